@@ -39,6 +39,7 @@ from .event import (
     Wait,
     CloseChannel,
     ExpectDisconnect,
+    record_event_locations,
 )
 
 from .structure import Sequence, OneOf, AnyOrder, TryAll
@@ -46,6 +47,7 @@ from .structure import Sequence, OneOf, AnyOrder, TryAll
 from .runner import (
     Runner,
     Conn,
+    Checkpoint,
     remote_revocation_basepoint,
     remote_payment_basepoint,
     remote_delayed_payment_basepoint,
@@ -84,6 +86,14 @@ from .funding import (
     FinalizeFunding,
     AddWitnesses,
 )
+from .gossip import GossipGraph
+from .gossip_query import (
+    ChannelRange,
+    ExpectReplyChannelRange,
+    channel_range_scids,
+    channel_range_timestamps,
+    channel_range_checksums,
+)
 from .proposals import dual_fund_csv, channel_type_csv
 
 __all__ = [
@@ -94,6 +104,7 @@ __all__ = [
     "ResolvableStr",
     "ResolvableBool",
     "Event",
+    "record_event_locations",
     "Connect",
     "Disconnect",
     "DualFundAccept",
@@ -123,6 +134,7 @@ __all__ = [
     "DummyRunner",
     "Runner",
     "Conn",
+    "Checkpoint",
     "KeySet",
     "peer_message_namespace",
     "namespace",
@@ -148,6 +160,12 @@ __all__ = [
     "AcceptFunding",
     "CreateFunding",
     "Funding",
+    "GossipGraph",
+    "ChannelRange",
+    "ExpectReplyChannelRange",
+    "channel_range_scids",
+    "channel_range_timestamps",
+    "channel_range_checksums",
     "regtest_hash",
     "privkey_expand",
     "Wait",
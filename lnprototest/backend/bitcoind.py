@@ -5,43 +5,268 @@
 # https://creativecommons.org/publicdomain/zero/1.0/
 
 import os
+import base64
+import decimal
+import functools
+import http.client
+import json
+import re
+import select
 import shutil
 import subprocess
 import logging
 import socket
+import tempfile
+import threading
 
 from contextlib import closing
-from typing import Any, Callable, Optional
-from bitcoin.rpc import RawProxy
+from typing import Any, Callable, Dict, List, Optional, Sequence, Tuple
+from bitcoin.rpc import JSONRPCError, DEFAULT_HTTP_TIMEOUT
 from .backend import Backend
+from ..utils import cache_dir
+
+# A JSON-RPC call: the method name, then its arguments.
+RpcCall = Tuple[Any, ...]
+
+# Calls which change nothing, so can be sent again if we don't get a reply.
+READ_ONLY_METHODS = frozenset(
+    [
+        "getbestblockhash",
+        "getblock",
+        "getblockchaininfo",
+        "getblockcount",
+        "getblockhash",
+        "getmempoolinfo",
+        "getnetworkinfo",
+        "getrawmempool",
+        "getrawtransaction",
+    ]
+)
+
+
+class _Abbrev(object):
+    """Formats as (the start of) a value, only if something logs it"""
+
+    def __init__(self, val: Any, maxlen: int = 200):
+        self.val = val
+        self.maxlen = maxlen
+
+    def __str__(self) -> str:
+        s = str(self.val)
+        if len(s) > self.maxlen:
+            return "{}... ({} chars)".format(s[: self.maxlen], len(s))
+        return s
+
+
+def _json_default(obj: Any) -> Any:
+    if isinstance(obj, decimal.Decimal):
+        return float(obj)
+    raise TypeError("{} is not JSON serializable".format(obj))
+
+
+# Bump this if start() would mine a different chain (or the template changes).
+TEMPLATE_VERSION = 2
+
+# The template's tip (block 101) hash, kept alongside its chain.
+TEMPLATE_TIP = "lnprototest-tip"
+
+# Every rewind leaves invalidated blocks behind in bitcoind's block index,
+# so after this many we start again from the template instead.
+MAX_REWINDS = 50
+
+
+@functools.lru_cache(maxsize=None)
+def bitcoind_version() -> str:
+    """The version of the bitcoind we run, e.g. "Bitcoin Core version v25.0.0" """
+    out = subprocess.run(
+        ["bitcoind", "-version"], stdout=subprocess.PIPE, check=True
+    ).stdout
+    return out.decode("utf-8").splitlines()[0]
+
+
+def clone_dir(src: str, dest: str) -> None:
+    """Copy src to dest, sharing the data (copy-on-write) if we can"""
+    try:
+        subprocess.run(
+            ["cp", "-a", "--reflink=auto", src, dest],
+            stderr=subprocess.DEVNULL,
+            check=True,
+        )
+    except (OSError, subprocess.CalledProcessError):
+        # Not GNU cp?
+        shutil.rmtree(dest, ignore_errors=True)
+        shutil.copytree(src, dest)
 
 
 class BitcoinProxy:
-    """Wrapper for BitcoinProxy to reconnect.
+    """JSON-RPC client for bitcoind, which keeps its connections open.
 
-    Long wait times between calls to the Bitcoin RPC could result in
-    `bitcoind` closing the connection, so here we just create
-    throwaway connections. This is easier than to reach into the RPC
-    library to close, reopen and reauth upon failure.
+    Idle HTTP connections are kept in a pool, and reused for later calls
+    (from any thread).  bitcoind may close a connection which has been
+    idle for a while: we don't reuse one it has closed, and if a pooled
+    connection fails anyway the call is retried once on a new one, as
+    long as bitcoind can't have acted on it already (see __post).
+    batch() makes many calls in one round trip.
     """
 
     def __init__(self, btc_conf_file: str, *args: Any, **kwargs: Any):
         self.btc_conf_file = btc_conf_file
+        conf = self.__read_conf(btc_conf_file)
+        self.port = int(conf["rpcport"])
+        auth = "{}:{}".format(conf["rpcuser"], conf["rpcpassword"])
+        self.headers = {
+            "Authorization": "Basic " + base64.b64encode(auth.encode()).decode(),
+            "Content-type": "application/json",
+        }
+        self.idle: List[http.client.HTTPConnection] = []
+        self.lock = threading.Lock()
+        self.next_id = 0
+
+    @staticmethod
+    def __read_conf(btc_conf_file: str) -> Dict[str, str]:
+        conf = {}
+        with open(btc_conf_file) as f:
+            for line in f:
+                if "=" in line:
+                    k, v = line.split("=", 1)
+                    conf[k.strip()] = v.strip()
+        return conf
+
+    @staticmethod
+    def __dropped(conn: http.client.HTTPConnection) -> bool:
+        """Has the other end closed this idle connection?"""
+        if conn.sock is None:
+            return True
+        # An idle connection only becomes readable if it's been closed.
+        return bool(select.select([conn.sock], [], [], 0)[0])
+
+    def __idle_conn(self) -> Optional[http.client.HTTPConnection]:
+        while True:
+            with self.lock:
+                conn = self.idle.pop() if self.idle else None
+            if conn is None or not self.__dropped(conn):
+                return conn
+            conn.close()
+
+    def __post(self, body: Any, read_only: bool) -> Any:
+        """Send body, retrying on a new connection if a reused one fails.
+
+        Once the request has been sent, bitcoind may have acted on it even
+        if we never see the reply, so then only read_only calls are sent
+        again."""
+        postdata = json.dumps(body, default=_json_default)
+        conn = self.__idle_conn()
+        # Only a reused connection gets another chance.
+        for fresh in ([False, True] if conn else [True]):
+            if fresh:
+                conn = http.client.HTTPConnection(
+                    "127.0.0.1", self.port, timeout=DEFAULT_HTTP_TIMEOUT
+                )
+            assert conn
+            sent = False
+            try:
+                conn.request("POST", "/", postdata, self.headers)
+                sent = True
+                response = conn.getresponse()
+                rdata = response.read()
+                break
+            except (http.client.HTTPException, OSError):
+                conn.close()
+                if fresh or (sent and not read_only):
+                    raise
+        with self.lock:
+            self.idle.append(conn)
+
+        try:
+            return json.loads(rdata, parse_float=decimal.Decimal)
+        except ValueError:
+            raise JSONRPCError(
+                {
+                    "code": -342,
+                    "message": "non-JSON HTTP response with '{} {}': {}".format(
+                        response.status, response.reason, rdata[:20]
+                    ),
+                }
+            )
+
+    def __next_ids(self, n: int = 1) -> int:
+        """Reserve n request ids, returning the first"""
+        with self.lock:
+            self.next_id += n
+            return self.next_id - n + 1
+
+    @staticmethod
+    def __result(response: Dict[str, Any]) -> Any:
+        err = response.get("error")
+        if err is not None:
+            if isinstance(err, dict):
+                raise JSONRPCError(
+                    {
+                        "code": err.get("code", -345),
+                        "message": err.get("message", "error message not specified"),
+                    }
+                )
+            raise JSONRPCError({"code": -344, "message": str(err)})
+        if "result" not in response:
+            raise JSONRPCError({"code": -343, "message": "missing JSON-RPC result"})
+        return response["result"]
+
+    def call(self, name: str, *args: Any) -> Any:
+        logging.debug("Calling %s with arguments %s", name, _Abbrev(args))
+        res = self.__result(
+            self.__post(
+                {
+                    "version": "1.1",
+                    "method": name,
+                    "params": args,
+                    "id": self.__next_ids(),
+                },
+                name in READ_ONLY_METHODS,
+            )
+        )
+        logging.debug("Result for %s call: %s", name, _Abbrev(res))
+        return res
+
+    def batch(self, calls: Sequence[RpcCall]) -> List[Any]:
+        """Make every (method, *args) call in one request; returns each result.
+
+        Raises JSONRPCError if any of them failed."""
+        if not calls:
+            return []
+        first_id = self.__next_ids(len(calls))
+        logging.debug("Calling batch %s", _Abbrev(calls))
+        responses = self.__post(
+            [
+                {"version": "1.1", "method": c[0], "params": c[1:], "id": first_id + i}
+                for i, c in enumerate(calls)
+            ],
+            all(c[0] in READ_ONLY_METHODS for c in calls),
+        )
+        if not isinstance(responses, list):
+            # bitcoind answers a batch it can't parse with a single error.
+            self.__result(responses)
+            raise JSONRPCError({"code": -343, "message": "missing batch results"})
+        by_id = {r.get("id"): r for r in responses}
+        results = [
+            self.__result(by_id.get(first_id + i, {})) for i in range(len(calls))
+        ]
+        logging.debug("Results for batch: %s", _Abbrev(results))
+        return results
+
+    def close(self) -> None:
+        """Close our idle connections (e.g. once bitcoind has stopped)"""
+        with self.lock:
+            idle, self.idle = self.idle, []
+        for conn in idle:
+            conn.close()
 
     def __getattr__(self, name: str) -> Callable:
         if name.startswith("__") and name.endswith("__"):
             # Python internal stuff
             raise AttributeError
 
-        def f(*args: Any) -> Callable:
-            self.__proxy = RawProxy(btc_conf_file=self.btc_conf_file)
-
-            logging.debug(
-                "Calling {name} with arguments {args}".format(name=name, args=args)
-            )
-            res = self.__proxy._call(name, *args)
-            logging.debug("Result for {name} call: {res}".format(name=name, res=res))
-            return res
+        def f(*args: Any) -> Any:
+            return self.call(name, *args)
 
         # Make debuggers show <function bitcoin.rpc.name> rather than <function
         # bitcoin.rpc.<lambda>>
@@ -69,6 +294,8 @@ class Bitcoind(Backend):
             "-nolisten",
         ]
         self.btc_version = None
+        self.template_tip: Optional[str] = None
+        self.rewinds = 0
 
     def __reserve(self) -> int:
         """
@@ -120,9 +347,10 @@ class Bitcoind(Backend):
         if self.btc_version >= 210000:
             # Maintains the compatibility between wallet
             # different ln implementation can use the main wallet (?)
-            self.rpc.createwallet(
-                "main" if self.with_wallet is None else self.with_wallet
-            )  # Automatically loads
+            self.rpc.createwallet(self.wallet_name())  # Automatically loads
+
+    def wallet_name(self) -> str:
+        return "main" if self.with_wallet is None else self.with_wallet
 
     def __is__bitcoind_ready(self) -> bool:
         """Check if bitcoind is ready during the execution"""
@@ -135,17 +363,60 @@ class Bitcoind(Backend):
             pass
         return True
 
-    def start(self) -> None:
-        if self.rpc is None:
-            self.__init_bitcoin_conf()
+    def __start_proc(self, extra_args: List[str] = []) -> None:
+        """Launch bitcoind on our datadir, and wait until it's ready"""
         # TODO: We can move this to a single call and not use Popen
-        self.proc = subprocess.Popen(self.cmd_line, stdout=subprocess.PIPE)
+        self.proc = subprocess.Popen(self.cmd_line + extra_args, stdout=subprocess.PIPE)
         assert self.proc.stdout
 
         # Wait for it to startup.
         while not self.__is__bitcoind_ready():
             logging.debug("Bitcoin core is loading")
 
+    def __template(self) -> str:
+        """The regtest datadir start() copies: 101 blocks, and our wallet.
+
+        It's built the first time it's needed for each bitcoind version,
+        and kept under cache_dir().
+        """
+        key = re.sub(
+            "[^A-Za-z0-9.]+",
+            "-",
+            "{}-{}-{}".format(TEMPLATE_VERSION, bitcoind_version(), self.wallet_name()),
+        )
+        parent = cache_dir("bitcoind")
+        template = os.path.join(parent, key)
+        if os.path.exists(template):
+            return template
+
+        logging.debug(f"Building bitcoind template {template}")
+        builddir = tempfile.mkdtemp(prefix="build-", dir=parent)
+        builder = Bitcoind(builddir, self.with_wallet)
+        try:
+            builder.__init_bitcoin_conf()
+            builder.__mine()
+            tip = builder.rpc.getbestblockhash()
+            builder.__shutdown()
+            built = os.path.join(builder.bitcoin_dir, "regtest")
+            os.remove(os.path.join(built, "debug.log"))
+            with open(os.path.join(built, TEMPLATE_TIP), "w") as f:
+                f.write(tip)
+            try:
+                os.rename(built, template)
+            except OSError:
+                # Someone else (e.g. another test process) beat us to it.
+                if not os.path.exists(template):
+                    raise
+        finally:
+            if builder.proc is not None and builder.proc.poll() is None:
+                builder.proc.kill()
+            shutil.rmtree(builddir, ignore_errors=True)
+        return template
+
+    def __mine(self) -> None:
+        """Start bitcoind on an empty datadir, and mine the first 101 blocks"""
+        self.__start_proc()
+
         self.__version_compatibility()
         # Block #1.
         # Privkey the coinbase spends to:
@@ -155,13 +426,184 @@ class Bitcoind(Backend):
         )
         self.rpc.generatetoaddress(100, self.rpc.getnewaddress())
 
+    def start(self) -> None:
+        """Start bitcoind with 101 blocks mined, from a copy of the template"""
+        if self.rpc is None:
+            self.__init_bitcoin_conf()
+        regtest_dir = os.path.join(self.bitcoin_dir, "regtest")
+        shutil.rmtree(regtest_dir, ignore_errors=True)
+        clone_dir(self.__template(), regtest_dir)
+        with open(os.path.join(regtest_dir, TEMPLATE_TIP)) as f:
+            self.template_tip = f.read().strip()
+        self.rewinds = 0
+        self.__start_proc()
+        self.btc_version = self.rpc.getnetworkinfo()["version"]
+        if self.btc_version >= 210000:
+            self.rpc.loadwallet(self.wallet_name())
+
     def stop(self) -> None:
         self.rpc.stop()
+        self.rpc.close()
         self.proc.kill()
         shutil.rmtree(os.path.join(self.bitcoin_dir, "regtest"))
 
+    def __shutdown(self) -> None:
+        """Stop bitcoind cleanly, leaving the datadir intact"""
+        self.rpc.stop()
+        self.rpc.close()
+        self.proc.wait()
+
+    def __resume(self, extra_args: List[str] = []) -> None:
+        """Start bitcoind again on an existing (already mined) datadir"""
+        self.__start_proc(extra_args)
+        if self.btc_version is not None and self.btc_version >= 210000:
+            self.rpc.loadwallet(self.wallet_name())
+
+    def snapshot(self, dest: str) -> None:
+        """Copy the regtest datadir to dest (bitcoind is stopped while we copy)"""
+        self.__shutdown()
+        shutil.copytree(os.path.join(self.bitcoin_dir, "regtest"), dest)
+        self.__resume()
+
+    def restore(self, src: str) -> None:
+        """Replace the regtest datadir with a snapshot() taken earlier"""
+        self.__shutdown()
+        regtest_dir = os.path.join(self.bitcoin_dir, "regtest")
+        shutil.rmtree(regtest_dir)
+        shutil.copytree(src, regtest_dir)
+        self.__resume()
+
+    def rewind(self) -> bool:
+        """Take the running bitcoind back to the template's chain, if we can.
+
+        Blocks after 101 are invalidated, rather than copying the template
+        again, and bitcoind is only restarted if that leaves anything in
+        the mempool.  Returns False (and logs why) if we didn't end up
+        exactly where start() left us.
+        """
+        if self.rewinds >= MAX_REWINDS:
+            logging.debug("Rewound bitcoind %d times: starting afresh", self.rewinds)
+            return False
+        blockcount, mempool = self.rpc.batch([("getblockcount",), ("getrawmempool",)])
+        if blockcount < 101:
+            logging.warning("Can't rewind bitcoind from %d blocks", blockcount)
+            return False
+        if blockcount > 101:
+            # This takes every later block with it, and puts their
+            # transactions back in the mempool.  We don't reconsiderblock
+            # afterwards: that would make the old (longer) chain active again.
+            self.rpc.invalidateblock(self.rpc.getblockhash(102))
+            mempool = self.rpc.getrawmempool()
+        if mempool:
+            self.__clear_mempool()
+        tip, mempool = self.rpc.batch([("getbestblockhash",), ("getrawmempool",)])
+        if tip != self.template_tip:
+            logging.warning(
+                "Rewound bitcoind to %s, not %s: starting afresh",
+                tip,
+                self.template_tip,
+            )
+            return False
+        if mempool:
+            logging.warning(
+                "Rewound bitcoind with %d txs in its mempool: starting afresh",
+                len(mempool),
+            )
+            return False
+        self.rewinds += 1
+        return True
+
+    def __clear_mempool(self) -> None:
+        """Restart bitcoind with an empty mempool, and keep it that way"""
+        # There's no RPC to evict them, so restart without them.
+        self.__shutdown()
+        mempool_dat = os.path.join(self.bitcoin_dir, "regtest", "mempool.dat")
+        if os.path.exists(mempool_dat):
+            os.remove(mempool_dat)
+        # Otherwise the wallet puts its own txs straight back.
+        self.__resume(["-walletbroadcast=0"])
+
+        # Abandon them (now they're out of the mempool), so the wallet
+        # doesn't resubmit them when bitcoind next restarts either.
+        for tx in self.rpc.listtransactions("*", 1000000, 0, True):
+            if tx["confirmations"] > 0 or tx.get("generated") or tx.get("abandoned"):
+                continue
+            try:
+                self.rpc.abandontransaction(tx["txid"])
+            except JSONRPCError as ex:
+                logging.debug("Can't abandon %s: %s", tx["txid"], ex)
+
     def restart(self) -> None:
-        # Only restart if we have to.
-        if self.rpc.getblockcount() != 101 or self.rpc.getrawmempool() != []:
+        """Back to 101 blocks and an empty mempool: rewind, or start afresh"""
+        if not self.rewind():
             self.stop()
             self.start()
+
+
+def test_bitcoin_proxy_retry() -> None:
+    import socketserver
+    import time
+
+    # What the server does with each request: "reply", reply then "close",
+    # or "drop" the connection without replying.
+    actions: List[str] = []
+    methods: List[str] = []
+
+    class Handler(socketserver.StreamRequestHandler):
+        def handle(self) -> None:
+            while True:
+                line = self.rfile.readline()
+                length = 0
+                while line not in (b"\r\n", b""):
+                    if line.lower().startswith(b"content-length:"):
+                        length = int(line.split(b":")[1])
+                    line = self.rfile.readline()
+                if not line:
+                    return
+                req = json.loads(self.rfile.read(length))
+                methods.append(req["method"])
+                action = actions.pop(0) if actions else "reply"
+                if action == "drop":
+                    return
+                data = json.dumps({"result": req["method"], "id": req["id"]}).encode()
+                self.wfile.write(
+                    b"HTTP/1.1 200 OK\r\nContent-Length: %d\r\n\r\n" % len(data) + data
+                )
+                if action == "close":
+                    return
+
+    server = socketserver.ThreadingTCPServer(("127.0.0.1", 0), Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    with tempfile.NamedTemporaryFile("w", suffix=".conf") as conf:
+        conf.write(
+            "rpcuser=u\nrpcpassword=p\nrpcport={}\n".format(server.server_address[1])
+        )
+        conf.flush()
+        rpc = BitcoinProxy(btc_conf_file=conf.name)
+        try:
+            # A connection bitcoind closed while idle isn't reused.
+            actions.append("close")
+            assert rpc.sendrawtransaction("00") == "sendrawtransaction"
+            time.sleep(0.2)
+            assert rpc.sendrawtransaction("01") == "sendrawtransaction"
+            assert methods == ["sendrawtransaction"] * 2
+
+            # No reply: it may have been sent, so don't send it again.
+            actions.append("drop")
+            try:
+                rpc.sendrawtransaction("02")
+                assert False, "Expected an error"
+            except (http.client.HTTPException, OSError):
+                pass
+            assert methods == ["sendrawtransaction"] * 3
+
+            # But a read-only call is safe to retry.
+            assert rpc.getblockcount() == "getblockcount"
+            actions.append("drop")
+            assert rpc.getblockcount() == "getblockcount"
+            assert methods[3:] == ["getblockcount"] * 3
+        finally:
+            rpc.close()
+            server.shutdown()
+            server.server_close()
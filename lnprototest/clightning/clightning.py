@@ -14,7 +14,9 @@ import bitcoin.core
 import struct
 import shutil
 import logging
+import queue
 import socket
+import threading
 import time
 
 from contextlib import closing
@@ -27,14 +29,18 @@ from lnprototest import (
     SpecFileError,
     KeySet,
     Conn,
+    Checkpoint,
     namespace,
     MustNotMsg,
 )
 from lnprototest import wait_for
-from typing import Dict, Any, Callable, List, Optional, cast
+from typing import Dict, Any, Callable, List, Optional, Tuple, cast
 
 TIMEOUT = int(os.getenv("TIMEOUT", "60"))
 LIGHTNING_SRC = os.path.join(os.getcwd(), os.getenv("LIGHTNING_SRC", "../lightning/"))
+# How many messages a connection holds before its reader stops reading,
+# so a flood of gossip pushes back on the node rather than eating memory.
+RECV_QUEUE_SIZE = 4096
 
 
 class CLightningConn(lnprototest.Conn):
@@ -52,6 +58,63 @@ class CLightningConn(lnprototest.Conn):
             "127.0.0.1",
             port,
         )
+        # (time received, message), then (time, None) once it's closed.
+        self.received: "queue.Queue[Tuple[float, Optional[bytes]]]" = queue.Queue(
+            RECV_QUEUE_SIZE
+        )
+        # When the last message we returned was received (by time.time()).
+        self.last_received: Optional[float] = None
+        self.eof = False
+        self.closing = False
+        self.reader = threading.Thread(
+            target=self._read_all, name="conn-{}".format(connprivkey), daemon=True
+        )
+        self.reader.start()
+
+    def _read_all(self) -> None:
+        """Read every message, in the background, until the connection closes"""
+        while True:
+            try:
+                msg: Optional[bytes] = self.connection.read_message()
+            except Exception as ex:
+                logging.debug(f"connection {self.name} closed: {ex}")
+                msg = None
+            item = (time.time(), msg)
+            # Don't wait forever for room if nobody's going to read it.
+            while not self.closing:
+                try:
+                    self.received.put(item, timeout=1)
+                    break
+                except queue.Full:
+                    pass
+            if msg is None or self.closing:
+                return
+
+    def read_message(self, timeout: float) -> Optional[bytes]:
+        """The next message, or None if none arrives in time or it's closed"""
+        if self.eof:
+            return None
+        try:
+            received, msg = self.received.get(timeout=timeout)
+        except queue.Empty:
+            logging.error(f"timeout reading from {self.name} after {timeout}s")
+            return None
+        if msg is None:
+            self.eof = True
+            return None
+        self.last_received = received
+        logging.debug("msg from %s waited %.3fs", self.name, time.time() - received)
+        return msg
+
+    def close(self) -> None:
+        self.closing = True
+        try:
+            # This wakes the reader, unlike close().
+            self.connection.connection.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.connection.connection.close()
+        self.reader.join(TIMEOUT)
 
 
 class Runner(lnprototest.Runner):
@@ -203,11 +266,14 @@ class Runner(lnprototest.Runner):
             self.bitcoind.stop()
 
     def stop(self, print_logs: bool = False, also_bitcoind: bool = True) -> None:
+        if not self.running:
+            # e.g. a failed TryAll branch, after this runner finished its own
+            return
         self.logger.debug("[STOP]")
         self.shutdown(also_bitcoind=also_bitcoind)
         self.running = False
         for c in self.conns.values():
-            cast(CLightningConn, c).connection.connection.close()
+            cast(CLightningConn, c).close()
         if print_logs:
             log_path = f"{self.lightning_dir}/regtest/log"
             with open(log_path) as log:
@@ -223,11 +289,62 @@ class Runner(lnprototest.Runner):
     def restart(self) -> None:
         self.logger.debug("[RESTART]")
         self.stop(also_bitcoind=False)
-        # Make a clean start
+        # Make a clean start (bitcoind keeps running, and rewinds its chain)
         super().restart()
         self.bitcoind.restart()
         self.start(also_bitcoind=False)
 
+    def branch_runner(self) -> "Runner":
+        runner = cast(Runner, super().branch_runner())
+        # So add_startup_flag() only affects this branch's node.
+        runner.startup_flags = list(self.startup_flags)
+        runner.options = dict(self.options)
+        runner.running = False
+        runner.rpc = None
+        runner.bitcoind = None
+        runner.proc = None
+        runner.cleanup_callbacks = []
+        runner.fundchannel_future = None
+        runner.is_fundchannel_kill = False
+        runner.executor = futures.ThreadPoolExecutor(max_workers=20)
+        return runner
+
+    def checkpoint(self, event: Event) -> Optional[Checkpoint]:
+        # We can't snapshot a live peer connection (or an RPC call which is
+        # still in flight), so only checkpoint if none are left open.
+        if self.conns or self.fundchannel_future:
+            self.logger.debug("[CHECKPOINT] skipped: connections still open")
+            return None
+
+        self.logger.debug("[CHECKPOINT]")
+        snapshot_dir = os.path.join(self.directory, "checkpoint")
+        self.shutdown(also_bitcoind=False)
+        self.proc.wait()
+        self.running = False
+        shutil.copytree(
+            os.path.join(self.lightning_dir, "regtest"),
+            os.path.join(snapshot_dir, "lightningd"),
+        )
+        self.bitcoind.snapshot(os.path.join(snapshot_dir, "bitcoind"))
+        self.start(also_bitcoind=False)
+        return Checkpoint(self, event, snapshot_dir)
+
+    def restore(self, checkpoint: Checkpoint) -> None:
+        self.logger.debug("[RESTORE]")
+        self.shutdown(also_bitcoind=False)
+        self.proc.wait()
+        self.running = False
+        for c in self.conns.values():
+            cast(CLightningConn, c).close()
+        shutil.rmtree(os.path.join(self.lightning_dir, "regtest"))
+        self.bitcoind.restore(os.path.join(checkpoint.node_state, "bitcoind"))
+        shutil.copytree(
+            os.path.join(checkpoint.node_state, "lightningd"),
+            os.path.join(self.lightning_dir, "regtest"),
+        )
+        self.start(also_bitcoind=False)
+        super().restore(checkpoint)
+
     def connect(self, _: Event, connprivkey: str) -> None:
         self.add_conn(CLightningConn(connprivkey, self.lightning_port))
 
@@ -239,8 +356,7 @@ class Runner(lnprototest.Runner):
         self.bitcoind.rpc.invalidateblock(h)
 
     def add_blocks(self, event: Event, txs: List[str], n: int) -> None:
-        for tx in txs:
-            self.bitcoind.rpc.sendrawtransaction(tx)
+        self.bitcoind.rpc.batch([("sendrawtransaction", tx) for tx in txs])
         self.bitcoind.rpc.generatetoaddress(n, self.bitcoind.rpc.getnewaddress())
 
         wait_for(lambda: self.rpc.getinfo()["blockheight"] == self.getblockheight())
@@ -251,13 +367,7 @@ class Runner(lnprototest.Runner):
         except BrokenPipeError:
             # This happens when they've sent an error and closed; try
             # reading it to figure out what went wrong.
-            fut = self.executor.submit(
-                cast(CLightningConn, conn).connection.read_message
-            )
-            try:
-                msg = fut.result(1)
-            except futures.TimeoutError:
-                msg = None
+            msg = cast(CLightningConn, conn).read_message(1)
             if msg:
                 raise EventError(
                     event, "Connection closed after sending {}".format(msg.hex())
@@ -444,15 +554,7 @@ class Runner(lnprototest.Runner):
     def get_output_message(
         self, conn: Conn, event: Event, timeout: int = TIMEOUT
     ) -> Optional[bytes]:
-        fut = self.executor.submit(cast(CLightningConn, conn).connection.read_message)
-        try:
-            return fut.result(timeout)
-        except futures.TimeoutError as ex:
-            logging.error(f"timeout exception {ex}")
-            return None
-        except Exception as ex:
-            logging.error(f"{ex}")
-            return None
+        return cast(CLightningConn, conn).read_message(timeout)
 
     def check_error(self, event: Event, conn: Conn) -> Optional[str]:
         # We get errors in form of err msgs, always.
@@ -488,7 +590,7 @@ class Runner(lnprototest.Runner):
                 if msgtype == namespace().get_msgtype("error").number:
                     raise EventError(event, "Got error msg: {}".format(binmsg.hex()))
 
-        cast(CLightningConn, conn).connection.connection.close()
+        cast(CLightningConn, conn).close()
 
     def expect_tx(self, event: Event, txid: str) -> None:
         # Ah bitcoin endianness...
@@ -498,14 +600,14 @@ class Runner(lnprototest.Runner):
         try:
             wait_for(lambda: revtxid in self.bitcoind.rpc.getrawmempool())
         except ValueError:
+            mempool = self.bitcoind.rpc.getrawmempool()
+            rawtxs = self.bitcoind.rpc.batch(
+                [("getrawtransaction", txid) for txid in mempool]
+            )
             raise EventError(
                 event,
                 "Did not broadcast the txid {}, just {}".format(
-                    revtxid,
-                    [
-                        (txid, self.bitcoind.rpc.getrawtransaction(txid))
-                        for txid in self.bitcoind.rpc.getrawmempool()
-                    ],
+                    revtxid, list(zip(mempool, rawtxs))
                 ),
             )
 
@@ -6,6 +6,7 @@ from bitcoin.core import (
     CTxIn,
     Hash160,
     CMutableTransaction,
+    CTransaction,
     CTxWitness,
     CScriptWitness,
 )
@@ -16,8 +17,21 @@ import struct
 from hashlib import sha256
 from .keyset import KeySet
 from .errors import SpecFileError, EventError
-from .signature import Sig
-from typing import List, Tuple, Callable, Union, Optional, Dict
+from .signature import Sig, sign_all
+from .sighash import SighashCache, htlc_sighashes
+from .compact_tx import CompactTx, SLOT, script_template, p2wsh
+from typing import (
+    Any,
+    Hashable,
+    Iterator,
+    List,
+    Tuple,
+    Callable,
+    Union,
+    Optional,
+    Dict,
+    TypeVar,
+)
 from .event import Event, ResolvableInt, ResolvableStr, negotiated, msat
 from .runner import Runner
 from .utils import Side, check_hex
@@ -25,8 +39,13 @@ from .funding import Funding
 import coincurve
 import json
 
+T = TypeVar("T")
+
 
 class HTLC(object):
+    # Never changed once made, so checkpoints can share them.
+    immutable = True
+
     def __init__(
         self,
         owner: Side,
@@ -78,6 +97,216 @@ class HTLC(object):
         return feerate_per_kw * base // 1000
 
 
+class HTLCTable(object):
+    """The HTLCs in a commitment, by id, indexed for large HTLC sets.
+
+    HTLCs can also be found by object or payment hash, and the untrimmed
+    HTLCs for the current feerate are kept up to date as HTLCs are added
+    and removed, rather than rechecking every HTLC for every transaction.
+    """
+
+    def __init__(self, dust_limit: Tuple[int, int], option_anchor_outputs: bool):
+        self.dust_limit = dust_limit
+        self.option_anchor_outputs = option_anchor_outputs
+        self.by_id: Dict[int, HTLC] = {}
+        # id(htlc) -> htlc_id
+        self.by_object: Dict[int, int] = {}
+        self.by_payment_hash: Dict[bytes, List[int]] = {}
+        # (feerate, side) -> min untrimmed amount_msat for (offered, received)
+        self.thresholds: Dict[Tuple[int, Side], Tuple[int, int]] = {}
+        # (feerate, side) -> untrimmed HTLCs, in order added, for one feerate.
+        self.untrimmed: Dict[Tuple[int, Side], Dict[int, HTLC]] = {}
+
+    def _thresholds(self, feerate: int, side: Side) -> Tuple[int, int]:
+        thresholds = self.thresholds.get((feerate, side))
+        if thresholds is None:
+            # BOLT #3:
+            #   - for every offered HTLC:
+            #     - if the HTLC amount minus the HTLC-timeout fee would be less than
+            #     `dust_limit_satoshis` set by the transaction owner:
+            #       - MUST NOT contain that output.
+            #     - otherwise:
+            #       - MUST be generated as specified in
+            #       [Offered HTLC Outputs](#offered-htlc-outputs).
+            #   - for every received HTLC:
+            #     - if the HTLC amount minus the HTLC-success fee would be less
+            #      than `dust_limit_satoshis` set by the transaction owner:
+            #       - MUST NOT contain that output.
+            #     - otherwise:
+            #       - MUST be generated as specified in
+            #       [Received HTLC Outputs](#received-htlc-outputs).
+            thresholds = (
+                msat(
+                    HTLC.htlc_timeout_fee(feerate, self.option_anchor_outputs)
+                    + self.dust_limit[side]
+                ),
+                msat(
+                    HTLC.htlc_success_fee(feerate, self.option_anchor_outputs)
+                    + self.dust_limit[side]
+                ),
+            )
+            self.thresholds[(feerate, side)] = thresholds
+        return thresholds
+
+    def is_trimmed(self, htlc: HTLC, feerate: int, side: Side) -> bool:
+        offered, received = self._thresholds(feerate, side)
+        if htlc.owner == side:
+            return htlc.amount_msat < offered
+        return htlc.amount_msat < received
+
+    def untrimmed_htlcs(self, feerate: int, side: Side) -> List[HTLC]:
+        untrimmed = self.untrimmed.get((feerate, side))
+        if untrimmed is None:
+            # Only keep them for one feerate: it rarely changes.
+            for key in [k for k in self.untrimmed if k[0] != feerate]:
+                del self.untrimmed[key]
+            untrimmed = {
+                htlc_id: htlc
+                for htlc_id, htlc in self.by_id.items()
+                if not self.is_trimmed(htlc, feerate, side)
+            }
+            self.untrimmed[(feerate, side)] = untrimmed
+        return list(untrimmed.values())
+
+    def add(self, htlc_id: int, htlc: HTLC) -> bool:
+        if htlc_id in self.by_id:
+            return False
+        self.by_id[htlc_id] = htlc
+        self.by_object[id(htlc)] = htlc_id
+        self.by_payment_hash.setdefault(htlc.raw_payment_hash(), []).append(htlc_id)
+        for (feerate, side), untrimmed in self.untrimmed.items():
+            if not self.is_trimmed(htlc, feerate, side):
+                untrimmed[htlc_id] = htlc
+        return True
+
+    def remove(self, htlc: HTLC) -> bool:
+        htlc_id = self.by_object.pop(id(htlc), None)
+        if htlc_id is None:
+            return False
+        del self.by_id[htlc_id]
+        payment_hash = htlc.raw_payment_hash()
+        self.by_payment_hash[payment_hash].remove(htlc_id)
+        if not self.by_payment_hash[payment_hash]:
+            del self.by_payment_hash[payment_hash]
+        for untrimmed in self.untrimmed.values():
+            untrimmed.pop(htlc_id, None)
+        return True
+
+    def with_payment_hash(self, payment_hash: bytes) -> List[HTLC]:
+        return [self.by_id[i] for i in self.by_payment_hash.get(payment_hash, [])]
+
+    def items(self) -> Iterator[Tuple[int, HTLC]]:
+        return iter(self.by_id.items())
+
+    def values(self) -> Iterator[HTLC]:
+        return iter(self.by_id.values())
+
+    def __contains__(self, htlc_id: int) -> bool:
+        return htlc_id in self.by_id
+
+    def __getitem__(self, htlc_id: int) -> HTLC:
+        return self.by_id[htlc_id]
+
+    def __len__(self) -> int:
+        return len(self.by_id)
+
+    def __iter__(self) -> Iterator[int]:
+        return iter(self.by_id)
+
+
+class DerivedKeys(object):
+    """The keys for side's commitment transaction number commitnum.
+
+    Every output of a commitment transaction (and every HTLC transaction
+    spending it) uses the same few keys, so each is derived only once.
+    """
+
+    def __init__(self, keyset: List[KeySet], side: Side, commitnum: int):
+        self.keyset = keyset
+        self.side = side
+        self.commitnum = commitnum
+        # All keyed by the secrets they're derived from, so they're right
+        # even if a keyset's secrets change (as the BOLT #3 tests do).
+        self.points: Dict[bytes, coincurve.PublicKey] = {}
+        self.revocations: Dict[Tuple[bytes, bytes], coincurve.PrivateKey] = {}
+        self.tweaked: Dict[Tuple[bytes, bytes], coincurve.PrivateKey] = {}
+        self.pubkeys: Dict[bytes, coincurve.PublicKey] = {}
+
+    def per_commitment_point(self) -> coincurve.PublicKey:
+        seed = self.keyset[self.side].shachain_seed
+        point = self.points.get(seed)
+        if point is None:
+            point = self.keyset[self.side].raw_per_commit_point(self.commitnum)
+            self.points[seed] = point
+        return point
+
+    def pubkey(self, privkey: coincurve.PrivateKey) -> coincurve.PublicKey:
+        pubkey = self.pubkeys.get(privkey.secret)
+        if pubkey is None:
+            pubkey = coincurve.PublicKey.from_secret(privkey.secret)
+            self.pubkeys[privkey.secret] = pubkey
+        return pubkey
+
+    def revocation_privkey(self) -> coincurve.PrivateKey:
+        side = self.side
+        key = (
+            self.keyset[not side].revocation_base_secret.secret,
+            self.keyset[side].shachain_seed,
+        )
+        revocation = self.revocations.get(key)
+        if revocation is not None:
+            return revocation
+
+        # BOLT #3:
+        # The `revocationpubkey` is a blinded key: when the local node wishes
+        # to create a new commitment for the remote node, it uses its own
+        # `revocation_basepoint` and the remote node's `per_commitment_point`
+        # to derive a new `revocationpubkey` for the commitment.
+        revocation_basepoint_secret = self.keyset[not side].revocation_base_secret
+        revocation_basepoint = self.pubkey(revocation_basepoint_secret)
+        per_commitment_secret = self.keyset[side].raw_per_commit_secret(self.commitnum)
+        per_commitment_point = self.per_commitment_point()
+
+        # BOLT #3:
+        # ...
+        #    revocationprivkey = revocation_basepoint_secret * SHA256(revocation_basepoint || per_commitment_point)
+        #      + per_commitment_secret * SHA256(per_commitment_point || revocation_basepoint)
+        revocation_tweak = sha256(
+            revocation_basepoint.format() + per_commitment_point.format()
+        ).digest()
+        val = revocation_basepoint_secret.multiply(revocation_tweak, update=False)
+
+        per_commit_tweak = sha256(
+            per_commitment_point.format() + revocation_basepoint.format()
+        ).digest()
+
+        val2 = per_commitment_secret.multiply(per_commit_tweak, update=False)
+        revocation = val.add(val2.secret, update=False)
+        self.revocations[key] = revocation
+        return revocation
+
+    def basepoint_tweak(self, basesecret: coincurve.PrivateKey) -> coincurve.PrivateKey:
+        # BOLT #3:
+        # ### `localpubkey`, `local_htlcpubkey`, `remote_htlcpubkey`,
+        #  `local_delayedpubkey`, and `remote_delayedpubkey` Derivation
+        # ...
+        # The corresponding private keys can be similarly derived, if the
+        # basepoint secrets are known (i.e. the private keys corresponding to
+        # `localpubkey`, `local_htlcpubkey`, and `local_delayedpubkey` only):
+        #
+        #    privkey = basepoint_secret + SHA256(per_commitment_point || basepoint)
+        key = (basesecret.secret, self.keyset[self.side].shachain_seed)
+        privkey = self.tweaked.get(key)
+        if privkey is None:
+            basepoint = self.pubkey(basesecret)
+            tweak = sha256(
+                self.per_commitment_point().format() + basepoint.format()
+            ).digest()
+            privkey = basesecret.add(tweak, update=False)
+            self.tweaked[key] = privkey
+        return privkey
+
+
 class Commitment(object):
     def __init__(
         self,
@@ -95,6 +324,9 @@ class Commitment(object):
         option_static_remotekey: bool,
         option_anchor_outputs: bool,
     ):
+        # Bumped by anything which changes the transactions we'd build.
+        self.version = 0
+        self.built: Dict[Tuple[Any, ...], Any] = {}
         self.opener = opener
         self.funding = funding
         self.feerate = feerate
@@ -102,73 +334,79 @@ class Commitment(object):
         self.self_delay = (local_to_self_delay, remote_to_self_delay)
         self.amounts = [local_amount, remote_amount]
         self.dust_limit = (local_dust_limit, remote_dust_limit)
-        self.htlcs: Dict[int, HTLC] = {}
+        self.htlcs = HTLCTable(self.dust_limit, option_anchor_outputs)
         self.commitnum = 0
+        self.derived_keys: Dict[Tuple[Side, int], DerivedKeys] = {}
         self.option_static_remotekey = option_static_remotekey
         self.option_anchor_outputs = option_anchor_outputs
         if self.option_anchor_outputs:
             assert self.option_static_remotekey
 
+    @property
+    def feerate(self) -> int:
+        return self._feerate
+
+    @feerate.setter
+    def feerate(self, feerate: int) -> None:
+        self._feerate = feerate
+        self._changed()
+
+    @property
+    def commitnum(self) -> int:
+        return self._commitnum
+
+    @commitnum.setter
+    def commitnum(self, commitnum: int) -> None:
+        self._commitnum = commitnum
+        self._changed()
+
+    def _changed(self) -> None:
+        self.version += 1
+        self.built.clear()
+
+    def _memoized(self, what: Hashable, side: Side, build: Callable[[], T]) -> T:
+        """Build side's `what` once per version of this commitment.
+
+        The results are shared, so public methods return copies of them."""
+        # amounts is a plain list which callers (e.g. the BOLT #3 vector
+        # tests) may assign to directly, so it's part of the key.
+        key = (what, side, self.version, tuple(self.amounts))
+        if key not in self.built:
+            self.built[key] = build()
+        return self.built[key]
+
     @staticmethod
     def ripemd160(b: bytes) -> bytes:
         return ripemd160(b)
 
+    def keys(self, side: Side) -> DerivedKeys:
+        """The (lazily) derived keys for side's current commitment transaction"""
+        keys = self.derived_keys.get((side, self.commitnum))
+        if keys is None:
+            keys = DerivedKeys(self.keyset, side, self.commitnum)
+            self.derived_keys[(side, self.commitnum)] = keys
+        return keys
+
     def revocation_privkey(self, side: Side) -> coincurve.PrivateKey:
         """Derive the privkey used for the revocation of side's commitment transaction."""
-        # BOLT #3:
-        # The `revocationpubkey` is a blinded key: when the local node wishes
-        # to create a new commitment for the remote node, it uses its own
-        # `revocation_basepoint` and the remote node's `per_commitment_point`
-        # to derive a new `revocationpubkey` for the commitment.
-        revocation_basepoint_secret = self.keyset[not side].revocation_base_secret
-        revocation_basepoint = self.keyset[not side].raw_revocation_basepoint()
-        per_commitment_secret = self.keyset[side].raw_per_commit_secret(self.commitnum)
-        per_commitment_point = self.keyset[side].raw_per_commit_point(self.commitnum)
-
-        # BOLT #3:
-        # ...
-        #    revocationprivkey = revocation_basepoint_secret * SHA256(revocation_basepoint || per_commitment_point)
-        #      + per_commitment_secret * SHA256(per_commitment_point || revocation_basepoint)
-        revocation_tweak = sha256(
-            revocation_basepoint.format() + per_commitment_point.format()
-        ).digest()
-        val = revocation_basepoint_secret.multiply(revocation_tweak, update=False)
-
-        per_commit_tweak = sha256(
-            per_commitment_point.format() + revocation_basepoint.format()
-        ).digest()
-
-        val2 = per_commitment_secret.multiply(per_commit_tweak, update=False)
-        return val.add(val2.secret, update=False)
+        return self.keys(side).revocation_privkey()
 
     def revocation_pubkey(self, side: Side) -> coincurve.PublicKey:
         """Derive the pubkey used for side's commitment transaction."""
-        return coincurve.PublicKey.from_secret(self.revocation_privkey(side).secret)
+        keys = self.keys(side)
+        return keys.pubkey(keys.revocation_privkey())
 
     def _basepoint_tweak(
         self, basesecret: coincurve.PrivateKey, side: Side
     ) -> coincurve.PrivateKey:
-        # BOLT #3:
-        # ### `localpubkey`, `local_htlcpubkey`, `remote_htlcpubkey`,
-        #  `local_delayedpubkey`, and `remote_delayedpubkey` Derivation
-        # ...
-        # The corresponding private keys can be similarly derived, if the
-        # basepoint secrets are known (i.e. the private keys corresponding to
-        # `localpubkey`, `local_htlcpubkey`, and `local_delayedpubkey` only):
-        #
-        #    privkey = basepoint_secret + SHA256(per_commitment_point || basepoint)
-        per_commit_point = self.keyset[side].raw_per_commit_point(self.commitnum)
-        basepoint = coincurve.PublicKey.from_secret(basesecret.secret)
-
-        tweak = sha256(per_commit_point.format() + basepoint.format()).digest()
-        return basesecret.add(tweak, update=False)
+        return self.keys(side).basepoint_tweak(basesecret)
 
     def delayed_pubkey(self, side: Side) -> coincurve.PublicKey:
         """Generate local delayed_pubkey for this side"""
         privkey = self._basepoint_tweak(
             self.keyset[side].delayed_payment_base_secret, side
         )
-        return coincurve.PublicKey.from_secret(privkey.secret)
+        return self.keys(side).pubkey(privkey)
 
     def to_remote_pubkey(self, side: Side) -> coincurve.PublicKey:
         """Generate remote payment key for this side"""
@@ -177,6 +415,7 @@ class Commitment(object):
         # the `remotepubkey` is simply the remote node's `payment_basepoint`,
         # otherwise it is calculated as above using the remote node's
         # `payment_basepoint`.
+        keys = self.keys(side)
         if self.option_static_remotekey:
             privkey = self.keyset[not side].payment_base_secret
         else:
@@ -186,51 +425,48 @@ class Commitment(object):
             print(
                 "to-remote for side {}: self->payment = {} (local would be {}), per_commit_point = {}, keyset->self_payment_key = {}".format(
                     side,
-                    coincurve.PublicKey.from_secret(
-                        self.keyset[not side].payment_base_secret.secret
-                    )
+                    keys.pubkey(self.keyset[not side].payment_base_secret)
                     .format()
                     .hex(),
-                    coincurve.PublicKey.from_secret(
-                        self.keyset[Side.local].payment_base_secret.secret
-                    )
+                    keys.pubkey(self.keyset[Side.local].payment_base_secret)
                     .format()
                     .hex(),
-                    self.keyset[side].per_commit_point(self.commitnum),
-                    coincurve.PublicKey.from_secret(privkey.secret).format().hex(),
+                    keys.per_commitment_point().format().hex(),
+                    keys.pubkey(privkey).format().hex(),
                 )
             )
-        return coincurve.PublicKey.from_secret(privkey.secret)
+        return keys.pubkey(privkey)
 
     def local_htlc_pubkey(self, side: Side) -> coincurve.PublicKey:
         privkey = self._basepoint_tweak(self.keyset[side].htlc_base_secret, side)
-        return coincurve.PublicKey.from_secret(privkey.secret)
+        return self.keys(side).pubkey(privkey)
 
     def remote_htlc_pubkey(self, side: Side) -> coincurve.PublicKey:
         privkey = self._basepoint_tweak(self.keyset[not side].htlc_base_secret, side)
-        return coincurve.PublicKey.from_secret(privkey.secret)
+        return self.keys(side).pubkey(privkey)
 
     def add_htlc(self, htlc: HTLC, htlc_id: int) -> bool:
-        if htlc_id in self.htlcs:
+        if not self.htlcs.add(htlc_id, htlc):
             return False
-        self.htlcs[htlc_id] = htlc
         self.amounts[htlc.owner] -= htlc.amount_msat
+        self._changed()
         return True
 
     def del_htlc(self, htlc: HTLC, xfer_funds: bool) -> bool:
-        for k, v in self.htlcs.items():
-            if v == htlc:
-                if xfer_funds:
-                    gains_to = not htlc.owner
-                else:
-                    gains_to = htlc.owner  # type: ignore
-                self.amounts[gains_to] += htlc.amount_msat
-                del self.htlcs[k]
-                return True
-        return False
+        if not self.htlcs.remove(htlc):
+            return False
+        if xfer_funds:
+            gains_to = not htlc.owner
+        else:
+            gains_to = htlc.owner  # type: ignore
+        self.amounts[gains_to] += htlc.amount_msat
+        self._changed()
+        return True
 
     def inc_commitnum(self) -> None:
         self.commitnum += 1
+        # The old commitment's keys are never needed again.
+        self.derived_keys.clear()
 
     def channel_id_v2(self) -> str:
         # BOLT-0eebb43e32a513f3b4dd9ced72ad1e915aefdd25 #2:
@@ -303,19 +539,7 @@ class Commitment(object):
         #         <local_delayedpubkey>
         #     OP_ENDIF
         #     OP_CHECKSIG
-        to_self_script = script.CScript(
-            [
-                script.OP_IF,
-                self.revocation_pubkey(side).format(),
-                script.OP_ELSE,
-                self.self_delay[side],
-                script.OP_CHECKSEQUENCEVERIFY,
-                script.OP_DROP,
-                self.delayed_pubkey(side).format(),
-                script.OP_ENDIF,
-                script.OP_CHECKSIG,
-            ]
-        )
+        to_self_script = self._to_self_script(side)
 
         # BOLT #3: The amounts for each output MUST be rounded down to whole
         # satoshis. If this amount, minus the fees for the HTLC transaction,
@@ -329,6 +553,41 @@ class Commitment(object):
 
         return to_self_script, amount_to_self
 
+    def _to_self_script(self, side: Side) -> script.CScript:
+        """The to_local (and HTLC tx output) script for side's commitment"""
+        return self._memoized(
+            "to_self_script", side, lambda: self._build_to_self_script(side)
+        )
+
+    def _build_to_self_script(self, side: Side) -> script.CScript:
+        template = script_template(
+            "to_self",
+            lambda: [
+                script.OP_IF,
+                SLOT,  # revocationpubkey
+                script.OP_ELSE,
+                SLOT,  # to_self_delay
+                script.OP_CHECKSEQUENCEVERIFY,
+                script.OP_DROP,
+                SLOT,  # local_delayedpubkey
+                script.OP_ENDIF,
+                script.OP_CHECKSIG,
+            ],
+        )
+        return template.fill(
+            self.revocation_pubkey(side).format(),
+            self.self_delay[side],
+            self.delayed_pubkey(side).format(),
+        )
+
+    def _revocation_hash(self, side: Side) -> bytes:
+        """RIPEMD160(SHA256(revocationpubkey)), for every HTLC output"""
+        return self._memoized(
+            "revocation_hash",
+            side,
+            lambda: Hash160(self.revocation_pubkey(side).format()),
+        )
+
     def _to_remote_output(self, fee: int, side: Side) -> Tuple[script.CScript, int]:
         """Returns the scriptpubkey and amount"""
 
@@ -412,16 +671,17 @@ class Commitment(object):
             csvcheck = [1, script.OP_CHECKSEQUENCEVERIFY, script.OP_DROP]
         else:
             csvcheck = []
-        htlc_script = script.CScript(
-            [
+        template = script_template(
+            ("offered_htlc", self.option_anchor_outputs),
+            lambda: [
                 script.OP_DUP,
                 script.OP_HASH160,
-                Hash160(self.revocation_pubkey(side).format()),
+                SLOT,  # RIPEMD160(SHA256(revocationpubkey))
                 script.OP_EQUAL,
                 script.OP_IF,
                 script.OP_CHECKSIG,
                 script.OP_ELSE,
-                self.remote_htlc_pubkey(side).format(),
+                SLOT,  # remote_htlcpubkey
                 script.OP_SWAP,
                 script.OP_SIZE,
                 32,
@@ -430,18 +690,24 @@ class Commitment(object):
                 script.OP_DROP,
                 2,
                 script.OP_SWAP,
-                self.local_htlc_pubkey(side).format(),
+                SLOT,  # local_htlcpubkey
                 2,
                 script.OP_CHECKMULTISIG,
                 script.OP_ELSE,
                 script.OP_HASH160,
-                self.ripemd160(htlc.raw_payment_hash()),
+                SLOT,  # RIPEMD160(payment_hash)
                 script.OP_EQUALVERIFY,
                 script.OP_CHECKSIG,
                 script.OP_ENDIF,
             ]
             + csvcheck
-            + [script.OP_ENDIF]
+            + [script.OP_ENDIF],
+        )
+        htlc_script = template.fill(
+            self._revocation_hash(side),
+            self.remote_htlc_pubkey(side).format(),
+            self.local_htlc_pubkey(side).format(),
+            self.ripemd160(htlc.raw_payment_hash()),
         )
 
         # BOLT #3: The amounts for each output MUST be rounded down to whole
@@ -499,45 +765,63 @@ class Commitment(object):
         else:
             csvcheck = []
 
-        htlc_script = script.CScript(
-            [
+        template = script_template(
+            ("received_htlc", self.option_anchor_outputs),
+            lambda: [
                 script.OP_DUP,
                 script.OP_HASH160,
-                Hash160(self.revocation_pubkey(side).format()),
+                SLOT,  # RIPEMD160(SHA256(revocationpubkey))
                 script.OP_EQUAL,
                 script.OP_IF,
                 script.OP_CHECKSIG,
                 script.OP_ELSE,
-                self.remote_htlc_pubkey(side).format(),
+                SLOT,  # remote_htlcpubkey
                 script.OP_SWAP,
                 script.OP_SIZE,
                 32,
                 script.OP_EQUAL,
                 script.OP_IF,
                 script.OP_HASH160,
-                self.ripemd160(htlc.raw_payment_hash()),
+                SLOT,  # RIPEMD160(payment_hash)
                 script.OP_EQUALVERIFY,
                 2,
                 script.OP_SWAP,
-                self.local_htlc_pubkey(side).format(),
+                SLOT,  # local_htlcpubkey
                 2,
                 script.OP_CHECKMULTISIG,
                 script.OP_ELSE,
                 script.OP_DROP,
-                htlc.cltv_expiry,
+                SLOT,  # cltv_expiry
                 script.OP_CHECKLOCKTIMEVERIFY,
                 script.OP_DROP,
                 script.OP_CHECKSIG,
                 script.OP_ENDIF,
             ]
             + csvcheck
-            + [script.OP_ENDIF]
+            + [script.OP_ENDIF],
+        )
+        htlc_script = template.fill(
+            self._revocation_hash(side),
+            self.remote_htlc_pubkey(side).format(),
+            self.ripemd160(htlc.raw_payment_hash()),
+            self.local_htlc_pubkey(side).format(),
+            htlc.cltv_expiry,
         )
 
         # BOLT #3: The amounts for each output MUST be rounded down to whole
         # satoshis.
         return htlc_script, htlc.amount_msat // 1000
 
+    def _htlc_output(self, htlc: HTLC, side: Side) -> Tuple[script.CScript, int]:
+        """The redeemscript and amount of htlc's output in side's commitment"""
+        if htlc.owner == side:
+            build = self._offered_htlc_output
+        else:
+            build = self._received_htlc_output
+        return self._memoized(
+            ("htlc_output", id(htlc)), side, lambda: build(htlc, side)
+        )
+
     def _anchor_out(self, side: Side) -> CTxOut:
         # BOLT-a12da24dd0102c170365124782b46d9710950ac1 #3:
         # #### `to_local_anchor` and `to_remote_anchor` Output (option_anchor_outputs)
@@ -562,48 +846,19 @@ class Commitment(object):
         return CTxOut(330, CScript([script.OP_0, sha256(redeemscript).digest()]))
 
     def untrimmed_htlcs(self, side: Side) -> List[HTLC]:
-        htlcs = []
-        for _, htlc in self.htlcs.items():
-            # BOLT #3:
-            #   - for every offered HTLC:
-            #     - if the HTLC amount minus the HTLC-timeout fee would be less than
-            #     `dust_limit_satoshis` set by the transaction owner:
-            #       - MUST NOT contain that output.
-            #     - otherwise:
-            #       - MUST be generated as specified in
-            #       [Offered HTLC Outputs](#offered-htlc-outputs).
-            if htlc.owner == side:
-                # FIXME: Use Millisatoshi type?
-                if htlc.amount_msat - msat(
-                    htlc.htlc_timeout_fee(self.feerate, self.option_anchor_outputs)
-                ) < msat(self.dust_limit[side]):
-                    continue
-            else:
-                # BOLT #3:
-                #   - for every received HTLC:
-                #     - if the HTLC amount minus the HTLC-success fee would be less
-                #      than `dust_limit_satoshis` set by the transaction owner:
-                #       - MUST NOT contain that output.
-                #     - otherwise:
-                #       - MUST be generated as specified in
-                #       [Received HTLC Outputs](#received-htlc-outputs).
-                if htlc.amount_msat - msat(
-                    htlc.htlc_success_fee(self.feerate, self.option_anchor_outputs)
-                ) < msat(self.dust_limit[side]):
-                    continue
-            htlcs.append(htlc)
-
-        return htlcs
+        return self.htlcs.untrimmed_htlcs(self.feerate, side)
 
     def htlc_outputs(self, side: Side) -> List[Tuple[HTLC, int, bytes]]:
         """Give CTxOut, cltv_expiry, redeemscript for each non-trimmed HTLC"""
+        return list(
+            self._memoized("htlc_outputs", side, lambda: self._build_htlc_outputs(side))
+        )
+
+    def _build_htlc_outputs(self, side: Side) -> List[Tuple[HTLC, int, bytes]]:
         ret: List[Tuple[CTxOut, int, bytes]] = []
 
         for htlc in self.untrimmed_htlcs(side):
-            if htlc.owner == side:
-                redeemscript, sats = self._offered_htlc_output(htlc, side)
-            else:
-                redeemscript, sats = self._received_htlc_output(htlc, side)
+            redeemscript, sats = self._htlc_output(htlc, side)
             ret.append(
                 (
                     CTxOut(sats, CScript([script.OP_0, sha256(redeemscript).digest()])),
@@ -622,6 +877,16 @@ class Commitment(object):
         Returns it and a list of matching HTLCs for each output
 
         """
+
+        # A fresh copy every time, so callers can modify it.
+        tx, htlcs = self._compact_tx(side)
+        return tx.to_mutable(), list(htlcs)
+
+    def _compact_tx(self, side: Side) -> Tuple[CompactTx, List[Optional[HTLC]]]:
+        """The commitment transaction as we build it (see _unsigned_tx)"""
+        return self._memoized("compact_tx", side, lambda: self._build_compact_tx(side))
+
+    def _build_compact_tx(self, side: Side) -> Tuple[CompactTx, List[Optional[HTLC]]]:
         ocn = self.obscured_commit_num(
             self.keyset[self.opener].raw_payment_basepoint(),
             self.keyset[not self.opener].raw_payment_basepoint(),
@@ -636,32 +901,24 @@ class Commitment(object):
         #    * `txin[0]` sequence: upper 8 bits are 0x80, lower 24 bits are upper 24 bits of the obscured commitment number
         #    * `txin[0]` script bytes: 0
         #    * `txin[0]` witness: `0 <signature_for_pubkey1> <signature_for_pubkey2>`
-        txin = CTxIn(
-            COutPoint(bytes.fromhex(self.funding.txid), self.funding.output_index),
-            nSequence=0x80000000 | (ocn >> 24),
+        txin = (
+            bytes.fromhex(self.funding.txid),
+            self.funding.output_index,
+            0x80000000 | (ocn >> 24),
         )
 
         # txouts, with ctlv_timeouts (for htlc output tiebreak) and htlc
-        txouts: List[Tuple[CTxOut, int, Optional[HTLC]]] = []
+        txouts: List[Tuple[Tuple[int, bytes], int, Optional[HTLC]]] = []
 
         have_htlcs = False
         for htlc in self.untrimmed_htlcs(side):
-            if htlc.owner == side:
-                redeemscript, sats = self._offered_htlc_output(htlc, side)
-            else:
-                redeemscript, sats = self._received_htlc_output(htlc, side)
+            redeemscript, sats = self._htlc_output(htlc, side)
             print(
                 "*** Got htlc redeemscript {} / {}".format(
                     redeemscript, redeemscript.hex()
                 )
             )
-            txouts.append(
-                (
-                    CTxOut(sats, CScript([script.OP_0, sha256(redeemscript).digest()])),
-                    htlc.cltv_expiry,
-                    htlc,
-                )
-            )
+            txouts.append(((sats, p2wsh(redeemscript)), htlc.cltv_expiry, htlc))
             have_htlcs = True
 
         num_untrimmed_htlcs = len(txouts)
@@ -670,20 +927,12 @@ class Commitment(object):
         have_outputs = [False, False]
         out_redeemscript, sats = self._to_local_output(fee, side)
         if sats >= self.dust_limit[side]:
-            txouts.append(
-                (
-                    CTxOut(
-                        sats, CScript([script.OP_0, sha256(out_redeemscript).digest()])
-                    ),
-                    0,
-                    None,
-                )
-            )
+            txouts.append(((sats, p2wsh(out_redeemscript)), 0, None))
             have_outputs[side] = True
 
         cscript, sats = self._to_remote_output(fee, side)
         if sats >= self.dust_limit[side]:
-            txouts.append((CTxOut(sats, cscript), 0, None))
+            txouts.append(((sats, bytes(cscript)), 0, None))
             have_outputs[not side] = True
 
         # BOLT-a12da24dd0102c170365124782b46d9710950ac1 #3:
@@ -695,10 +944,12 @@ class Commitment(object):
         #   * if `to_remote` exists and/or there are HTLCs, add a
         #     `to_remote_anchor` output
         if self.option_anchor_outputs:
-            if have_htlcs or have_outputs[side]:
-                txouts.append((self._anchor_out(side), 0, None))
-            if have_htlcs or have_outputs[not side]:
-                txouts.append((self._anchor_out(not side), 0, None))  # type: ignore
+            for anchor_side in (side, not side):
+                if have_htlcs or have_outputs[anchor_side]:
+                    anchor = self._anchor_out(anchor_side)  # type: ignore
+                    txouts.append(
+                        ((anchor.nValue, bytes(anchor.scriptPubKey)), 0, None)
+                    )
 
         # BOLT #3:
         # ## Transaction Input and Output Ordering
@@ -711,8 +962,8 @@ class Commitment(object):
         # First sort by cltv_expiry
         txouts.sort(key=lambda txout: txout[1])
         # Now sort by BIP69: lexical key, then amount
-        txouts.sort(key=lambda txout: txout[0].scriptPubKey)
-        txouts.sort(key=lambda txout: txout[0].nValue)
+        txouts.sort(key=lambda txout: txout[0][1])
+        txouts.sort(key=lambda txout: txout[0][0])
 
         # BOLT #3:
         # ## Commitment Transaction
@@ -721,7 +972,7 @@ class Commitment(object):
         # * locktime: upper 8 bits are 0x20, lower 24 bits are the
         #   lower 24 bits of the obscured commitment number
         return (
-            CMutableTransaction(
+            CompactTx(
                 vin=[txin],
                 vout=[txout[0] for txout in txouts],
                 nVersion=2,
@@ -732,7 +983,7 @@ class Commitment(object):
 
     def htlc_tx(
         self,
-        commit_tx: CMutableTransaction,
+        commit_tx: Union[CMutableTransaction, CompactTx],
         outnum: int,
         side: Side,
         amount_sat: int,
@@ -781,23 +1032,9 @@ class Commitment(object):
         #     <local_delayedpubkey>
         # OP_ENDIF
         # OP_CHECKSIG
-        redeemscript = script.CScript(
-            [
-                script.OP_IF,
-                self.revocation_pubkey(side).format(),
-                script.OP_ELSE,
-                self.self_delay[side],
-                script.OP_CHECKSEQUENCEVERIFY,
-                script.OP_DROP,
-                self.delayed_pubkey(side).format(),
-                script.OP_ENDIF,
-                script.OP_CHECKSIG,
-            ]
-        )
+        redeemscript = self._to_self_script(side)
         print("htlc redeemscript = {}".format(redeemscript.hex()))
-        txout = CTxOut(
-            amount_sat, CScript([script.OP_0, sha256(redeemscript).digest()])
-        )
+        txout = CTxOut(amount_sat, CScript(p2wsh(redeemscript)))
 
         # BOLT #3:
         # ## HTLC-Timeout and HTLC-Success Transactions
@@ -814,16 +1051,14 @@ class Commitment(object):
     def remote_unsigned_tx(self) -> CMutableTransaction:
         return self._unsigned_tx(Side.remote)[0]
 
-    def _sig(self, privkey: coincurve.PrivateKey, tx: CMutableTransaction) -> Sig:
-        sighash = script.SignatureHash(
-            self.funding.redeemscript(),
-            tx,
-            inIdx=0,
-            hashtype=script.SIGHASH_ALL,
-            amount=self.funding.amount,
-            sigversion=script.SIGVERSION_WITNESS_V0,
+    def _funding_sighash(self, tx: CMutableTransaction) -> bytes:
+        return SighashCache(tx).sighash(
+            0, self.funding.redeemscript(), self.funding.amount, script.SIGHASH_ALL
         )
-        return Sig(privkey.secret.hex(), sighash.hex())
+
+    def _sig(self, privkey: coincurve.PrivateKey, tx: CMutableTransaction) -> Sig:
+        sighash = self._funding_sighash(tx)
+        return Sig(privkey, sighash)
 
     def local_sig(self, tx: CMutableTransaction) -> Sig:
         return self._sig(self.funding.bitcoin_privkeys[Side.local], tx)
@@ -845,35 +1080,49 @@ class Commitment(object):
         self, side: Side
     ) -> List[Tuple[CMutableTransaction, script.CScript, int]]:
         """Return unsigned HTLC txs (+ redeemscript, input sats) in output order"""
+        return [
+            (CMutableTransaction.from_tx(tx), redeemscript, sats)
+            for tx, redeemscript, sats in self._htlc_txs(side)
+        ]
+
+    def _htlc_txs(self, side: Side) -> List[Tuple[CTransaction, script.CScript, int]]:
+        """htlc_txs(), built once per version (and immutable, as it's shared)"""
+        return self._memoized("htlc_txs", side, lambda: self._build_htlc_txs(side))
+
+    def _build_htlc_txs(
+        self, side: Side
+    ) -> List[Tuple[CTransaction, script.CScript, int]]:
         # So we need the HTLCs in output order, which is why we had _unsigned_tx
         # return them.
-        commit_tx, htlcs = self._unsigned_tx(side)
+        commit_tx, htlcs = self._compact_tx(side)
 
-        ret: List[Tuple[CMutableTransaction, script.CScript, int]] = []
+        ret: List[Tuple[CTransaction, script.CScript, int]] = []
         for outnum, htlc in enumerate(htlcs):
             # to_local or to_remote output?
             if htlc is None:
                 continue
             if htlc.owner == side:
-                redeemscript, sats = self._offered_htlc_output(htlc, side)
+                redeemscript, sats = self._htlc_output(htlc, side)
                 fee = htlc.htlc_timeout_fee(self.feerate, self.option_anchor_outputs)
                 # BOLT #3:
                 # * locktime: `0` for HTLC-success, `cltv_expiry` for HTLC-timeout
                 locktime = htlc.cltv_expiry
             else:
-                redeemscript, sats = self._received_htlc_output(htlc, side)
+                redeemscript, sats = self._htlc_output(htlc, side)
                 fee = htlc.htlc_success_fee(self.feerate, self.option_anchor_outputs)
                 locktime = 0
 
             ret.append(
                 (
-                    self.htlc_tx(
-                        commit_tx,
-                        outnum,
-                        side,
-                        (htlc.amount_msat - msat(fee)) // 1000,
-                        locktime,
-                        self.option_anchor_outputs,
+                    CTransaction.from_tx(
+                        self.htlc_tx(
+                            commit_tx,
+                            outnum,
+                            side,
+                            (htlc.amount_msat - msat(fee)) // 1000,
+                            locktime,
+                            self.option_anchor_outputs,
+                        )
                     ),
                     redeemscript,
                     sats,
@@ -889,43 +1138,34 @@ class Commitment(object):
         #   corresponding to the ordering of the commitment transaction (see
         #   [BOLT
         #   #3](03-transactions.md#transaction-input-and-output-ordering)).
-        sigs: List[Sig] = []
-        for htlc_tx, redeemscript, sats in self.htlc_txs(side):
-            # BOLT-a12da24dd0102c170365124782b46d9710950ac1 #3:
-            # ## HTLC-Timeout and HTLC-Success Transactions
-            #
-            # if `option_anchor_outputs` applies to this commitment transaction,
-            # `SIGHASH_SINGLE|SIGHASH_ANYONECANPAY` is used.
-            if self.option_anchor_outputs:
-                hashtype = script.SIGHASH_SINGLE | script.SIGHASH_ANYONECANPAY
-            else:
-                hashtype = script.SIGHASH_ALL
-
-            sighash = script.SignatureHash(
-                redeemscript,
-                htlc_tx,
-                inIdx=0,
-                hashtype=hashtype,
-                amount=sats,
-                sigversion=script.SIGVERSION_WITNESS_V0,
-            )
-            privkey = self._basepoint_tweak(self.keyset[signer].htlc_base_secret, side)
-            sigs.append(Sig(privkey.secret.hex(), sighash.hex()))
+        privkey = self._basepoint_tweak(self.keyset[signer].htlc_base_secret, side)
+        return sign_all(privkey, self.htlc_sighashes(side))
+
+    def htlc_sighashes(self, side: Side) -> List[bytes]:
+        """The hashes to sign for side's HTLC transactions, in output order"""
+        # BOLT-a12da24dd0102c170365124782b46d9710950ac1 #3:
+        # ## HTLC-Timeout and HTLC-Success Transactions
+        #
+        # if `option_anchor_outputs` applies to this commitment transaction,
+        # `SIGHASH_SINGLE|SIGHASH_ANYONECANPAY` is used.
+        if self.option_anchor_outputs:
+            hashtype = script.SIGHASH_SINGLE | script.SIGHASH_ANYONECANPAY
+        else:
+            hashtype = script.SIGHASH_ALL
 
-        return sigs
+        return list(
+            self._memoized(
+                "htlc_sighashes",
+                side,
+                lambda: htlc_sighashes(self._htlc_txs(side), hashtype),
+            )
+        )
 
     def signed_tx(self, unsigned_tx: CMutableTransaction) -> CMutableTransaction:
         # BOLT #3:
         # * `txin[0]` witness: `0 <signature_for_pubkey1> <signature_for_pubkey2>`
-        tx = unsigned_tx.copy()
-        sighash = script.SignatureHash(
-            self.funding.redeemscript(),
-            tx,
-            inIdx=0,
-            hashtype=script.SIGHASH_ALL,
-            amount=self.funding.amount,
-            sigversion=script.SIGVERSION_WITNESS_V0,
-        )
+        tx = CMutableTransaction.from_tx(unsigned_tx)
+        sighash = self._funding_sighash(tx)
         sigs = [
             key.sign(sighash, hasher=None)
             for key in self.funding.funding_privkeys_for_tx()
@@ -1110,6 +1350,143 @@ def test_commitment_number() -> None:
     )
 
 
+def dummy_commitment(num_htlcs: int) -> Commitment:
+    c = Commitment(
+        funding=Funding(
+            funding_txid="00" * 32,
+            funding_output_index=0,
+            funding_amount=10000000,
+            local_node_privkey="01",
+            local_funding_privkey="02",
+            remote_node_privkey="03",
+            remote_funding_privkey="04",
+        ),
+        opener=Side.local,
+        local_keyset=KeySet("11", "12", "13", "14", "15" * 32),
+        remote_keyset=KeySet("21", "22", "23", "24", "25" * 32),
+        local_to_self_delay=144,
+        remote_to_self_delay=145,
+        local_amount=7000000000,
+        remote_amount=3000000000,
+        local_dust_limit=546,
+        remote_dust_limit=546,
+        feerate=253,
+        option_static_remotekey=False,
+        option_anchor_outputs=False,
+    )
+    for i in range(num_htlcs):
+        c.add_htlc(
+            HTLC(Side(i % 2), 1000000 + i, "{:064x}".format(i), 500, "00" * 1366),
+            i,
+        )
+    return c
+
+
+def test_derived_keys() -> None:
+    # Count the EC multiplications it takes to sign every HTLC tx.
+    orig_from_secret = coincurve.PublicKey.from_secret
+    calls = [0]
+
+    def from_secret(secret: bytes) -> coincurve.PublicKey:
+        calls[0] += 1
+        return orig_from_secret(secret)
+
+    ops = []
+    coincurve.PublicKey.from_secret = from_secret  # type: ignore
+    try:
+        for num_htlcs in (2, 30):
+            c = dummy_commitment(num_htlcs)
+            calls[0] = 0
+            assert len(c.htlc_sigs(Side.local, Side.remote)) == num_htlcs
+            ops.append(calls[0])
+    finally:
+        coincurve.PublicKey.from_secret = orig_from_secret  # type: ignore
+    assert ops[0] == ops[1]
+
+    keys = c.keys(Side.remote)
+    assert c.revocation_pubkey(Side.remote) is c.revocation_pubkey(Side.remote)
+    c.inc_commitnum()
+    assert c.keys(Side.remote) is not keys
+    assert c.revocation_pubkey(Side.remote) != keys.pubkey(keys.revocation_privkey())
+
+    # Replacing a keyset's secrets changes the keys derived from them.
+    from .utils import privkey_expand
+
+    keys = c.keys(Side.remote)
+    point = keys.per_commitment_point()
+    revocation = keys.revocation_privkey()
+    delayed = c.delayed_pubkey(Side.remote)
+    c.keyset[Side.remote].shachain_seed = bytes.fromhex("26" * 32)
+    assert keys.per_commitment_point() != point
+    assert keys.per_commitment_point() == c.keyset[Side.remote].raw_per_commit_point(
+        c.commitnum
+    )
+    assert keys.revocation_privkey() != revocation
+    assert c.delayed_pubkey(Side.remote) != delayed
+    revocation = keys.revocation_privkey()
+    c.keyset[Side.local].revocation_base_secret = privkey_expand("31")
+    assert keys.revocation_privkey() != revocation
+
+
+def test_memoized_txs() -> None:
+    c = dummy_commitment(10)
+    tx, _ = c._unsigned_tx(Side.local)
+    assert c._compact_tx(Side.local) is c._compact_tx(Side.local)
+    htlc_txs = c.htlc_txs(Side.local)
+    assert c._htlc_txs(Side.local) is c._htlc_txs(Side.local)
+    assert len(htlc_txs) == 10
+    assert c.remote_unsigned_tx().serialize() != tx.serialize()
+
+    # Callers get their own copies, which they can modify.
+    tx.vout.pop()
+    htlc_txs[0][0].nLockTime += 1
+    assert c.local_unsigned_tx().serialize() != tx.serialize()
+    assert c.htlc_txs(Side.local)[0][0].nLockTime + 1 == htlc_txs[0][0].nLockTime
+    tx = c.local_unsigned_tx()
+
+    # Assigning to amounts directly means we build them again too.
+    htlc_sighashes = c.htlc_sighashes(Side.local)
+    c.amounts[Side.local] -= 1000
+    assert c.local_unsigned_tx().vout != tx.vout
+    assert c.htlc_sighashes(Side.local) != htlc_sighashes
+    c.amounts[Side.local] += 1000
+    assert c.local_unsigned_tx().serialize() == tx.serialize()
+
+    # Anything which changes the tx means we build it again.
+    c.feerate += 1
+    tx2 = c.local_unsigned_tx()
+    assert tx2.vout != tx.vout
+    assert c.del_htlc(c.htlcs[0], xfer_funds=True)
+    assert len(c.htlc_txs(Side.local)) == 9
+    c.inc_commitnum()
+    assert c.local_unsigned_tx().nLockTime != tx2.nLockTime
+
+
+def test_htlc_table() -> None:
+    table = HTLCTable((546, 546), option_anchor_outputs=False)
+    # At 253 sat/kw, the HTLC-timeout fee is 167 and HTLC-success fee 177.
+    small = HTLC(Side.local, 720000, "00" * 32, 500, "00" * 1366)
+    big = HTLC(Side.remote, 720000, "01" * 32, 500, "00" * 1366)
+    dup = HTLC(Side.remote, 2000000, "01" * 32, 501, "00" * 1366)
+    assert table.add(0, small)
+    assert table.untrimmed_htlcs(253, Side.local) == [small]
+    assert table.untrimmed_htlcs(253, Side.remote) == []
+    assert table.add(1, big)
+    assert not table.add(1, dup)
+    assert table.add(2, dup)
+    assert table.untrimmed_htlcs(253, Side.local) == [small, dup]
+    assert table.untrimmed_htlcs(253, Side.remote) == [big, dup]
+    assert table.with_payment_hash(big.raw_payment_hash()) == [big, dup]
+
+    assert table.remove(big)
+    assert not table.remove(big)
+    assert table.untrimmed_htlcs(253, Side.remote) == [dup]
+    assert table.with_payment_hash(big.raw_payment_hash()) == [dup]
+    assert list(table) == [0, 2]
+    # A higher feerate trims more.
+    assert table.untrimmed_htlcs(1000, Side.local) == [dup]
+
+
 def revhex(h: str) -> str:
     return bytes(reversed(bytes.fromhex(h))).hex()
 
@@ -0,0 +1,173 @@
+#! /usr/bin/python3
+# Compact transactions and scripts, for building many commitment txs.
+import struct
+from hashlib import sha256
+
+import bitcoin.core.script as script
+from bitcoin.core import Hash, CMutableTransaction, COutPoint, CTxIn, CTxOut
+from bitcoin.core.script import CScript, CScriptOp
+from typing import Callable, Dict, Hashable, List, Optional, Tuple, Union
+
+# Marks where a ScriptTemplate takes a value.
+SLOT = None
+
+ScriptElem = Union[int, bytes, CScriptOp, None]
+
+
+def push(val: Union[int, bytes]) -> bytes:
+    """The script encoding of a pushed value"""
+    if isinstance(val, bytes):
+        return CScriptOp.encode_op_pushdata(val)
+    return bytes(CScript([val]))
+
+
+def p2wsh(redeemscript: bytes) -> bytes:
+    """The version-0 P2WSH scriptPubKey for redeemscript"""
+    return b"\x00\x20" + sha256(redeemscript).digest()
+
+
+class ScriptTemplate(object):
+    """A script with a few values (keys, hashes, delays) left as SLOTs.
+
+    Everything else is encoded once, when the template is made, so
+    filling it in is just joining bytes."""
+
+    __slots__ = ("parts",)
+
+    def __init__(self, elems: List[ScriptElem]):
+        self.parts: List[Optional[bytes]] = []
+        fixed: List[ScriptElem] = []
+        for e in elems + [SLOT]:
+            if e is SLOT:
+                if fixed:
+                    self.parts.append(bytes(CScript(fixed)))
+                    fixed = []
+                self.parts.append(None)
+            else:
+                fixed.append(e)
+        # Drop the SLOT we added at the end.
+        self.parts.pop()
+
+    def fill(self, *vals: Union[int, bytes]) -> CScript:
+        it = iter(vals)
+        ret = CScript(
+            b"".join(p if p is not None else push(next(it)) for p in self.parts)
+        )
+        assert next(it, None) is None, "Too many values for template"
+        return ret
+
+
+# Every template made by script_template(), by key.
+TEMPLATES: Dict[Hashable, ScriptTemplate] = {}
+
+
+def script_template(
+    key: Hashable, elems: Callable[[], List[ScriptElem]]
+) -> ScriptTemplate:
+    """The template for key, made from elems() the first time it's needed"""
+    template = TEMPLATES.get(key)
+    if template is None:
+        template = ScriptTemplate(elems())
+        TEMPLATES[key] = template
+    return template
+
+
+class CompactTx(object):
+    """A (non-witness) transaction, serialized once and only on demand.
+
+    vin is a list of (txid, outnum, nSequence), vout of (sats, scriptPubKey).
+    It must not be modified once serialize() or GetTxid() has been called;
+    use to_mutable() to get a CMutableTransaction for anything else.
+    """
+
+    __slots__ = ("nVersion", "nLockTime", "vin", "vout", "_raw", "_txid")
+
+    def __init__(
+        self,
+        vin: List[Tuple[bytes, int, int]],
+        vout: List[Tuple[int, bytes]],
+        nVersion: int = 2,
+        nLockTime: int = 0,
+    ):
+        self.nVersion = nVersion
+        self.nLockTime = nLockTime
+        self.vin = vin
+        self.vout = vout
+        self._raw: Optional[bytes] = None
+        self._txid: Optional[bytes] = None
+
+    @staticmethod
+    def _varint(n: int, buf: bytearray) -> None:
+        if n < 0xFD:
+            buf.append(n)
+        elif n <= 0xFFFF:
+            buf += b"\xfd" + struct.pack("<H", n)
+        else:
+            buf += b"\xfe" + struct.pack("<I", n)
+
+    def serialize(self) -> bytes:
+        if self._raw is None:
+            buf = bytearray(struct.pack("<i", self.nVersion))
+            self._varint(len(self.vin), buf)
+            for txid, outnum, sequence in self.vin:
+                buf += txid
+                # No scriptSig: we only spend segwit outputs.
+                buf += struct.pack("<IBI", outnum, 0, sequence)
+            self._varint(len(self.vout), buf)
+            for sats, spk in self.vout:
+                buf += struct.pack("<q", sats)
+                self._varint(len(spk), buf)
+                buf += spk
+            buf += struct.pack("<I", self.nLockTime)
+            self._raw = bytes(buf)
+        return self._raw
+
+    def GetTxid(self) -> bytes:
+        if self._txid is None:
+            self._txid = Hash(self.serialize())
+        return self._txid
+
+    def to_mutable(self) -> CMutableTransaction:
+        return CMutableTransaction(
+            vin=[
+                CTxIn(COutPoint(txid, outnum), nSequence=sequence)
+                for txid, outnum, sequence in self.vin
+            ],
+            vout=[CTxOut(sats, CScript(spk)) for sats, spk in self.vout],
+            nVersion=self.nVersion,
+            nLockTime=self.nLockTime,
+        )
+
+
+def test_compact_tx() -> None:
+    template = ScriptTemplate(
+        [script.OP_IF, SLOT, script.OP_ELSE, SLOT, script.OP_CHECKSEQUENCEVERIFY]
+        + [script.OP_DROP, SLOT, script.OP_ENDIF, script.OP_CHECKSIG]
+    )
+    key1, key2 = bytes([2]) * 33, bytes([3]) * 33
+    for delay in (6, 144, 2016, 70000):
+        assert template.fill(key1, delay, key2) == CScript(
+            [
+                script.OP_IF,
+                key1,
+                script.OP_ELSE,
+                delay,
+                script.OP_CHECKSEQUENCEVERIFY,
+                script.OP_DROP,
+                key2,
+                script.OP_ENDIF,
+                script.OP_CHECKSIG,
+            ]
+        )
+
+    tx = CompactTx(
+        vin=[(bytes(range(32)), 1, 0x80001234)],
+        vout=[(330, bytes(34)), (1000000, bytes(22)), (2000, bytes(300))],
+        nLockTime=0x20000000 | 42,
+    )
+    mutable = tx.to_mutable()
+    assert tx.serialize() == mutable.serialize()
+    assert tx.GetTxid() == mutable.GetTxid()
+    assert p2wsh(template.fill(key1, 6, key2)) == CScript(
+        [script.OP_0, sha256(template.fill(key1, 6, key2)).digest()]
+    )
@@ -1,7 +1,7 @@
 #! /usr/bin/python3
 # #### Dummy runner which you should replace with real one. ####
 import io
-from .runner import Runner, Conn
+from .runner import Runner, Conn, Checkpoint
 from .event import Event, ExpectMsg, MustNotMsg
 from typing import List, Optional
 from .keyset import KeySet
@@ -58,6 +58,17 @@ class DummyRunner(Runner):
             print("[RESTART]")
         self.blockheight = 102
 
+    def checkpoint(self, event: Event) -> Optional[Checkpoint]:
+        if self.config.getoption("verbose"):
+            print("[CHECKPOINT AT HEIGHT {}]".format(self.blockheight))
+        return Checkpoint(self, event, self.blockheight)
+
+    def restore(self, checkpoint: Checkpoint) -> None:
+        if self.config.getoption("verbose"):
+            print("[RESTORE TO HEIGHT {}]".format(checkpoint.node_state))
+        self.blockheight = checkpoint.node_state
+        super().restore(checkpoint)
+
     def connect(self, event: Event, connprivkey: str) -> None:
         if self.config.getoption("verbose"):
             print("[CONNECT {} {}]".format(event, connprivkey))
@@ -218,3 +229,47 @@ class DummyRunner(Runner):
 
     def teardown(self):
         pass
+
+
+def test_checkpoint_restore() -> None:
+    from .event import Block, Connect, Msg, RawMsg
+    from .structure import TryAll
+
+    class dummyconfig(object):
+        def getoption(self, name: str, default: Any = None) -> Any:
+            return name == "checkpoint"
+
+    class CountingRunner(DummyRunner):
+        def __init__(self, config: Any):
+            super().__init__(config)
+            self.restores: List[int] = []
+            self.restarts = 0
+            self.connects: List[str] = []
+
+        def restore(self, checkpoint: Checkpoint) -> None:
+            super().restore(checkpoint)
+            self.restores.append(self.blockheight)
+
+        def restart(self) -> None:
+            super().restart()
+            self.restarts += 1
+
+        def connect(self, event: Event, connprivkey: str) -> None:
+            super().connect(event, connprivkey)
+            self.connects.append(connprivkey)
+
+    runner = CountingRunner(dummyconfig())
+    runner.run(
+        [
+            Block(blockheight=102, number=6),
+            Connect(connprivkey="02"),
+            ExpectMsg("init"),
+            Msg("init", globalfeatures="", features=""),
+            TryAll([], RawMsg(bytes.fromhex("270F")), []),
+        ]
+    )
+    # The blocks were only added once; the connection is made every run.
+    assert runner.restores == [107, 107]
+    assert runner.restarts == 0
+    assert runner.connects == ["02"] * 3
+    runner.teardown()
@@ -1,21 +1,40 @@
 #! /usr/bin/python3
 import logging
-import traceback
 import collections
-import os.path
+import functools
+import os
+import sys
 import io
 import struct
+import threading
 import time
 import json
-import asyncio
 
-from typing import Optional, Dict, Union, Callable, Any, List, TYPE_CHECKING, overload
-
-from pyln.proto.message import Message
+from typing import (
+    Optional,
+    Dict,
+    Union,
+    Callable,
+    Any,
+    List,
+    FrozenSet,
+    Tuple,
+    TYPE_CHECKING,
+    overload,
+)
+
+from pyln.proto.message import Message, MessageType
+from pyln.proto.message.fundamental_types import (
+    FieldType,
+    IntegerType,
+    FundamentalHexType,
+)
+from pyln.proto.message.array_types import SizedArrayType
 
 from .errors import SpecFileError, EventError
 from .namespace import namespace
-from .signature import Sig
+from .signature import Sig, SigType
+from .msglog import MessageLog
 from .bitfield import has_bit
 from .utils import check_hex
 
@@ -33,22 +52,58 @@ ResolvableBool = Union[int, Callable[["Runner", "Event", str], bool]]
 Resolvable = Union[Any, Callable[["Runner", "Event", str], Any]]
 
 
+# Where each Event was created is only used to name it in logs and
+# errors; set LNPROTOTEST_EVENT_LOCATIONS=0 (or call
+# record_event_locations(False)) to skip it, e.g. for benchmarks.
+_record_locations = os.getenv("LNPROTOTEST_EVENT_LOCATIONS", "1") != "0"
+
+
+# Events are shared by runners running TryAll branches at once (see
+# run_branches()), so anything they compute lazily is set under this.
+_lazy_lock = threading.Lock()
+
+
+def record_event_locations(enable: bool) -> None:
+    """Turn recording where each Event is created on or off"""
+    global _record_locations
+    _record_locations = enable
+
+
 class Event(object):
     """Abstract base class for events."""
 
     def __init__(self) -> None:
-        # From help(traceback.extract_stack):
-        #   Each item in the list is a quadruple (filename,
-        #   line number, function name, text), and the entries are in order
-        #   from oldest to newest stack frame.
-        self.name = self.__class__.__name__
-        for s in reversed(traceback.extract_stack()):
-            # Ignore constructor calls, like this one.
-            if s[2] != "__init__":
-                self.name = "{}:{}:{}".format(
-                    type(self).__name__, os.path.basename(s[0]), s[1]
-                )
-                break
+        self._name: Optional[str] = None
+        self._location: Optional[Tuple[str, int]] = None
+        if _record_locations:
+            # Ignore constructor calls, like this one.  Unlike
+            # traceback.extract_stack() this doesn't look up any source.
+            frame = sys._getframe(1)
+            while frame is not None and frame.f_code.co_name == "__init__":
+                frame = frame.f_back  # type: ignore
+            if frame is not None:
+                self._location = (frame.f_code.co_filename, frame.f_lineno)
+
+    @property
+    def name(self) -> str:
+        """Type and where it was created, e.g. Msg:test_foo.py:123"""
+        name = getattr(self, "_name", None)
+        if name is None:
+            with _lazy_lock:
+                name = getattr(self, "_name", None)
+                if name is None:
+                    name = type(self).__name__
+                    location = getattr(self, "_location", None)
+                    if location is not None:
+                        name = "{}:{}:{}".format(
+                            name, os.path.basename(location[0]), location[1]
+                        )
+                    self._name = name
+        return name
+
+    @name.setter
+    def name(self, name: str) -> None:
+        self._name = name
 
     def enabled(self, runner: "Runner") -> bool:
         """Returns whether it should be enabled for this run.  Usually True"""
@@ -57,8 +112,8 @@ class Event(object):
     def action(self, runner: "Runner") -> bool:
         """Execute this event, return True if we're done with this sequence"""
         # Broadcast event through WebSocket if enabled
-        if hasattr(runner, 'broadcast_event'):
-            asyncio.run(runner.broadcast_event(self, "out", {}))
+        if getattr(runner, "websocket_server", None) is not None:
+            runner.broadcast_event(self, "out", {})
         return True
 
     def resolve_arg(self, fieldname: str, runner: "Runner", arg: Resolvable) -> Any:
@@ -82,7 +137,7 @@ class Event(object):
         event = self.name
         file_name = ""
         pos = ""
-        if len(toks) > 0:
+        if len(toks) == 3:
             event = toks[0]
             file_name = toks[1]
             pos = toks[2]
@@ -201,8 +256,8 @@ class Msg(PerConnEvent):
         runner.recv(self, self.find_conn(runner), binmsg.getvalue())
         msg_to_stash(runner, self, message)
         # Broadcast message through WebSocket if enabled
-        if hasattr(runner, 'broadcast_event'):
-            asyncio.run(runner.broadcast_event(self, "out", self.kwargs))
+        if getattr(runner, "websocket_server", None) is not None:
+            runner.broadcast_event(self, "out", self.kwargs)
         return True
 
 
@@ -332,12 +387,41 @@ class ExpectMsg(PerConnEvent):
         if ignore is None:
             ignore = self.ignore_gossip_queries
         self.ignore = ignore
+        self.matcher: Optional[MessageMatcher] = None
 
-    def message_match(self, runner: "Runner", msg: Message) -> Optional[str]:
-        """Does this message match what we expect?"""
-        partmessage = Message(self.msgtype, **self.resolve_args(runner, self.kwargs))
+    def prefilter(self, binmsg: bytes) -> Optional[List[bytes]]:
+        """What ignore() would do, judging by the message type alone.
 
-        ret = cmp_msg(msg, partmessage)
+        For the standard ignore functions, ignored messages (and pings)
+        needn't be decoded at all: this returns the raw replies to send.
+        Otherwise it returns None, and the message has to be decoded."""
+        ignored = IGNORED_TYPES.get(self.ignore)
+        if ignored is None or len(binmsg) < 4:
+            return None
+        msgtype, num_pong_bytes = struct.unpack(">HH", binmsg[:4])
+        if msgtype in ignored:
+            return []
+        if msgtype == PING_TYPE:
+            # BOLT #1:
+            #  - otherwise (`num_pong_bytes` is **not** less than 65532):
+            #    - MUST ignore the `ping`.
+            if num_pong_bytes >= 65532:
+                return []
+            return [pong_for(num_pong_bytes)]
+        return None
+
+    def message_match(
+        self, runner: "Runner", msg: Message, binmsg: Optional[bytes] = None
+    ) -> Optional[str]:
+        """Does this message match what we expect?"""
+        matcher = self.matcher
+        if matcher is None:
+            with _lazy_lock:
+                if self.matcher is None:
+                    self.matcher = MessageMatcher(self.msgtype, self.kwargs)
+                matcher = self.matcher
+
+        ret = matcher.match(self, runner, msg, binmsg)
         if ret is None:
             self.if_match(self, msg, runner)
             msg_to_stash(runner, self, msg)
@@ -358,7 +442,14 @@ class ExpectMsg(PerConnEvent):
                     raise EventError(
                         self, "Got msg banned by {}: {}".format(e, binmsg.hex())
                     )
-            logging.debug(f"raw msg {''.join('%02x' % b for b in binmsg)}")
+            # Drop (or answer) anything we're ignoring without decoding it.
+            replies = self.prefilter(binmsg)
+            if replies is not None:
+                for reply in replies:
+                    runner.recv(self, conn, reply)
+                continue
+            if logging.getLogger().isEnabledFor(logging.DEBUG):
+                logging.debug(f"raw msg {binmsg.hex()}")
             # Might be completely unknown to namespace.
             try:
                 msg = Message.read(namespace(), io.BytesIO(binmsg))
@@ -367,7 +458,8 @@ class ExpectMsg(PerConnEvent):
                 raise EventError(
                     self, "Runner gave bad msg {}: {}".format(binmsg.hex(), ve)
                 )
-            logging.debug(f"decoded msg {msg.to_str()}")
+            if logging.getLogger().isEnabledFor(logging.DEBUG):
+                logging.debug(f"decoded msg {msg.to_str()}")
             # Ignore function may tell us to respond.
             response = self.ignore(msg)
             if response is not None:
@@ -377,17 +469,48 @@ class ExpectMsg(PerConnEvent):
                     runner.recv(self, conn, binm.getvalue())
                 continue
 
-            err = self.message_match(runner, msg)
+            err = self.message_match(runner, msg, binmsg)
             if err:
                 raise EventError(self, "{}: message was {}".format(err, msg.to_str()))
 
             break
         # Broadcast expect message through WebSocket if enabled
-        if hasattr(runner, 'broadcast_event'):
-            asyncio.run(runner.broadcast_event(self, "in", {"msgtype": self.msgtype}))
+        if getattr(runner, "websocket_server", None) is not None:
+            runner.broadcast_event(self, "in", {"msgtype": self.msgtype})
         return True
 
 
+PING_TYPE = namespace().get_msgtype("ping").number
+
+# The message types each standard ignore function ignores (they all
+# answer pings, too), so ExpectMsg.prefilter() can skip decoding them.
+IGNORED_TYPES: Dict[Callable[[Message], Optional[List[Message]]], FrozenSet[int]] = {
+    ExpectMsg.ignore_pings: frozenset(),
+    ExpectMsg.ignore_gossip_queries: frozenset(
+        namespace().get_msgtype(name).number
+        for name in (
+            "gossip_timestamp_filter",
+            "query_channel_range",
+            "query_short_channel_ids",
+        )
+    ),
+    ExpectMsg.ignore_all_gossip: frozenset(range(256, 512)),
+    ExpectMsg.ignore_channel_update: frozenset([258]),
+}
+
+
+@functools.lru_cache(maxsize=64)
+def pong_for(num_pong_bytes: int) -> bytes:
+    """The (serialized) pong answering a ping, as ignore_pings() makes it"""
+    ping = Message(
+        namespace().get_msgtype("ping"), num_pong_bytes=num_pong_bytes, ignored=""
+    )
+    (pong,) = ExpectMsg.ignore_pings(ping) or []
+    buf = io.BytesIO()
+    pong.write(buf)
+    return buf.getvalue()
+
+
 class Block(Event):
     """Generate a block, at blockheight, with optional txs."""
 
@@ -405,29 +528,28 @@ class Block(Event):
     def action(self, runner: "Runner") -> bool:
         super().action(runner)
 
-        if isinstance(self.blockheight, Callable):
-            self.blockheight = self.resolve_arg(None, runner, self.blockheight)
+        # Resolved for this run only: other runs (or branches) may differ.
+        blockheight = self.resolve_arg(None, runner, self.blockheight)
 
         # Oops, did they ask us to produce a block with no predecessor?
-        if runner.getblockheight() + 1 < self.blockheight:
+        if runner.getblockheight() + 1 < blockheight:
             raise SpecFileError(
                 self,
                 "Cannot generate block #{} at height {}".format(
-                    self.blockheight, runner.getblockheight()
+                    blockheight, runner.getblockheight()
                 ),
             )
         # Throw away blocks we're replacing.
-        if runner.getblockheight() >= self.blockheight:
-            runner.trim_blocks(self.blockheight - 1)
+        if runner.getblockheight() >= blockheight:
+            runner.trim_blocks(blockheight - 1)
 
-        if isinstance(self.number, Callable):
-            self.number = self.resolve_arg(None, runner, self.number)
+        number = self.resolve_arg(None, runner, self.number)
 
         # Add new one
         runner.add_blocks(
-            self, [self.resolve_arg("tx", runner, tx) for tx in self.txs], self.number
+            self, [self.resolve_arg("tx", runner, tx) for tx in self.txs], number
         )
-        assert runner.getblockheight() == self.blockheight - 1 + self.number
+        assert runner.getblockheight() == blockheight - 1 + number
         return True
 
 
@@ -635,9 +757,13 @@ def msg_to_stash(runner: "Runner", event: Event, msg: Message) -> None:
     """ExpectMsg and Msg save every field to the stash, in order"""
     fields = msg.to_py()
 
-    stash = runner.get_stash(event, type(event).__name__, [])
+    stashname = type(event).__name__
+    if stashname in runner.stash:
+        stash = runner.get_stash(event, stashname)
+    else:
+        stash = MessageLog(runner.config.getoption("stash_retention", 0) or None)
+        runner.add_stash(stashname, stash)
     stash.append((msg.messagetype.name, fields))
-    runner.add_stash(type(event).__name__, stash)
 
 
 def cmp_obj(obj: Any, expected: Any, prefix: str) -> Optional[str]:
@@ -658,6 +784,9 @@ def cmp_obj(obj: Any, expected: Any, prefix: str) -> Optional[str]:
                 len(expected), len(obj), prefix, expected, obj
             )
         for i in range(len(expected)):
+            # Only build the prefix if we have to (these can be huge arrays)
+            if obj[i] == expected[i]:
+                continue
             diff = cmp_obj(obj[i], expected[i], "{}[{}]".format(prefix, i))
             if diff:
                 return diff
@@ -683,6 +812,116 @@ def cmp_msg(msg: Message, expected: Message) -> Optional[str]:
     return cmp_obj(obj, expected_obj, expected.messagetype.name)
 
 
+def fixed_size(fieldtype: FieldType) -> Optional[int]:
+    """Length of this field on the wire, if it's always the same"""
+    if isinstance(fieldtype, (IntegerType, FundamentalHexType)):
+        return fieldtype.bytelen
+    if isinstance(fieldtype, SigType):
+        return 64
+    if isinstance(fieldtype, SizedArrayType):
+        elemsize = fixed_size(fieldtype.elemtype)
+        if elemsize is not None:
+            return fieldtype.arraysize * elemsize
+    return None
+
+
+def match_val(val: Any, expected: Any) -> bool:
+    """Quick version of cmp_obj() on decoded values: True means it matches.
+
+    False means use cmp_obj() to decide (and explain)."""
+    if isinstance(expected, dict):
+        if not isinstance(val, dict):
+            return False
+        for k, v in expected.items():
+            if k not in val or not match_val(val[k], v):
+                return False
+        return True
+    if isinstance(expected, list) and expected and isinstance(expected[0], Sig):
+        # e.g. htlc_signature: compare the whole array in one pass.
+        return isinstance(val, list) and Sig.first_mismatch(val, expected) is None
+    return bool(val == expected)
+
+
+class MessageMatcher(object):
+    """ExpectMsg's fields, compiled once, to check each message against.
+
+    Constant fields are converted once; those at a fixed offset (except
+    signatures, which may be a privkey/hash pair) are compared with the
+    raw message bytes.  The rest are compared with the decoded fields,
+    and only fields which differ are converted with to_py() for cmp_obj()
+    to explain, so large messages never need converting as a whole.
+    """
+
+    def __init__(self, msgtype: MessageType, kwargs: Dict[str, Any]):
+        self.msgtype = msgtype
+        self.order = list(kwargs.keys())
+        self.resolvable = {k: v for k, v in kwargs.items() if callable(v)}
+        # This converts strings, and checks the fields are valid.
+        self.constant = Message(
+            msgtype, **{k: v for k, v in kwargs.items() if not callable(v)}
+        ).fields
+
+        # (fieldname, offset, bytes) for constant fields we can check raw.
+        self.raw: List[Tuple[str, int, bytes]] = []
+        offset = 2
+        for f in msgtype.fields:
+            size = fixed_size(f.fieldtype)
+            if size is None:
+                break
+            if (
+                f.name in self.constant
+                and f.option is None
+                and not isinstance(f.fieldtype, SigType)
+            ):
+                buf = io.BytesIO()
+                f.fieldtype.write(buf, self.constant[f.name], self.constant)
+                self.raw.append((f.name, offset, buf.getvalue()))
+            offset += size
+
+    def match(
+        self,
+        event: Event,
+        runner: "Runner",
+        msg: Message,
+        binmsg: Optional[bytes] = None,
+    ) -> Optional[str]:
+        """Return None if msg matches, otherwise a complaint"""
+        if msg.messagetype != self.msgtype:
+            return "Expected {}, got {}".format(self.msgtype, msg.messagetype)
+
+        matched = set()
+        if binmsg is not None:
+            for name, offset, raw in self.raw:
+                if binmsg[offset : offset + len(raw)] == raw:
+                    matched.add(name)
+
+        expected = dict(self.constant)
+        if self.resolvable:
+            expected.update(
+                Message(
+                    self.msgtype, **event.resolve_args(runner, self.resolvable)
+                ).fields
+            )
+
+        for name in self.order:
+            if name in matched:
+                continue
+            if name not in msg.fields:
+                return "Missing field {}.{}".format(self.msgtype.name, name)
+            if match_val(msg.fields[name], expected[name]):
+                continue
+            field = self.msgtype.find_field(name)
+            assert field
+            diff = cmp_obj(
+                field.fieldtype.val_to_py(msg.fields[name], msg.fields),
+                field.fieldtype.val_to_py(expected[name], expected),
+                "{}.{}".format(self.msgtype.name, name),
+            )
+            if diff:
+                return diff
+        return None
+
+
 @overload
 def msat(sats: int) -> int: ...
 
@@ -734,3 +973,102 @@ def negotiated(
         return True
 
     return _negotiated
+
+
+def test_event_name() -> None:
+    e = Event()
+    assert e.name.startswith("Event:event.py:")
+    assert e.to_json()["file"] == "event.py"
+
+    record_event_locations(False)
+    try:
+        e = Event()
+    finally:
+        record_event_locations(True)
+    assert e.name == "Event"
+    assert e.to_json() == {"event": "Event", "file": "", "pos": ""}
+
+
+def test_message_matcher() -> None:
+    from .dummyrunner import DummyRunner
+
+    class dummyconfig(object):
+        def getoption(self, name: str, default: Any = None) -> Any:
+            return False
+
+    runner = DummyRunner(dummyconfig())
+    msg = Message(
+        namespace().get_msgtype("reply_channel_range"),
+        chain_hash="06226e46111a0b59caaf126043eb5bbf28c34f3a5e332a1fc7b2b73cf188910f",
+        first_blocknum=103,
+        number_of_blocks=1,
+        sync_complete=1,
+        encoded_short_ids="00" + "0000670000010000" * 1000,
+    )
+    buf = io.BytesIO()
+    msg.write(buf)
+    binmsg = buf.getvalue()
+
+    good = ExpectMsg(
+        "reply_channel_range",
+        first_blocknum=103,
+        number_of_blocks=lambda runner, event, field: 1,
+        encoded_short_ids="00" + "0000670000010000" * 1000,
+    )
+    assert good.message_match(runner, msg, binmsg) is None
+    bad = ExpectMsg(
+        "reply_channel_range",
+        first_blocknum=104,
+        encoded_short_ids="00" + "0000670000010000" * 1000,
+    )
+    complaint = "reply_channel_range.first_blocknum: 103 != 104"
+    assert bad.message_match(runner, msg, binmsg) == complaint
+    assert bad.message_match(runner, msg) == complaint
+    runner.teardown()
+
+
+def test_prefilter() -> None:
+    def serialize(msgtype: str, **kwargs: Any) -> bytes:
+        buf = io.BytesIO()
+        Message(namespace().get_msgtype(msgtype), **kwargs).write(buf)
+        return buf.getvalue()
+
+    query = serialize(
+        "query_channel_range",
+        chain_hash="00" * 32,
+        first_blocknum=0,
+        number_of_blocks=1,
+    )
+    update = bytes([1, 2]) + bytes(200)
+    ping = serialize("ping", num_pong_bytes=3, ignored="")
+
+    expect = ExpectMsg("init")
+    assert expect.prefilter(query) == []
+    assert expect.prefilter(update) is None
+    assert expect.prefilter(ping) == [serialize("pong", ignored="000000")]
+    assert expect.prefilter(serialize("ping", num_pong_bytes=65532, ignored="")) == []
+    assert expect.prefilter(serialize("init", globalfeatures="", features="")) is None
+
+    expect = ExpectMsg("init", ignore=ExpectMsg.ignore_all_gossip)
+    assert expect.prefilter(update) == [] and expect.prefilter(query) == []
+    # We don't know what other functions will ignore.
+    expect = ExpectMsg("init", ignore=lambda msg: [])
+    assert expect.prefilter(update) is None and expect.prefilter(ping) is None
+
+
+def test_block_resolves_per_run() -> None:
+    from .dummyrunner import DummyRunner
+
+    class dummyconfig(object):
+        def getoption(self, name: str, default: Any = None) -> Any:
+            return False
+
+    runner = DummyRunner(dummyconfig())
+    runner.start()
+    # Mine on top of whatever height this run is at.
+    block = Block(blockheight=lambda runner, event, field: runner.blockheight + 1)
+    block.action(runner)
+    block.action(runner)
+    assert runner.getblockheight() == 104
+    assert callable(block.blockheight)
+    runner.teardown()
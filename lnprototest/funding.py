@@ -14,6 +14,7 @@ from .event import Event, ResolvableInt, ResolvableStr
 from .namespace import namespace
 from .runner import Runner
 from .signature import Sig
+from .sighash import SighashCache
 
 import bitcoin.core.script as script
 from bitcoin.core import (
@@ -38,6 +39,46 @@ def txid_raw(tx: str) -> str:
     return CTransaction.deserialize(bytes.fromhex(tx)).GetTxid().hex()
 
 
+class FundingKeys(object):
+    """The public keys and scripts which a Funding's private keys imply.
+
+    Funding makes these once, and again only if its private keys change."""
+
+    def __init__(
+        self,
+        bitcoin_privkeys: List[coincurve.PrivateKey],
+        node_privkeys: List[coincurve.PrivateKey],
+    ):
+        self.secrets = FundingKeys.secrets_of(bitcoin_privkeys, node_privkeys)
+        self.funding_pubkeys = [
+            coincurve.PublicKey.from_secret(k.secret) for k in bitcoin_privkeys
+        ]
+        self.node_ids = [
+            coincurve.PublicKey.from_secret(k.secret) for k in node_privkeys
+        ]
+        self.tx_order: Tuple[Side, Side] = Funding.sort_by_keys(
+            self.funding_pubkeys[Side.local],
+            self.funding_pubkeys[Side.remote],
+            Side.local,
+            Side.remote,
+        )
+        self.gossip_order: Tuple[Side, Side] = Funding.sort_by_keys(
+            self.node_ids[Side.local],
+            self.node_ids[Side.remote],
+            Side.local,
+            Side.remote,
+        )
+        self.redeemscript = Funding.redeemscript_keys(*self.funding_pubkeys)
+        self.locking_script = CScript([script.OP_0, sha256(self.redeemscript).digest()])
+
+    @staticmethod
+    def secrets_of(
+        bitcoin_privkeys: List[coincurve.PrivateKey],
+        node_privkeys: List[coincurve.PrivateKey],
+    ) -> Tuple[bytes, ...]:
+        return tuple(k.secret for k in bitcoin_privkeys + node_privkeys)
+
+
 class Funding(object):
     def __init__(
         self,
@@ -63,11 +104,19 @@ class Funding(object):
             privkey_expand(local_node_privkey),
             privkey_expand(remote_node_privkey),
         ]
+        self._keys: Optional[FundingKeys] = None
         self.tx = None
         self.locktime = locktime
         self.outputs: List[Dict[str, Any]] = []
         self.inputs: List[Dict[str, Any]] = []
 
+    def keys(self) -> FundingKeys:
+        """Our public keys and scripts, derived once from our private keys"""
+        secrets = FundingKeys.secrets_of(self.bitcoin_privkeys, self.node_privkeys)
+        if self._keys is None or self._keys.secrets != secrets:
+            self._keys = FundingKeys(self.bitcoin_privkeys, self.node_privkeys)
+        return self._keys
+
     def tx_hex(self) -> str:
         if not self.tx:
             return ""
@@ -101,9 +150,9 @@ class Funding(object):
         #   nodes operating the channel, such that `node_id_1` is the
         #   lexicographically-lesser of the two compressed keys sorted in
         #   ascending lexicographic order.
-        return self.sort_by_keys(
-            self.node_id(Side.local), self.node_id(Side.remote), local, remote
-        )
+        if self.keys().gossip_order[0] == Side.local:
+            return local, remote
+        return remote, local
 
     @staticmethod
     def redeemscript_keys(
@@ -119,8 +168,7 @@ class Funding(object):
         )
 
     def redeemscript(self) -> CScript:
-        key_a, key_b = self.funding_pubkeys_for_tx()
-        return self.redeemscript_keys(key_a, key_b)
+        return self.keys().redeemscript
 
     @staticmethod
     def locking_script_keys(
@@ -131,8 +179,7 @@ class Funding(object):
         )
 
     def locking_script(self) -> CScript:
-        a, b = self.funding_pubkeys_for_tx()
-        return self.locking_script_keys(a, b)
+        return self.keys().locking_script
 
     @staticmethod
     def start(
@@ -212,6 +259,7 @@ class Funding(object):
 
     def sign_our_inputs(self) -> None:
         assert self.tx is not None
+        sighashes = SighashCache(self.tx)
         for idx, _in in enumerate(self.inputs):
             privkey = _in["privkey"]
 
@@ -235,13 +283,8 @@ class Funding(object):
                     )
                     redeemscript = address.to_redeemScript()
 
-                sighash = script.SignatureHash(
-                    redeemscript,
-                    self.tx,
-                    idx,
-                    script.SIGHASH_ALL,
-                    amount=_in["sats"],
-                    sigversion=script.SIGVERSION_WITNESS_V0,
+                sighash = sighashes.sighash(
+                    idx, redeemscript, _in["sats"], script.SIGHASH_ALL
                 )
                 sig = inkey.sign(sighash, hasher=None) + bytes([script.SIGHASH_ALL])
 
@@ -350,13 +393,8 @@ class Funding(object):
             CScript([script.OP_0, Hash160(inkey_pub.format())])
         )
 
-        sighash = script.SignatureHash(
-            address.to_redeemScript(),
-            tx,
-            0,
-            script.SIGHASH_ALL,
-            amount=sats,
-            sigversion=script.SIGVERSION_WITNESS_V0,
+        sighash = SighashCache(tx).sighash(
+            0, address.to_redeemScript(), sats, script.SIGHASH_ALL
         )
         sig = inkey.sign(sighash, hasher=None) + bytes([script.SIGHASH_ALL])
 
@@ -378,7 +416,7 @@ class Funding(object):
         return coincurve.PublicKey.from_secret(privkey.secret)
 
     def funding_pubkey(self, side: Side) -> coincurve.PublicKey:
-        return self.funding_pubkey_key(self.bitcoin_privkeys[side])
+        return self.keys().funding_pubkeys[side]
 
     def funding_pubkeys_for_tx(self) -> Tuple[coincurve.PublicKey, coincurve.PublicKey]:
         """Returns funding pubkeys, in tx order"""
@@ -390,26 +428,19 @@ class Funding(object):
         # * Where `pubkey1` is the lexicographically lesser of the two
         #   `funding_pubkey` in compressed format, and where `pubkey2` is the
         #   lexicographically greater of the two.
-        return self.sort_by_keys(
-            self.funding_pubkey(Side.local),
-            self.funding_pubkey(Side.remote),
-            self.funding_pubkey(Side.local),
-            self.funding_pubkey(Side.remote),
-        )
+        keys = self.keys()
+        first, second = keys.tx_order
+        return keys.funding_pubkeys[first], keys.funding_pubkeys[second]
 
     def funding_privkeys_for_tx(
         self,
     ) -> Tuple[coincurve.PrivateKey, coincurve.PrivateKey]:
         """Returns funding private keys, in tx order"""
-        return self.sort_by_keys(
-            self.funding_pubkey(Side.local),
-            self.funding_pubkey(Side.remote),
-            self.bitcoin_privkeys[Side.local],
-            self.bitcoin_privkeys[Side.remote],
-        )
+        first, second = self.keys().tx_order
+        return self.bitcoin_privkeys[first], self.bitcoin_privkeys[second]
 
     def node_id(self, side: Side) -> coincurve.PublicKey:
-        return coincurve.PublicKey.from_secret(self.node_privkeys[side].secret)
+        return self.keys().node_ids[side]
 
     def node_ids(self) -> Tuple[coincurve.PublicKey, coincurve.PublicKey]:
         """Returns node pubkeys, in order"""
@@ -476,19 +507,15 @@ class Funding(object):
         #   signatures of the hash `h` (using `node_id_1` and `node_id_2`'s
         #   respective secrets).
         node_privkeys = self.node_id_privkeys()
-        ann.set_field("node_signature_1", Sig(node_privkeys[0].secret.hex(), h.hex()))
-        ann.set_field("node_signature_2", Sig(node_privkeys[1].secret.hex(), h.hex()))
+        ann.set_field("node_signature_1", Sig(node_privkeys[0], h))
+        ann.set_field("node_signature_2", Sig(node_privkeys[1], h))
 
         bitcoin_privkeys = self.funding_privkeys_for_gossip()
         # - MUST set `bitcoin_signature_1` and `bitcoin_signature_2` to valid
         #   signatures of the hash `h` (using `bitcoin_key_1` and
         #   `bitcoin_key_2`'s respective secrets).
-        ann.set_field(
-            "bitcoin_signature_1", Sig(bitcoin_privkeys[0].secret.hex(), h.hex())
-        )
-        ann.set_field(
-            "bitcoin_signature_2", Sig(bitcoin_privkeys[1].secret.hex(), h.hex())
-        )
+        ann.set_field("bitcoin_signature_1", Sig(bitcoin_privkeys[0], h))
+        ann.set_field("bitcoin_signature_2", Sig(bitcoin_privkeys[1], h))
 
         return ann
 
@@ -562,9 +589,7 @@ class Funding(object):
         # Note the first two 'type' bytes!
         h = sha256(sha256(buf.getvalue()[2 + 64 :]).digest()).digest()
 
-        update.set_field(
-            "signature", Sig(self.node_privkeys[side].secret.hex(), h.hex())
-        )
+        update.set_field("signature", Sig(self.node_privkeys[side], h))
 
         return update
 
@@ -597,7 +622,7 @@ class Funding(object):
         # Note the first two 'type' bytes!
         h = sha256(sha256(buf.getvalue()[2 + 64 :]).digest()).digest()
 
-        ann.set_field("signature", Sig(self.node_privkeys[side].secret.hex(), h.hex()))
+        ann.set_field("signature", Sig(self.node_privkeys[side], h))
         return ann
 
     def close_tx(self, fee: int, privkey_dest: str) -> str:
@@ -619,13 +644,8 @@ class Funding(object):
         )
 
         tx = CMutableTransaction(vin=[txin], vout=[txout])
-        sighash = script.SignatureHash(
-            self.redeemscript(),
-            tx,
-            inIdx=0,
-            hashtype=script.SIGHASH_ALL,
-            amount=self.amount,
-            sigversion=script.SIGVERSION_WITNESS_V0,
+        sighash = SighashCache(tx).sighash(
+            0, self.redeemscript(), self.amount, script.SIGHASH_ALL
         )
 
         sigs = [
@@ -894,3 +914,33 @@ class AddWitnesses(Event):
         tx_hex = funding.add_witnesses(wit_stack)
         runner.add_stash("FundingTx", tx_hex)
         return True
+
+
+def test_funding_keys() -> None:
+    def pubkeys_in_tx_order(funding: Funding) -> List[bytes]:
+        return sorted(
+            coincurve.PublicKey.from_secret(k.secret).format()
+            for k in funding.bitcoin_privkeys
+        )
+
+    funding = Funding("00" * 32, 0, 10000000, "01", "02", "03", "04")
+    keys = funding.keys()
+    assert funding.redeemscript() is keys.redeemscript
+    pubkeys = funding.funding_pubkeys_for_tx()
+    old_order = pubkeys_in_tx_order(funding)
+    assert [k.format() for k in pubkeys] == old_order
+    # Both come from the cached keys, not derived again.
+    assert all(a is b for a, b in zip(funding.funding_pubkeys_for_tx(), pubkeys))
+    assert funding.locking_script() == CScript(
+        [script.OP_0, sha256(funding.redeemscript()).digest()]
+    )
+
+    # Changing a private key means the keys are derived again.
+    funding.bitcoin_privkeys[Side.local] = privkey_expand("05")
+    assert funding.keys() is not keys
+    new_order = [k.format() for k in funding.funding_pubkeys_for_tx()]
+    assert new_order != old_order
+    assert new_order == pubkeys_in_tx_order(funding)
+    assert funding.funding_pubkey(Side.local) == coincurve.PublicKey.from_secret(
+        privkey_expand("05").secret
+    )
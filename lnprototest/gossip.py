@@ -0,0 +1,309 @@
+#! /usr/bin/python3
+# Synthetic gossip for large network graphs, for gossip scaling tests.
+import os
+import io
+import random
+import struct
+from hashlib import sha256
+from pyln.proto.message import Message
+
+from .event import RawMsg
+from .funding import Funding
+from .namespace import namespace
+from .signature import SIGN_PROCESSES, process_pool
+from .utils import Side, cache_dir
+from .utils.bitcoin_utils import BitcoinUtils
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+# Bump this if the messages for the same parameters change.
+GOSSIP_CACHE_VERSION = 1
+
+# Each cached message is prefixed by its length, as a big-endian u16.
+_LEN = struct.Struct(">H")
+
+
+def write_gossip_file(f: Any, msgs: Iterator[bytes]) -> Iterator[bytes]:
+    """Write msgs to f as they go past"""
+    for m in msgs:
+        f.write(_LEN.pack(len(m)))
+        f.write(m)
+        yield m
+
+
+def read_gossip_file(path: str) -> Iterator[bytes]:
+    """The messages written to path by write_gossip_file()"""
+    with open(path, "rb") as f:
+        while True:
+            hdr = f.read(_LEN.size)
+            if not hdr:
+                return
+            (msglen,) = _LEN.unpack(hdr)
+            msg = f.read(msglen)
+            if len(msg) != msglen:
+                raise ValueError("{}: truncated gossip file".format(path))
+            yield msg
+
+
+class GossipGraph(object):
+    """A deterministic, synthetic network graph, and all its gossip.
+
+    The same parameters always give the same nodes, channels and (signed)
+    messages: the first channels join every node into a tree, and the
+    rest join random pairs of nodes.  Each channel has a Funding (whose
+    txid is made up, so a node must not check the funding tx), and
+    short_channel_ids count up from first_block.
+    """
+
+    def __init__(
+        self,
+        num_nodes: int,
+        num_channels: int,
+        seed: str = "lnprototest",
+        first_block: int = 103,
+        channels_per_block: int = 1000,
+        capacity_sats: int = 1000000,
+        timestamp: int = 1700000000,
+        chain_hash: str = BitcoinUtils.blockchain_hash(),
+    ):
+        if num_nodes < 2:
+            raise ValueError("A graph needs at least 2 nodes")
+        self.num_nodes = num_nodes
+        self.num_channels = num_channels
+        self.seed = seed
+        self.first_block = first_block
+        self.channels_per_block = channels_per_block
+        self.capacity_sats = capacity_sats
+        self.timestamp = timestamp
+        self.chain_hash = chain_hash
+
+        # The (node, node) of each channel.
+        rng = random.Random(seed)
+        self.channels: List[Tuple[int, int]] = []
+        for n in range(1, min(num_nodes, num_channels + 1)):
+            self.channels.append((rng.randrange(n), n))
+        while len(self.channels) < num_channels:
+            a, b = rng.sample(range(num_nodes), 2)
+            self.channels.append((a, b))
+
+    def params(self) -> Tuple[Any, ...]:
+        """Everything which decides what the messages are"""
+        return (
+            GOSSIP_CACHE_VERSION,
+            self.num_nodes,
+            self.num_channels,
+            self.seed,
+            self.first_block,
+            self.channels_per_block,
+            self.capacity_sats,
+            self.timestamp,
+            self.chain_hash,
+        )
+
+    def _secret(self, kind: str, index: int) -> str:
+        return sha256("{}/{}/{}".format(self.seed, kind, index).encode()).hexdigest()
+
+    def node_privkey(self, node: int) -> str:
+        return self._secret("node", node)
+
+    def short_channel_id(self, chan: int) -> str:
+        return "{}x{}x0".format(
+            self.first_block + chan // self.channels_per_block,
+            chan % self.channels_per_block + 1,
+        )
+
+    def funding(self, chan: int) -> Funding:
+        """The Funding for channel chan: its first node is local"""
+        local, remote = self.channels[chan]
+        return Funding(
+            funding_txid=self._secret("txid", chan),
+            funding_output_index=0,
+            funding_amount=self.capacity_sats,
+            local_node_privkey=self.node_privkey(local),
+            local_funding_privkey=self._secret("funding", chan * 2),
+            remote_node_privkey=self.node_privkey(remote),
+            remote_funding_privkey=self._secret("funding", chan * 2 + 1),
+            chain_hash=self.chain_hash,
+        )
+
+    def channel_messages(self, chan: int) -> List[Message]:
+        """The channel_announcement for chan, and a channel_update each way"""
+        funding = self.funding(chan)
+        scid = self.short_channel_id(chan)
+        msgs = [funding.channel_announcement(scid, "")]
+        for side in (Side.local, Side.remote):
+            msgs.append(
+                funding.channel_update(
+                    short_channel_id=scid,
+                    side=side,
+                    disable=False,
+                    cltv_expiry_delta=144,
+                    htlc_minimum_msat=0,
+                    fee_base_msat=1000,
+                    fee_proportional_millionths=10,
+                    timestamp=self.timestamp,
+                    htlc_maximum_msat=self.capacity_sats * 1000,
+                )
+            )
+        return msgs
+
+    def node_message(self, node: int) -> Message:
+        """The node_announcement for node"""
+        # Any Funding with this node as local will do.
+        funding = Funding(
+            "",
+            0,
+            0,
+            self.node_privkey(node),
+            "01",
+            self.node_privkey((node + 1) % self.num_nodes),
+            "02",
+            chain_hash=self.chain_hash,
+        )
+        color = sha256(self.node_privkey(node).encode()).digest()
+        return funding.node_announcement(
+            side=Side.local,
+            features="",
+            rgb_color=(color[0], color[1], color[2]),
+            alias="node{}".format(node),
+            addresses=b"",
+            timestamp=self.timestamp,
+        )
+
+    def _serialize(self, kind: str, indices: List[int]) -> List[bytes]:
+        ret = []
+        for i in indices:
+            if kind == "channel":
+                msgs = self.channel_messages(i)
+            else:
+                msgs = [self.node_message(i)]
+            for msg in msgs:
+                buf = io.BytesIO()
+                msg.write(buf)
+                ret.append(buf.getvalue())
+        return ret
+
+    def _generate(self, processes: int) -> Iterator[List[bytes]]:
+        # BOLT #7:
+        # - if `node_id` is NOT previously known from a `channel_announcement`
+        #   message, OR if `timestamp` is NOT greater than the last-received
+        #   `node_announcement` from this `node_id`:
+        #   - SHOULD ignore the message.
+        # So nodes with no channels get no node_announcement, and they
+        # all come after the channels.
+        nodes = sorted(set(n for chan in self.channels for n in chan))
+        work = [("channel", list(range(self.num_channels))), ("node", nodes)]
+        for kind, indices in work:
+            # Small chunks, so messages can stream out while we sign.
+            chunk = max(1, min(256, -(-len(indices) // (max(processes, 1) * 4))))
+            chunks = [indices[i : i + chunk] for i in range(0, len(indices), chunk)]
+            if processes <= 1:
+                for c in chunks:
+                    yield self._serialize(kind, c)
+            else:
+                # Workers get our params, not the graph: see _serialize_chunk().
+                params = self.params()
+                yield from process_pool(processes).map(
+                    _serialize_chunk,
+                    [params] * len(chunks),
+                    [kind] * len(chunks),
+                    chunks,
+                )
+
+    def cache_path(self, directory: Optional[str] = None) -> str:
+        if directory is None:
+            directory = cache_dir("gossip")
+        key = sha256(repr(self.params()).encode()).hexdigest()[:32]
+        return os.path.join(directory, "gossip-{}.bin".format(key))
+
+    def messages(
+        self,
+        processes: Optional[int] = None,
+        cache: bool = True,
+        directory: Optional[str] = None,
+    ) -> Iterator[bytes]:
+        """Every serialized message, announcements first, as they're made.
+
+        The first time, messages are signed by a pool of processes
+        (SIGN_PROCESSES by default) and saved in the cache directory as
+        they go; after that they're simply read back.
+        """
+        if processes is None:
+            processes = SIGN_PROCESSES
+        msgs = (m for msgs in self._generate(processes) for m in msgs)
+        if not cache:
+            yield from msgs
+            return
+
+        path = self.cache_path(directory)
+        if os.path.exists(path):
+            yield from read_gossip_file(path)
+            return
+
+        # Only a complete file goes into the cache.
+        tmppath = "{}.{}.tmp".format(path, os.getpid())
+        try:
+            with open(tmppath, "wb") as f:
+                yield from write_gossip_file(f, msgs)
+            os.replace(tmppath, path)
+        finally:
+            if os.path.exists(tmppath):
+                os.unlink(tmppath)
+
+    def raw_msgs(
+        self, connprivkey: Optional[str] = None, **kwargs: Any
+    ) -> List[RawMsg]:
+        """A RawMsg event to feed each message to the runner"""
+        return [RawMsg(m, connprivkey) for m in self.messages(**kwargs)]
+
+
+# The graph each pool worker last rebuilt, by its params().
+_worker_graph: Dict[Tuple[Any, ...], GossipGraph] = {}
+
+
+def _serialize_chunk(
+    params: Tuple[Any, ...], kind: str, indices: List[int]
+) -> List[bytes]:
+    """GossipGraph._serialize(), in a pool worker.
+
+    Pickling the graph for every chunk would cost as much as the graph;
+    instead each worker rebuilds it from params the first time."""
+    graph = _worker_graph.get(params)
+    if graph is None:
+        # Everything after GOSSIP_CACHE_VERSION is a constructor arg.
+        graph = GossipGraph(*params[1:])
+        _worker_graph.clear()
+        _worker_graph[params] = graph
+    return graph._serialize(kind, indices)
+
+
+def test_gossip_graph() -> None:
+    import coincurve
+    import tempfile
+
+    graph = GossipGraph(num_nodes=5, num_channels=8, channels_per_block=3)
+    assert len(set(frozenset(c) for c in graph.channels[:4])) == 4
+    assert graph.short_channel_id(4) == "104x2x0"
+
+    with tempfile.TemporaryDirectory() as directory:
+        msgs = list(graph.messages(processes=0, directory=directory))
+        assert os.path.exists(graph.cache_path(directory))
+        assert list(graph.messages(processes=0, directory=directory)) == msgs
+    assert list(graph.messages(processes=2, cache=False)) == msgs
+    assert _serialize_chunk(graph.params(), "channel", [3]) == msgs[9:12]
+    assert len(msgs) == 8 * 3 + 5
+
+    decoded = [Message.read(namespace(), io.BytesIO(m)) for m in msgs]
+    assert [m.messagetype.name for m in decoded[:3]] == [
+        "channel_announcement",
+        "channel_update",
+        "channel_update",
+    ]
+    assert decoded[-1].messagetype.name == "node_announcement"
+
+    # The update from node_id_1 is signed by node_id_1.
+    i = 1 if decoded[1].fields["channel_flags"] & 1 == 0 else 2
+    sig = decoded[i].fields["signature"]
+    h = sha256(sha256(msgs[i][2 + 64 :]).digest()).digest()
+    assert coincurve.PublicKey(decoded[0].fields["node_id_1"]).verify(
+        sig.to_der(sig.sigval), h, hasher=None
+    )
@@ -0,0 +1,470 @@
+#! /usr/bin/python3
+# Bulk encoding and decoding of the arrays in gossip query messages.
+import io
+import struct
+import zlib
+import crc32c
+from pyln.proto.message import Message
+from typing import (
+    Any,
+    Callable,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    Optional,
+    Tuple,
+    Union,
+    TYPE_CHECKING,
+)
+
+from .errors import EventError
+from .event import Event, ExpectMsg, ResolvableInt
+
+if TYPE_CHECKING:
+    # Otherwise a circular dependency
+    from .runner import Runner
+
+# BOLT #7:
+# Encoding types:
+# * `0`: uncompressed array of `short_channel_id` types, in ascending
+#   order.
+# * `1`: array of `short_channel_id` types, in ascending order, compressed
+#   with zlib deflate<sup>[1](#reference-1)</sup>
+ENCODING_UNCOMPRESSED = 0
+ENCODING_ZLIB = 1
+
+# How much compressed data to inflate at once.
+INFLATE_CHUNK = 65536
+
+_SCID = struct.Struct(">Q")
+# BOLT #7:
+# 1. subtype: `channel_update_timestamps`
+# 2. data:
+#     * [`u32`:`timestamp_node_id_1`]
+#     * [`u32`:`timestamp_node_id_2`]
+# (and `channel_update_checksums` is the same, with checksums)
+_PAIR = struct.Struct(">II")
+
+ShortChannelId = Union[str, int]
+
+
+def scid_to_int(scid: ShortChannelId) -> int:
+    """The u64 value of a blockxtxnumxoutnum short_channel_id"""
+    if isinstance(scid, int):
+        return scid
+    block, txnum, outnum = (int(v) for v in scid.split("x"))
+    return (block << 40) | (txnum << 16) | outnum
+
+
+def scid_to_str(scid: int) -> str:
+    return "{}x{}x{}".format(scid >> 40, (scid >> 16) & 0xFFFFFF, scid & 0xFFFF)
+
+
+def _chunks(encoding_type: int, data: bytes) -> Iterator[bytes]:
+    if encoding_type == ENCODING_UNCOMPRESSED:
+        yield data
+    elif encoding_type == ENCODING_ZLIB:
+        inflater = zlib.decompressobj()
+        view = memoryview(data)
+        for off in range(0, len(data), INFLATE_CHUNK):
+            yield inflater.decompress(view[off : off + INFLATE_CHUNK])
+        yield inflater.flush()
+        if not inflater.eof:
+            raise ValueError("Truncated zlib data")
+    else:
+        raise ValueError("Unknown encoding type {}".format(encoding_type))
+
+
+def _unpack(fmt: struct.Struct, encoding_type: int, data: bytes) -> Iterator[tuple]:
+    """Every fmt in data, inflating it as we go if it's compressed"""
+    partial = b""
+    for chunk in _chunks(encoding_type, data):
+        if partial:
+            chunk = partial + chunk
+        end = len(chunk) - len(chunk) % fmt.size
+        yield from fmt.iter_unpack(memoryview(chunk)[:end])
+        partial = chunk[end:]
+    if partial:
+        raise ValueError("{} trailing bytes".format(len(partial)))
+
+
+def _encode(encoding_type: int, raw: bytes) -> bytes:
+    if encoding_type == ENCODING_UNCOMPRESSED:
+        return raw
+    elif encoding_type == ENCODING_ZLIB:
+        return zlib.compress(raw)
+    raise ValueError("Unknown encoding type {}".format(encoding_type))
+
+
+def decode_scid_ints(encoded: bytes) -> List[int]:
+    """The u64 short_channel_ids in an encoded_short_ids field"""
+    return [s for (s,) in _unpack(_SCID, encoded[0], encoded[1:])]
+
+
+def decode_scids(encoded: bytes) -> List[str]:
+    """The short_channel_ids in an encoded_short_ids field"""
+    return [scid_to_str(s) for s in decode_scid_ints(encoded)]
+
+
+def encode_scids(
+    scids: Iterable[ShortChannelId], encoding_type: int = ENCODING_UNCOMPRESSED
+) -> bytes:
+    """An encoded_short_ids field (encoding type first) for these scids"""
+    vals = [scid_to_int(s) for s in scids]
+    raw = struct.pack(">{}Q".format(len(vals)), *vals)
+    return bytes([encoding_type]) + _encode(encoding_type, raw)
+
+
+def decode_timestamps(encoding_type: int, encoded: bytes) -> List[Tuple[int, int]]:
+    """The (timestamp_node_id_1, timestamp_node_id_2) pairs in a timestamps_tlv"""
+    return list(_unpack(_PAIR, encoding_type, encoded))
+
+
+def encode_timestamps(
+    timestamps: Iterable[Tuple[int, int]], encoding_type: int = ENCODING_UNCOMPRESSED
+) -> bytes:
+    """The encoded_timestamps for these (node_id_1, node_id_2) timestamp pairs"""
+    # BOLT #7:
+    # Where:
+    # * `timestamp_node_id_1` is the timestamp of the `channel_update` for
+    #   `node_id_1`, or 0 if there was no `channel_update` from that node.
+    # * `timestamp_node_id_2` is the timestamp of the `channel_update` for
+    #    `node_id_2`, or 0 if there was no `channel_update` from that node.
+    return _encode(encoding_type, b"".join(_PAIR.pack(*t) for t in timestamps))
+
+
+def decode_checksums(encoded: bytes) -> List[Tuple[int, int]]:
+    """The (checksum_node_id_1, checksum_node_id_2) pairs in a checksums_tlv"""
+    return list(_unpack(_PAIR, ENCODING_UNCOMPRESSED, encoded))
+
+
+def encode_checksums(checksums: Iterable[Tuple[int, int]]) -> bytes:
+    return b"".join(_PAIR.pack(*c) for c in checksums)
+
+
+def update_checksum(update: Union[bytes, Message, None]) -> int:
+    """The checksum of a (serialized) channel_update, or 0 for None"""
+    # BOLT #7: The checksum of a `channel_update` is the CRC32C checksum as
+    # specified in [RFC3720](https://tools.ietf.org/html/rfc3720#appendix-B.4)
+    # of this `channel_update` without its `signature` and `timestamp` fields.
+    if update is None:
+        return 0
+    if isinstance(update, Message):
+        buf = io.BytesIO()
+        update.write(buf)
+        update = buf.getvalue()
+
+    # BOLT #7:
+    # 1. type: 258 (`channel_update`)
+    # 2. data:
+    #     * [`signature`:`signature`]
+    #     * [`chain_hash`:`chain_hash`]
+    #     * [`short_channel_id`:`short_channel_id`]
+    #     * [`u32`:`timestamp`]
+    #     * [`byte`:`message_flags`]
+    # Note: 2 bytes for `type` field
+    view = memoryview(update)
+    csum = crc32c.crc32c(view[2 + 64 : 2 + 64 + 32 + 8])
+    return crc32c.crc32c(view[2 + 64 + 32 + 8 + 4 :], csum)
+
+
+def update_checksums(
+    updates: Iterable[Tuple[Union[bytes, Message, None], Union[bytes, Message, None]]],
+) -> List[Tuple[int, int]]:
+    """The checksum pairs for (node_id_1, node_id_2) channel_update pairs"""
+    return [(update_checksum(u1), update_checksum(u2)) for u1, u2 in updates]
+
+
+class ChannelRange(object):
+    """Everything in the reply_channel_range parts answering one query.
+
+    add_part() checks each part follows on from the ones before."""
+
+    def __init__(self, first_blocknum: int, number_of_blocks: int):
+        self.first_blocknum = first_blocknum
+        self.number_of_blocks = number_of_blocks
+        # (first_blocknum, number_of_blocks) of each part.
+        self.parts: List[Tuple[int, int]] = []
+        self.scids: List[int] = []
+        # These are None unless the parts have them.
+        self.timestamps: Optional[List[Tuple[int, int]]] = None
+        self.checksums: Optional[List[Tuple[int, int]]] = None
+        self.complete = False
+
+    def add_part(self, fields: Dict[str, Any]) -> Optional[str]:
+        """Add a reply_channel_range's fields, or say what's wrong with it"""
+        if self.complete:
+            return "reply_channel_range after the final one"
+        first = fields["first_blocknum"]
+        end = first + fields["number_of_blocks"]
+        # BOLT #7:
+        # - the first `reply_channel_range` message:
+        #   - MUST set `first_blocknum` less than or equal to the
+        #     `first_blocknum` in `query_channel_range`
+        #   - MUST set `first_blocknum` plus `number_of_blocks` greater than
+        #     the `first_blocknum` in `query_channel_range`.
+        # - successive `reply_channel_range` message:
+        #   - MUST have `first_blocknum` equal or greater than the previous
+        #     `first_blocknum`.
+        if not self.parts:
+            if first > self.first_blocknum or end <= self.first_blocknum:
+                return "first reply {}+{} does not include block {}".format(
+                    first, end - first, self.first_blocknum
+                )
+        elif first < self.parts[-1][0]:
+            return "reply {}+{} starts before previous reply {}+{}".format(
+                first, end - first, *self.parts[-1]
+            )
+
+        try:
+            scids = decode_scid_ints(bytes(fields["encoded_short_ids"]))
+        except ValueError as ve:
+            return "bad encoded_short_ids: {}".format(ve)
+        last = self.scids[-1] if self.scids else -1
+        for scid in scids:
+            if scid <= last:
+                return "{} not in ascending order".format(scid_to_str(scid))
+            if not first <= scid >> 40 < end:
+                return "{} outside reply {}+{}".format(
+                    scid_to_str(scid), first, end - first
+                )
+            last = scid
+
+        tlvs = fields.get("tlvs", {})
+        timestamps = None
+        if "timestamps_tlv" in tlvs:
+            tlv = tlvs["timestamps_tlv"]
+            try:
+                timestamps = decode_timestamps(
+                    tlv["encoding_type"], bytes(tlv["encoded_timestamps"])
+                )
+            except ValueError as ve:
+                return "bad encoded_timestamps: {}".format(ve)
+        checksums = None
+        if "checksums_tlv" in tlvs:
+            checksums = [
+                (c["checksum_node_id_1"], c["checksum_node_id_2"])
+                for c in tlvs["checksums_tlv"]["checksums"]
+            ]
+        for name, vals, sofar in (
+            ("timestamps", timestamps, self.timestamps),
+            ("checksums", checksums, self.checksums),
+        ):
+            if vals is not None and len(vals) != len(scids):
+                return "{} {} for {} scids".format(len(vals), name, len(scids))
+            if self.parts and (vals is None) != (sofar is None):
+                return "{} in some replies but not others".format(name)
+
+        # BOLT #7:
+        # - MUST set `sync_complete` to `false` if this is not the final
+        #   `reply_channel_range`.
+        # - the final `reply_channel_range` message:
+        #   - MUST have `first_blocknum` plus `number_of_blocks` equal or
+        #     greater than the `query_channel_range` `first_blocknum` plus
+        #     `number_of_blocks`.
+        #   - MUST set `sync_complete` to `true`.
+        final = end >= self.first_blocknum + self.number_of_blocks
+        if final and not fields["sync_complete"]:
+            return "final reply {}+{} without sync_complete".format(first, end - first)
+        if not final and fields["sync_complete"]:
+            return "sync_complete on reply {}+{} before the end".format(
+                first, end - first
+            )
+
+        self.parts.append((first, end - first))
+        self.scids += scids
+        if timestamps is not None:
+            self.timestamps = self.timestamps or []
+            self.timestamps += timestamps
+        if checksums is not None:
+            self.checksums = self.checksums or []
+            self.checksums += checksums
+        self.complete = final
+        return None
+
+
+class ExpectReplyChannelRange(ExpectMsg):
+    """Wait for all the reply_channel_range parts answering a query_channel_range.
+
+    Each part is decoded and checked as it arrives, and the whole
+    ChannelRange is stashed as "channel_range", for CheckEq with
+    channel_range_scids() etc.
+    """
+
+    def __init__(
+        self,
+        first_blocknum: ResolvableInt,
+        number_of_blocks: ResolvableInt,
+        ignore: Optional[Callable[[Message], Optional[List[Message]]]] = None,
+        connprivkey: Optional[str] = None,
+    ):
+        super().__init__(
+            "reply_channel_range",
+            if_match=ExpectReplyChannelRange._add_part,
+            ignore=ignore,
+            connprivkey=connprivkey,
+        )
+        self.first_blocknum = first_blocknum
+        self.number_of_blocks = number_of_blocks
+
+    def _add_part(self, msg: Message, runner: "Runner") -> None:
+        channel_range = runner.get_stash(self, "channel_range")
+        # Dummy runner sends dummy (single) replies.
+        if runner._is_dummy():
+            channel_range.complete = True
+            return
+        err = channel_range.add_part(msg.fields)
+        if err is not None:
+            raise EventError(self, "{}: {}".format(err, msg.to_str()))
+
+    def action(self, runner: "Runner") -> bool:
+        channel_range = ChannelRange(
+            self.resolve_arg("first_blocknum", runner, self.first_blocknum),
+            self.resolve_arg("number_of_blocks", runner, self.number_of_blocks),
+        )
+        runner.add_stash("channel_range", channel_range)
+        while not channel_range.complete:
+            super().action(runner)
+        return True
+
+
+def channel_range_scids() -> Callable[["Runner", Event, str], str]:
+    """The scids from the last ExpectReplyChannelRange, like "103x1x0,109x1x0" """
+
+    def _channel_range_scids(runner: "Runner", event: Event, field: str) -> str:
+        channel_range = runner.get_stash(event, "channel_range")
+        return ",".join(scid_to_str(s) for s in channel_range.scids)
+
+    return _channel_range_scids
+
+
+def channel_range_timestamps() -> (
+    Callable[["Runner", Event, str], Optional[List[Tuple[int, int]]]]
+):
+    """The timestamps from the last ExpectReplyChannelRange (None if none)"""
+
+    def _channel_range_timestamps(
+        runner: "Runner", event: Event, field: str
+    ) -> Optional[List[Tuple[int, int]]]:
+        return runner.get_stash(event, "channel_range").timestamps
+
+    return _channel_range_timestamps
+
+
+def channel_range_checksums() -> (
+    Callable[["Runner", Event, str], Optional[List[Tuple[int, int]]]]
+):
+    """The checksums from the last ExpectReplyChannelRange (None if none)"""
+
+    def _channel_range_checksums(
+        runner: "Runner", event: Event, field: str
+    ) -> Optional[List[Tuple[int, int]]]:
+        return runner.get_stash(event, "channel_range").checksums
+
+    return _channel_range_checksums
+
+
+def test_gossip_query() -> None:
+    from .funding import Funding
+    from .namespace import namespace
+
+    assert scid_to_int("103x1x0") == (103 << 40) | (1 << 16)
+    assert scid_to_str(scid_to_int("700000x1234x2")) == "700000x1234x2"
+
+    scids = ["{}x{}x{}".format(103 + i // 100, i % 100 + 1, i % 3) for i in range(1000)]
+    scidtype = namespace().get_fundamentaltype("short_channel_id")
+    for encoding_type in (ENCODING_UNCOMPRESSED, ENCODING_ZLIB):
+        encoded = encode_scids(scids, encoding_type)
+        assert encoded[0] == encoding_type
+        assert decode_scids(encoded) == scids
+
+    # The same as writing each one, and reading back.
+    buf = io.BytesIO()
+    for s in scids[:3]:
+        scidtype.write(buf, scidtype.val_from_str(s)[0], {})
+    assert encode_scids(scids[:3]) == bytes(1) + buf.getvalue()
+
+    # Streaming decompression has to stitch together values across chunks.
+    stamps = [(i, 2**32 - 1 - i) for i in range(INFLATE_CHUNK // 4)]
+    assert decode_timestamps(1, encode_timestamps(stamps, 1)) == stamps
+    assert decode_checksums(encode_checksums(stamps)) == stamps
+    try:
+        decode_scids(bytes([2]))
+        assert False
+    except ValueError:
+        pass
+    try:
+        decode_scids(bytes(1) + bytes(7))
+        assert False
+    except ValueError:
+        pass
+
+    funding = Funding("00" * 32, 0, 100000, "02", "10", "03", "20")
+    update = funding.channel_update("103x1x0", 0, False, 144, 0, 1000, 10, 1, 2000000)
+    buf = io.BytesIO()
+    update.write(buf)
+    binupdate = buf.getvalue()
+    assert update_checksum(update) == update_checksum(binupdate)
+    assert update_checksum(binupdate) == crc32c.crc32c(
+        binupdate[2 + 64 : 2 + 64 + 32 + 8] + binupdate[2 + 64 + 32 + 8 + 4 :]
+    )
+    assert update_checksums([(update, None)]) == [(update_checksum(update), 0)]
+
+
+def test_channel_range() -> None:
+    def part(
+        first: int, num: int, scids: List[str], sync_complete: int = 0, **tlvs: Any
+    ) -> Dict[str, Any]:
+        return {
+            "first_blocknum": first,
+            "number_of_blocks": num,
+            "sync_complete": sync_complete,
+            "encoded_short_ids": list(encode_scids(scids, ENCODING_ZLIB)),
+            "tlvs": tlvs,
+        }
+
+    def stamps(*vals: Tuple[int, int]) -> Dict[str, Any]:
+        return {"encoding_type": 0, "encoded_timestamps": list(encode_timestamps(vals))}
+
+    cr = ChannelRange(100, 20)
+    assert cr.add_part(part(90, 15, ["103x1x0"], timestamps_tlv=stamps((1, 2)))) is None
+    assert not cr.complete
+    assert (
+        cr.add_part(
+            part(
+                105,
+                15,
+                ["105x1x0", "119x2x1"],
+                1,
+                timestamps_tlv=stamps((3, 4), (5, 6)),
+            )
+        )
+        is None
+    )
+    assert cr.complete
+    assert [scid_to_str(s) for s in cr.scids] == ["103x1x0", "105x1x0", "119x2x1"]
+    assert cr.timestamps == [(1, 2), (3, 4), (5, 6)]
+    assert cr.checksums is None
+    assert cr.add_part(part(120, 1, [], 1)) is not None
+
+    # Doesn't cover the start, scid outside its range, or out of order.
+    assert ChannelRange(100, 20).add_part(part(101, 19, [], 1)) is not None
+    assert ChannelRange(100, 20).add_part(part(100, 20, ["99x1x0"], 1)) is not None
+    assert (
+        ChannelRange(100, 20).add_part(part(100, 20, ["103x2x0", "103x1x0"], 1))
+        is not None
+    )
+    # Goes backwards, or overlaps an earlier scid.
+    cr = ChannelRange(100, 20)
+    assert cr.add_part(part(100, 10, ["105x1x0"])) is None
+    assert cr.add_part(part(99, 21, [], 1)) is not None
+    assert cr.add_part(part(105, 15, ["105x1x0"], 1)) is not None
+    # Wrong sync_complete, or timestamps in only some parts.
+    assert ChannelRange(100, 20).add_part(part(100, 20, [])) is not None
+    assert ChannelRange(100, 20).add_part(part(100, 10, [], 1)) is not None
+    cr = ChannelRange(100, 20)
+    assert (
+        cr.add_part(part(100, 10, ["101x1x0"], timestamps_tlv=stamps((1, 1)))) is None
+    )
+    assert cr.add_part(part(110, 10, ["111x1x0"], 1)) is not None
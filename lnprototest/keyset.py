@@ -2,6 +2,13 @@
 # FIXME: clean this up for use as pyln.proto.tx
 import coincurve
 import hashlib
+from typing import Dict, List, Tuple
+
+# BOLT #3:
+# The first secret used:
+#  - MUST be index 281474976710655,
+#    - and from there, the index is decremented.
+MAX_SHACHAIN_INDEX = 281474976710655
 
 
 class KeySet(object):
@@ -20,6 +27,10 @@ class KeySet(object):
         self.htlc_base_secret = privkey_expand(htlc_base_secret)
         self.delayed_payment_base_secret = privkey_expand(delayed_payment_base_secret)
         self.shachain_seed = bytes.fromhex(check_hex(shachain_seed, 64))
+        # Keyed by (shachain_seed, n) and by secret respectively, so they
+        # stay correct if either is replaced (as the BOLT #3 tests do).
+        self.per_commit_secrets: Dict[Tuple[bytes, int], coincurve.PrivateKey] = {}
+        self.per_commit_points: Dict[bytes, coincurve.PublicKey] = {}
 
     def raw_payment_basepoint(self) -> coincurve.PublicKey:
         return coincurve.PublicKey.from_secret(self.payment_base_secret.secret)
@@ -46,13 +57,20 @@ class KeySet(object):
         return self.raw_htlc_basepoint().format().hex()
 
     def raw_per_commit_secret(self, n: int) -> coincurve.PrivateKey:
+        secret = self.per_commit_secrets.get((self.shachain_seed, n))
+        if secret is None:
+            secret = coincurve.PrivateKey(self.shachain_secret(n))
+            self.per_commit_secrets[(self.shachain_seed, n)] = secret
+        return secret
+
+    def shachain_secret(self, n: int) -> bytes:
         # BOLT #3:
         # The first secret used:
         #  - MUST be index 281474976710655,
         #    - and from there, the index is decremented.
-        if n > 281474976710655:
+        if n > MAX_SHACHAIN_INDEX:
             raise ValueError("48 bits is all you get!")
-        index = 281474976710655 - n
+        index = MAX_SHACHAIN_INDEX - n
 
         # BOLT #3:
         # generate_from_seed(seed, I):
@@ -74,13 +92,50 @@ class KeySet(object):
                 P[B // 8] ^= 1 << (B % 8)
                 P = bytearray(hashlib.sha256(P).digest())
 
-        return coincurve.PrivateKey(P)
+        return bytes(P)
+
+    def precompute(self, start: int, count: int) -> None:
+        """Derive the secrets and points for commitments start..start+count-1.
+
+        Consecutive indices share most of their high bits, so we keep the
+        intermediate value after each bit, and only redo the hashes below
+        the highest bit which differs from the previous index.
+        """
+        if start + count - 1 > MAX_SHACHAIN_INDEX:
+            raise ValueError("48 bits is all you get!")
+        # states[k] is P once the top k bits (47 down to 48-k) are done.
+        states: List[bytes] = [self.shachain_seed] * 49
+        prev_index = None
+        for n in range(start, start + count):
+            index = MAX_SHACHAIN_INDEX - n
+            if prev_index is None:
+                done = 0
+            else:
+                done = 48 - (index ^ prev_index).bit_length()
+            P = states[done]
+            for B in range(47 - done, -1, -1):
+                if ((1 << B) & index) != 0:
+                    flipped = bytearray(P)
+                    flipped[B // 8] ^= 1 << (B % 8)
+                    P = hashlib.sha256(flipped).digest()
+                states[48 - B] = P
+            prev_index = index
+
+            secret = coincurve.PrivateKey(P)
+            self.per_commit_secrets[(self.shachain_seed, n)] = secret
+            if P not in self.per_commit_points:
+                self.per_commit_points[P] = coincurve.PublicKey.from_secret(P)
 
     def per_commit_secret(self, n: int) -> str:
         return self.raw_per_commit_secret(n).secret.hex()
 
     def raw_per_commit_point(self, n: int) -> coincurve.PublicKey:
-        return coincurve.PublicKey.from_secret(self.raw_per_commit_secret(n).secret)
+        secret = self.raw_per_commit_secret(n).secret
+        point = self.per_commit_points.get(secret)
+        if point is None:
+            point = coincurve.PublicKey.from_secret(secret)
+            self.per_commit_points[secret] = point
+        return point
 
     def per_commit_point(self, n: int) -> str:
         return self.raw_per_commit_point(n).format().hex()
@@ -172,3 +227,22 @@ def test_shachain() -> None:
         keyset.per_commit_secret(0xFFFFFFFFFFFF - 1)
         == "915c75942a26bb3a433a8ce2cb0427c29ec6c1775cfc78328b57f6ba7bfeaa9c"
     )
+
+
+def test_precompute() -> None:
+    seed = "FFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFF"
+    # BOLT #3: generate_from_seed FF alternate bits 1 (I: 0xaaaaaaaaaaa)
+    alternate = 0xFFFFFFFFFFFF - 0xAAAAAAAAAAA
+    bulk = KeySet("01", "01", "01", "01", seed)
+    bulk.precompute(0, 300)
+    bulk.precompute(alternate - 5, 10)
+    assert (bulk.shachain_seed, alternate) in bulk.per_commit_secrets
+    assert (
+        bulk.per_commit_secret(alternate)
+        == "56f4008fb007ca9acf0e15b054d5c9fd12ee06cea347914ddbaed70d1c13a528"
+    )
+
+    one = KeySet("01", "01", "01", "01", seed)
+    for n in list(range(0, 300)) + list(range(alternate - 5, alternate + 5)):
+        assert bulk.per_commit_secret(n) == one.shachain_secret(n).hex()
+        assert bulk.per_commit_point(n) == one.per_commit_point(n)
@@ -0,0 +1,83 @@
+#! /usr/bin/python3
+# The stash of messages sent (Msg) and received (ExpectMsg) in a run.
+from typing import Any, Dict, Iterator, List, Optional, Tuple, Union, overload
+
+# (message name, fields as returned by Message.to_py())
+LogEntry = Tuple[str, Dict[str, Any]]
+
+
+class MessageLog(object):
+    """The ordered list of (msgname, fields) entries, indexed by msgname.
+
+    This behaves like the plain list the stash used to hold, but rcvd()
+    and sent() can find the first or last message of a given name
+    without scanning the whole log.  If maxlen is set, only the last
+    maxlen entries are kept in the log (for long soak runs), but the
+    first and last entry of each name are always remembered.
+    """
+
+    def __init__(self, maxlen: Optional[int] = None):
+        self.maxlen = maxlen
+        self.entries: List[LogEntry] = []
+        self.first_by_name: Dict[str, LogEntry] = {}
+        self.last_by_name: Dict[str, LogEntry] = {}
+        self.first_entry: Optional[LogEntry] = None
+
+    def append(self, entry: LogEntry) -> None:
+        name = entry[0]
+        if self.first_entry is None:
+            self.first_entry = entry
+        if name not in self.first_by_name:
+            self.first_by_name[name] = entry
+        self.last_by_name[name] = entry
+        self.entries.append(entry)
+        if self.maxlen and len(self.entries) > self.maxlen:
+            del self.entries[: len(self.entries) - self.maxlen]
+
+    def find(self, name: Optional[str] = None, last: bool = True) -> Optional[LogEntry]:
+        """The last (or first) entry called name (any name if None)"""
+        if name:
+            if last:
+                return self.last_by_name.get(name)
+            return self.first_by_name.get(name)
+        if last:
+            return self.entries[-1] if self.entries else None
+        return self.first_entry
+
+    @overload
+    def __getitem__(self, index: int) -> LogEntry: ...
+
+    @overload
+    def __getitem__(self, index: slice) -> List[LogEntry]: ...
+
+    def __getitem__(self, index: Union[int, slice]) -> Any:
+        return self.entries[index]
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def __iter__(self) -> Iterator[LogEntry]:
+        return iter(self.entries)
+
+    def __reversed__(self) -> Iterator[LogEntry]:
+        return reversed(self.entries)
+
+
+def test_message_log() -> None:
+    log = MessageLog()
+    assert log.find() is None
+    log.append(("init", {"features": "01"}))
+    log.append(("ping", {"num_pong_bytes": 1}))
+    log.append(("init", {"features": "02"}))
+    assert log[-1] == ("init", {"features": "02"})
+    assert log.find("init") == ("init", {"features": "02"})
+    assert log.find("init", last=False) == ("init", {"features": "01"})
+    assert log.find("pong") is None
+    assert len(log) == 3
+
+    log = MessageLog(maxlen=2)
+    for i in range(5):
+        log.append(("ping", {"num_pong_bytes": i}))
+    assert [e[1]["num_pong_bytes"] for e in log] == [3, 4]
+    assert log.find(last=False) == ("ping", {"num_pong_bytes": 0})
+    assert log.find("ping", last=False) == ("ping", {"num_pong_bytes": 0})
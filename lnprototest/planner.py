@@ -0,0 +1,100 @@
+#! /usr/bin/python3
+# Work out which runs a test needs before running any of it.
+from typing import Iterator, List, Union
+
+from .event import Event
+from .structure import (
+    Sequence,
+    OneOf,
+    AnyOrder,
+    TryAll,
+    Path,
+    leaf_paths,
+    statically_enabled,
+)
+
+
+def covering_paths(event: Event) -> List[Path]:
+    """The fewest runs which take every branch of every TryAll at least once.
+
+    A TryAll needs each of its branches covered in a separate run, so it
+    costs the sum of its branches.  Siblings in a Sequence (or OneOf,
+    AnyOrder) run in the same run, so their paths are zipped together
+    and cost the most expensive of them.
+    """
+    if not statically_enabled(event):
+        return [{}]
+    if isinstance(event, TryAll):
+        paths: List[Path] = []
+        for i, s in enumerate(event.sequences):
+            if statically_enabled(s):
+                paths += [{event: i, **p} for p in covering_paths(s)]
+        return paths or [{}]
+    if isinstance(event, Sequence):
+        children: List[Event] = event.events
+    elif isinstance(event, (OneOf, AnyOrder)):
+        children = list(event.sequences)
+    else:
+        return [{}]
+
+    child_paths = [covering_paths(c) for c in children]
+    runs = max([len(p) for p in child_paths], default=1)
+    paths = []
+    for n in range(runs):
+        path: Path = {}
+        for cp in child_paths:
+            # Once a child is covered, any of its paths will do.
+            path.update(cp[n] if n < len(cp) else cp[0])
+        paths.append(path)
+    return paths
+
+
+class Plan(object):
+    """The ordered list of runs a test needs, computed without running it.
+
+    By default this is the minimal set of runs covering every TryAll
+    branch; with exhaustive=True it is every combination of branches.
+    """
+
+    def __init__(
+        self,
+        events: Union[Sequence, List[Event], Event],
+        exhaustive: bool = False,
+    ):
+        self.sequence = Sequence(events)
+        if exhaustive:
+            self.paths = leaf_paths(self.sequence)
+        else:
+            self.paths = covering_paths(self.sequence)
+
+    def cost(self) -> int:
+        """How many times the test will be (re)started"""
+        return len(self.paths)
+
+    def shard(self, index: int, count: int) -> List[Path]:
+        """The paths which the index'th of count workers should run"""
+        return self.paths[index::count]
+
+    def __iter__(self) -> Iterator[Path]:
+        return iter(self.paths)
+
+    def __len__(self) -> int:
+        return len(self.paths)
+
+
+def test_plan() -> None:
+    inner = TryAll([], [], [])
+    outer = TryAll([Event(), inner], [])
+    second = TryAll([], [])
+    plan = Plan([outer, second])
+    # outer needs 3 runs for inner's branches plus 1; second fits alongside.
+    assert plan.cost() == 4
+    assert plan.paths == [
+        {outer: 0, inner: 0, second: 0},
+        {outer: 0, inner: 1, second: 1},
+        {outer: 0, inner: 2, second: 0},
+        {outer: 1, second: 0},
+    ]
+    assert Plan([outer, second], exhaustive=True).cost() == 8
+    assert plan.shard(1, 2) == [plan.paths[1], plan.paths[3]]
+    assert Plan(Event()).paths == [{}]
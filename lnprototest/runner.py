@@ -1,15 +1,19 @@
 #! /usr/bin/python3
+import copy
 import logging
 import shutil
 import tempfile
-import asyncio
 
 import coincurve
 import functools
 
+from bitcoin.core import CMutableTransaction
+from pyln.proto.message import Message
+
 from .bitfield import bitfield
 from .errors import SpecFileError
-from .structure import Sequence
+from .structure import Sequence, Path, checkpoint_split
+from .planner import Plan
 from .event import Event, MustNotMsg, ExpectMsg
 from .utils import privkey_expand
 from .keyset import KeySet
@@ -33,6 +37,74 @@ class Conn(object):
         return self.name
 
 
+def snapshot_state(obj: Any, memo: Optional[Dict[int, Any]] = None) -> Any:
+    """Copy runner state (e.g. the stash) so later changes don't affect it.
+
+    copy.deepcopy() can't cope with coincurve keys or python-bitcoinlib's
+    immutable objects, so we copy our own objects and containers, and
+    share everything else (which we never mutate).  Aliasing is preserved,
+    so the Funding inside a stashed Commitment is still the stashed Funding.
+    Objects marked immutable (e.g. HTLC) are shared too, so they can still
+    be found by identity.
+    """
+    if memo is None:
+        memo = {}
+    if id(obj) in memo:
+        return memo[id(obj)]
+
+    if isinstance(obj, dict):
+        ret: Any = {}
+        memo[id(obj)] = ret
+        for k, v in obj.items():
+            ret[k] = snapshot_state(v, memo)
+    elif isinstance(obj, list):
+        ret = []
+        memo[id(obj)] = ret
+        ret.extend(snapshot_state(v, memo) for v in obj)
+    elif isinstance(obj, tuple):
+        ret = tuple(snapshot_state(v, memo) for v in obj)
+        memo[id(obj)] = ret
+    elif isinstance(obj, CMutableTransaction):
+        ret = CMutableTransaction.from_tx(obj)
+        memo[id(obj)] = ret
+    elif isinstance(obj, Message) or (
+        hasattr(obj, "__dict__")
+        and type(obj).__module__.startswith("lnprototest")
+        and not isinstance(obj, type)
+        and not getattr(obj, "immutable", False)
+    ):
+        ret = copy.copy(obj)
+        memo[id(obj)] = ret
+        for k, v in obj.__dict__.items():
+            setattr(ret, k, snapshot_state(v, memo))
+    else:
+        ret = obj
+    return ret
+
+
+class Checkpoint(object):
+    """Runner state before the first TryAll, so later runs can resume from there.
+
+    node_state is whatever the particular runner needs to put the node
+    back the way it was; the stash and the connections (with the
+    MustNotMsg events registered on them) are common to all runners.
+    """
+
+    def __init__(self, runner: "Runner", event: Event, node_state: Any):
+        self.event = event
+        self.node_state = node_state
+        self.stash = snapshot_state(runner.stash)
+        self.conns = [
+            (name, list(conn.must_not_events), conn.expected_error)
+            for name, conn in runner.conns.items()
+        ]
+        # last_conn isn't cleared on disconnect, so it may be gone.
+        last_conn = runner.last_conn
+        self.last_conn = (
+            last_conn.name if last_conn and last_conn.name in runner.conns else None
+        )
+
+
 class Runner(ABC):
     """Abstract base class for runners.
 
@@ -49,27 +121,34 @@ class Runner(ABC):
         self.stash: Dict[str, Dict[str, Any]] = {}
         self.logger = logging.getLogger(__name__)
         self.websocket_server = None
+        # Set if this run should take particular TryAll branches.
+        self.path: Optional[Path] = None
+        # False for copies made by branch_runner()
+        self.primary = True
         if self.config.getoption("verbose"):
             self.logger.setLevel(logging.DEBUG)
         else:
             self.logger.setLevel(logging.INFO)
 
-    async def setup_websocket(self):
-        """Setup WebSocket server if enabled"""
-        if self.config.getoption("websocket"):
-            from .websocket_server import WebSocketServer
-            self.websocket_server = WebSocketServer()
-            await self.websocket_server.start()
+    def setup_websocket(self) -> None:
+        """Start the WebSocket server, which runs until teardown_websocket()"""
+        from .websocket_server import WebSocketServer
+
+        self.websocket_server = WebSocketServer()
+        self.websocket_server.start()
 
-    async def teardown_websocket(self):
+    def teardown_websocket(self) -> None:
         """Stop WebSocket server if running"""
         if self.websocket_server:
-            await self.websocket_server.stop()
+            self.websocket_server.stop()
+            self.websocket_server = None
 
-    async def broadcast_event(self, event: Event, direction: str, payload: Dict[str, Any]):
-        """Broadcast an event through WebSocket if enabled"""
+    def broadcast_event(
+        self, event: Event, direction: str, payload: Dict[str, Any]
+    ) -> None:
+        """Queue an event for WebSocket clients (a noop without --websocket)"""
         if self.websocket_server:
-            await self.websocket_server.broadcast_event(event, direction, payload)
+            self.websocket_server.broadcast_event(event, direction, payload)
 
     def _is_dummy(self) -> bool:
         """The DummyRunner returns True here, as it can't do some things"""
@@ -111,26 +190,120 @@ class Runner(ABC):
         self.last_conn = None
         self.stash = {}
 
+    def branch_runner(self) -> "Runner":
+        """A copy of this runner which can run one branch of a test in parallel.
+
+        It shares our configuration (including any startup flags the test
+        added), but has its own directory, connections and stash, so it
+        starts its own node.  Runners with other per-node state should
+        override this to reset it.
+        """
+        runner = copy.copy(self)
+        runner.directory = tempfile.mkdtemp(prefix="lnpt-cl-")
+        runner.conns = {}
+        runner.last_conn = None
+        runner.stash = {}
+        runner.websocket_server = None
+        runner.path = None
+        runner.primary = False
+        return runner
+
+    def _run_parallel(self, sequence: Sequence, max_workers: int) -> None:
+        """Run each TryAll branch on its own runner, and merge the results"""
+        from .scheduler import run_branches
+
+        report = run_branches(self, sequence, max_workers)
+        self.branch_report = report
+        if not report.passed:
+            self.logger.error("TryAll branch results:\n{}".format(report))
+            raise report.failures()[0].error  # type: ignore
+        self.logger.debug("TryAll branch results:\n{}".format(report))
+
+    def checkpoint(self, event: Event) -> Optional[Checkpoint]:
+        """Snapshot the node so the next runs can skip the common prefix.
+
+        Called (with --checkpoint) once the events before the first TryAll
+        have run.  Runners which can't snapshot the node in its current
+        state return None, and every run starts from scratch as usual.
+        """
+        return None
+
+    def restore(self, checkpoint: Checkpoint) -> None:
+        """Put the node, stash and connections back as they were at checkpoint.
+
+        Runners which implement checkpoint() should restore their node
+        state, then call this to restore the rest.
+        """
+        self.conns = {}
+        self.last_conn = None
+        self.stash = snapshot_state(checkpoint.stash)
+        for name, must_not_events, expected_error in checkpoint.conns:
+            self.connect(checkpoint.event, name)
+            conn = self.conns[name]
+            conn.must_not_events = list(must_not_events)
+            conn.expected_error = expected_error
+        self.last_conn = (
+            self.conns[checkpoint.last_conn] if checkpoint.last_conn else None
+        )
+
+    def _run_paths(self, sequence: Sequence, paths: List[Path]) -> None:
+        """Run the test once down each path, starting afresh in between.
+
+        With --checkpoint, the events before the first TryAll (which are
+        the same for every path) only run once, if the runner can
+        checkpoint after them.  Any connection still open at the TryAll
+        is made again after each restore, by rerunning its events from
+        the Connect: see checkpoint_split().
+        """
+        events = sequence
+        checkpoint = None
+        split = checkpoint_split(sequence)
+        if self.config.getoption("checkpoint", False) and len(paths) > 1 and split:
+            Sequence(sequence.events[:split]).action(self)
+            events = Sequence(sequence.events[split:])
+            checkpoint = self.checkpoint(events)
+
+        for i, path in enumerate(paths):
+            if i != 0:
+                if checkpoint is not None:
+                    self.logger.debug("[RESTORE CHECKPOINT]")
+                    self.restore(checkpoint)
+                else:
+                    self.restart()
+                    events = sequence
+            self.path = path
+            events.action(self)
+            self.post_check(sequence)
+        self.stop()
+
     def run(self, events: Union[Sequence, List[Event], Event]) -> None:
         sequence = Sequence(events)
+        max_workers = self.config.getoption("parallel_branches", 0)
+        if max_workers and self.path is None:
+            self._run_parallel(sequence, max_workers)
+            return
+
+        path = self.path
+        if path is not None:
+            # We're running a single branch for run_branches()
+            paths = [path]
+        else:
+            paths = Plan(sequence).paths
+
         self.start()
-        
+
         # Setup WebSocket server if enabled
-        if self.config.getoption("websocket"):
-            asyncio.run(self.setup_websocket())
-        
+        websocket = self.config.getoption("websocket") and self.primary
+        if websocket:
+            self.setup_websocket()
+
         try:
-            while True:
-                all_done = sequence.action(self)
-                self.post_check(sequence)
-                if all_done:
-                    self.stop()
-                    return
-                self.restart()
+            self._run_paths(sequence, paths)
         finally:
+            self.path = path
             # Cleanup WebSocket server
-            if self.config.getoption("websocket"):
-                asyncio.run(self.teardown_websocket())
+            if websocket:
+                self.teardown_websocket()
 
     def add_stash(self, stashname: str, vals: Any) -> None:
         """Add a dict to the stash."""
@@ -0,0 +1,124 @@
+#! /usr/bin/python3
+# Run each path through a test's TryAlls on its own runner, in parallel.
+import time
+
+from concurrent import futures
+from typing import Any, Dict, List, Optional, Set, TYPE_CHECKING
+
+from .structure import Sequence, Path
+from .planner import Plan
+
+if TYPE_CHECKING:
+    # Otherwise a circular dependency
+    from .runner import Runner
+
+
+def describe_path(path: Path) -> str:
+    """Human readable list of the branch taken at each TryAll"""
+    if not path:
+        return "no TryAll"
+    return ", ".join("{} branch {}".format(t.name, i) for t, i in path.items())
+
+
+class BranchResult(object):
+    """The outcome of running a test down one path"""
+
+    def __init__(self, index: int, path: Path):
+        self.index = index
+        self.path = path
+        self.error: Optional[Exception] = None
+        self.stash: Dict[str, Any] = {}
+        self.duration = 0.0
+
+    @property
+    def passed(self) -> bool:
+        return self.error is None
+
+    def __str__(self) -> str:
+        status = "PASS" if self.passed else "FAIL ({})".format(self.error)
+        return "branch {} [{}]: {} in {:.2f}s".format(
+            self.index, describe_path(self.path), status, self.duration
+        )
+
+
+class BranchReport(object):
+    """Results of every branch of a test, merged into one pass/fail"""
+
+    def __init__(self, results: List[BranchResult]):
+        self.results = results
+
+    @property
+    def passed(self) -> bool:
+        return all(r.passed for r in self.results)
+
+    def failures(self) -> List[BranchResult]:
+        return [r for r in self.results if not r.passed]
+
+    def stash_diff(self) -> Dict[int, Set[str]]:
+        """For each branch, the stash entries which not every branch made"""
+        if not self.results:
+            return {}
+        common = set.intersection(*[set(r.stash) for r in self.results])
+        diff = {}
+        for r in self.results:
+            extra = set(r.stash) - common
+            if extra:
+                diff[r.index] = extra
+        return diff
+
+    def __str__(self) -> str:
+        lines = [
+            "{} of {} branches passed".format(
+                len(self.results) - len(self.failures()), len(self.results)
+            )
+        ]
+        stash_diff = self.stash_diff()
+        for r in self.results:
+            lines.append(str(r))
+            if r.index in stash_diff:
+                lines.append("  only stashed: {}".format(sorted(stash_diff[r.index])))
+        return "\n".join(lines)
+
+
+def run_branch(runner: "Runner", sequence: Sequence, result: BranchResult) -> None:
+    """Run the test once, down result.path, recording how it went"""
+    runner.path = result.path
+    start = time.monotonic()
+    try:
+        runner.run(sequence)
+    except Exception as ex:
+        result.error = ex
+    finally:
+        result.duration = time.monotonic() - start
+        result.stash = runner.stash
+
+
+def run_branches(
+    runner: "Runner", sequence: Sequence, max_workers: int
+) -> BranchReport:
+    """Run each path of the sequence's Plan, up to max_workers at once.
+
+    The first path runs on runner itself, the others on copies made by
+    runner.branch_runner(), each of which has its own node.  So the test
+    takes about as long as its longest path, rather than the sum of them.
+    They all run the same events, so events must keep any per-run state
+    in the runner (e.g. its stash), not in themselves.
+    """
+    paths = Plan(sequence).paths
+    results = [BranchResult(i, p) for i, p in enumerate(paths)]
+    runners = [runner] + [runner.branch_runner() for _ in paths[1:]]
+    try:
+        with futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+            for fut in [
+                executor.submit(run_branch, r, sequence, res)
+                for r, res in zip(runners, results)
+            ]:
+                fut.result()
+    finally:
+        for r, res in zip(runners[1:], results[1:]):
+            try:
+                if not res.passed:
+                    r.stop(print_logs=True)
+            finally:
+                r.teardown()
+    return BranchReport(results)
@@ -0,0 +1,180 @@
+#! /usr/bin/python3
+# BIP143 signature hashes, sharing the work between inputs and transactions.
+import struct
+
+import bitcoin.core.script as script
+from bitcoin.core import Hash, CTransaction, CMutableTransaction, CTxIn, CTxOut
+from bitcoin.core.serialize import BytesSerializer
+from typing import Dict, List, Optional, Sequence, Tuple, Union
+
+AnyTx = Union[CTransaction, CMutableTransaction]
+
+ZERO_HASH = bytes(32)
+
+
+class SighashCache(object):
+    """BIP143 (segwit v0) signature hashes for the inputs of one transaction.
+
+    hashPrevouts, hashSequence and hashOutputs are the same for every input
+    (for a given sighash type), so they're only computed once.  The tx must
+    not be modified while this is in use.
+
+    Transactions can also share hashes of identical serializations (e.g.
+    the nSequence of every HTLC tx), by passing the same shared dict.
+    """
+
+    def __init__(self, tx: AnyTx, shared: Optional[Dict[bytes, bytes]] = None):
+        self.tx = tx
+        self.shared: Dict[bytes, bytes] = {} if shared is None else shared
+        self._prevouts: Optional[bytes] = None
+        self._sequence: Optional[bytes] = None
+        self._outputs: Optional[bytes] = None
+
+    def _hash(self, data: bytes) -> bytes:
+        ret = self.shared.get(data)
+        if ret is None:
+            ret = Hash(data)
+            self.shared[data] = ret
+        return ret
+
+    def hash_prevouts(self) -> bytes:
+        if self._prevouts is None:
+            self._prevouts = self._hash(
+                b"".join(txin.prevout.serialize() for txin in self.tx.vin)
+            )
+        return self._prevouts
+
+    def hash_sequence(self) -> bytes:
+        if self._sequence is None:
+            self._sequence = self._hash(
+                b"".join(struct.pack("<I", txin.nSequence) for txin in self.tx.vin)
+            )
+        return self._sequence
+
+    def hash_outputs(self) -> bytes:
+        if self._outputs is None:
+            self._outputs = self._hash(
+                b"".join(txout.serialize() for txout in self.tx.vout)
+            )
+        return self._outputs
+
+    def sighash(
+        self, inIdx: int, scriptcode: bytes, amount: int, hashtype: int
+    ) -> bytes:
+        """The hash to sign for input inIdx, as script.SignatureHash() gives"""
+        basetype = hashtype & 0x1F
+        anyonecanpay = hashtype & script.SIGHASH_ANYONECANPAY
+        single_or_none = basetype in (script.SIGHASH_SINGLE, script.SIGHASH_NONE)
+
+        hash_prevouts = ZERO_HASH if anyonecanpay else self.hash_prevouts()
+        if anyonecanpay or single_or_none:
+            hash_sequence = ZERO_HASH
+        else:
+            hash_sequence = self.hash_sequence()
+        if not single_or_none:
+            hash_outputs = self.hash_outputs()
+        elif basetype == script.SIGHASH_SINGLE and inIdx < len(self.tx.vout):
+            hash_outputs = Hash(self.tx.vout[inIdx].serialize())
+        else:
+            hash_outputs = ZERO_HASH
+
+        txin: CTxIn = self.tx.vin[inIdx]
+        return Hash(
+            b"".join(
+                [
+                    struct.pack("<i", self.tx.nVersion),
+                    hash_prevouts,
+                    hash_sequence,
+                    txin.prevout.serialize(),
+                    BytesSerializer.serialize(scriptcode),
+                    struct.pack("<q", amount),
+                    struct.pack("<I", txin.nSequence),
+                    hash_outputs,
+                    # Unsigned, as in the tx itself (SignatureHash() uses
+                    # "<i", so can't hash locktimes of 2^31 and above).
+                    struct.pack("<I", self.tx.nLockTime),
+                    struct.pack("<i", hashtype),
+                ]
+            )
+        )
+
+
+def htlc_sighashes(
+    htlc_txs: Sequence[Tuple[AnyTx, bytes, int]], hashtype: int
+) -> List[bytes]:
+    """The hash for the (only) input of each (tx, redeemscript, sats).
+
+    This is what Commitment.htlc_txs() returns: they all spend the same
+    commitment tx, so they share much of their structure."""
+    shared: Dict[bytes, bytes] = {}
+    return [
+        SighashCache(tx, shared).sighash(0, redeemscript, sats, hashtype)
+        for tx, redeemscript, sats in htlc_txs
+    ]
+
+
+def test_sighash() -> None:
+    from bitcoin.core import COutPoint
+
+    tx = CMutableTransaction(
+        vin=[
+            CTxIn(COutPoint(bytes([i]) * 32, i), nSequence=0xFFFFFFFD - i)
+            for i in range(3)
+        ],
+        vout=[
+            CTxOut(1000 * (i + 1), script.CScript([script.OP_0, bytes(20)]))
+            for i in range(2)
+        ],
+        nVersion=2,
+        nLockTime=0x20000000 | 42,
+    )
+    redeemscript = script.CScript([script.OP_1, bytes(33), script.OP_CHECKSIG])
+    cache = SighashCache(tx)
+    for basetype in (script.SIGHASH_ALL, script.SIGHASH_NONE, script.SIGHASH_SINGLE):
+        for anyonecanpay in (0, script.SIGHASH_ANYONECANPAY):
+            hashtype = basetype | anyonecanpay
+            # Input 2 has no matching output for SIGHASH_SINGLE.
+            for inIdx in range(3):
+                assert cache.sighash(
+                    inIdx, redeemscript, 12345, hashtype
+                ) == script.SignatureHash(
+                    redeemscript,
+                    tx,
+                    inIdx,
+                    hashtype,
+                    amount=12345,
+                    sigversion=script.SIGVERSION_WITNESS_V0,
+                )
+
+    # The same 32 bits, which SignatureHash() can only pack as signed.
+    tx.nLockTime = 0xFFFFFFFE
+    high = SighashCache(tx).sighash(0, redeemscript, 12345, script.SIGHASH_ALL)
+    tx.nLockTime -= 1 << 32
+    assert high == script.SignatureHash(
+        redeemscript,
+        tx,
+        0,
+        script.SIGHASH_ALL,
+        amount=12345,
+        sigversion=script.SIGVERSION_WITNESS_V0,
+    )
+
+    htlc_txs = [
+        (
+            CMutableTransaction(
+                vin=[CTxIn(COutPoint(bytes(32), i), nSequence=1)],
+                vout=[CTxOut(500 + i, script.CScript([script.OP_0, bytes(32)]))],
+                nVersion=2,
+            ),
+            redeemscript,
+            600 + i,
+        )
+        for i in range(4)
+    ]
+    hashtype = script.SIGHASH_SINGLE | script.SIGHASH_ANYONECANPAY
+    assert htlc_sighashes(htlc_txs, hashtype) == [
+        script.SignatureHash(
+            rs, tx, 0, hashtype, amount=sats, sigversion=script.SIGVERSION_WITNESS_V0
+        )
+        for tx, rs, sats in htlc_txs
+    ]
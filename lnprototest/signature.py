@@ -1,9 +1,37 @@
 #! /usr/bin/python3
 import coincurve
+import functools
+import os
+from concurrent.futures import ProcessPoolExecutor
 from io import BufferedIOBase
 from pyln.proto.message import FieldType, split_field
 from .utils import check_hex, privkey_expand
-from typing import Union, Tuple, Dict, Any, Optional, cast
+from typing import Union, Tuple, Dict, Any, List, Optional, Sequence, cast
+
+# TryAll re-runs (and every htlc_signature array) check the same
+# signatures against the same keys over and over.
+VERIFY_CACHE_SIZE = 8192
+
+# How many processes sign_all() spreads large batches over (0 == none);
+# below SIGN_POOL_MIN signatures, starting the work costs more than it saves.
+SIGN_PROCESSES = int(os.getenv("LNPROTOTEST_SIGN_PROCESSES", "0"))
+SIGN_POOL_MIN = 64
+
+_sign_pools: Dict[int, ProcessPoolExecutor] = {}
+
+
+@functools.lru_cache(maxsize=1024)
+def pubkey_from_secret(secret: bytes) -> bytes:
+    """Compressed public key for this private key"""
+    return coincurve.PublicKey.from_secret(secret).format()
+
+
+@functools.lru_cache(maxsize=VERIFY_CACHE_SIZE)
+def verify_sig(secret: bytes, hashval: bytes, sigval: bytes) -> bool:
+    """Is sigval a valid signature of hashval by this private key?"""
+    return coincurve.verify_signature(
+        Sig.to_der(sigval), hashval, pubkey_from_secret(secret), hasher=None
+    )
 
 
 class Sig(object):
@@ -14,6 +42,8 @@ class Sig(object):
 
     def __init__(self, *args: Any):
         """Either a 64-byte hex/bytes value, or a PrivateKey and a hash"""
+        # For a PrivateKey and hash, the signature once it's been made.
+        self.signed: Optional[bytes] = None
         if len(args) == 1:
             if type(args[0]) is bytes:
                 if len(args[0]) != 64:
@@ -28,8 +58,16 @@ class Sig(object):
                     self.sigval = bytes.fromhex(args[0])
         elif len(args) == 2:
             self.sigval = None
-            self.privkey = privkey_expand(args[0])
-            self.hashval = bytes.fromhex(check_hex(args[1], 64))
+            if isinstance(args[0], coincurve.PrivateKey):
+                self.privkey = args[0]
+            else:
+                self.privkey = privkey_expand(args[0])
+            if isinstance(args[1], bytes):
+                if len(args[1]) != 32:
+                    raise ValueError("Sig() expects a 32-byte hash")
+                self.hashval = args[1]
+            else:
+                self.hashval = bytes.fromhex(check_hex(args[1], 64))
         else:
             raise TypeError("Expected hexsig or Privkey, hash")
 
@@ -87,13 +125,24 @@ class Sig(object):
             a = othersig
             b = self
         # A has a privkey/hash, B has a sigval.
-        pubkey = coincurve.PublicKey.from_secret(a.privkey.secret)
         assert b.sigval is not None
-        if coincurve.verify_signature(
-            self.to_der(b.sigval), a.hashval, pubkey.format(), hasher=None
-        ):
-            return True
-        return False
+        return verify_sig(a.privkey.secret, a.hashval, b.sigval)
+
+    @staticmethod
+    def first_mismatch(
+        sigs: Sequence["Sig"], expected: Sequence["Sig"]
+    ) -> Optional[int]:
+        """Compare a whole array (e.g. htlc_signature) at once.
+
+        Returns the index of the first signature which doesn't match, the
+        length of the shorter array if they differ in length, or None.
+        """
+        for i, (sig, exp) in enumerate(zip(sigs, expected)):
+            if sig != exp:
+                return i
+        if len(sigs) != len(expected):
+            return min(len(sigs), len(expected))
+        return None
 
     def to_str(self) -> str:
         if self.sigval:
@@ -113,11 +162,68 @@ class Sig(object):
 
     def to_bin(self) -> bytes:
         if not self.sigval:
-            return self.from_der(self.privkey.sign(self.hashval, hasher=None))
+            if self.signed is None:
+                self.signed = compact_sign(self.privkey, self.hashval)
+            return self.signed
         else:
             return self.sigval
 
 
+def compact_sign(privkey: coincurve.PrivateKey, hashval: bytes) -> bytes:
+    """The 64-byte (r, s) signature of hashval.
+
+    A recoverable signature is just this plus the recovery id, and is the
+    same signature sign() gives, without the DER encoding and decoding."""
+    return privkey.sign_recoverable(hashval, hasher=None)[:64]
+
+
+def process_pool(processes: int) -> ProcessPoolExecutor:
+    """The (shared, long-lived) pool of this many signing processes"""
+    pool = _sign_pools.get(processes)
+    if pool is None:
+        pool = ProcessPoolExecutor(max_workers=processes)
+        _sign_pools[processes] = pool
+    return pool
+
+
+def _sign_hashes(secret: bytes, hashvals: Sequence[bytes]) -> List[bytes]:
+    privkey = coincurve.PrivateKey(secret)
+    return [compact_sign(privkey, h) for h in hashvals]
+
+
+def sign_all(
+    privkey: coincurve.PrivateKey,
+    hashvals: Sequence[bytes],
+    processes: Optional[int] = None,
+) -> List[Sig]:
+    """Sign every hash (e.g. for every HTLC tx) with privkey, all at once.
+
+    The Sigs already hold their 64-byte signatures, so writing them out
+    doesn't sign again.  Large batches are spread over a pool of
+    processes (SIGN_PROCESSES by default) if there's more than one.
+    """
+    if processes is None:
+        processes = SIGN_PROCESSES
+    if processes > 1 and len(hashvals) >= SIGN_POOL_MIN:
+        pool = process_pool(processes)
+        chunk = -(-len(hashvals) // processes)
+        chunks = [hashvals[i : i + chunk] for i in range(0, len(hashvals), chunk)]
+        signed = [
+            s
+            for sigs in pool.map(_sign_hashes, [privkey.secret] * len(chunks), chunks)
+            for s in sigs
+        ]
+    else:
+        signed = _sign_hashes(privkey.secret, hashvals)
+
+    ret = []
+    for hashval, sigval in zip(hashvals, signed):
+        sig = Sig(privkey, hashval)
+        sig.signed = sigval
+        ret.append(sig)
+    return ret
+
+
 class SigType(FieldType):
     """A signature type which has special comparison properties"""
 
@@ -156,7 +262,35 @@ def test_signature() -> None:
 
     assert s == s
     b = s.to_bin()
+    assert b == Sig.from_der(s.privkey.sign(s.hashval, hasher=None))
+    assert s.to_bin() is b
     s2 = Sig(b)
 
     assert s == s2
     assert s2 == s
+
+
+def test_verify_cache() -> None:
+    verify_sig.cache_clear()
+    s = Sig("01", "00" * 32)
+    raw = Sig(s.to_bin())
+    assert s == raw and raw == s
+    assert verify_sig.cache_info().hits == 1
+
+    other = Sig("02", "00" * 32)
+    assert Sig.first_mismatch([raw, raw], [s, s]) is None
+    assert Sig.first_mismatch([raw, raw], [s, other]) == 1
+    assert Sig.first_mismatch([raw], [s, s]) == 1
+
+
+def test_sign_all() -> None:
+    privkey = privkey_expand("01")
+    hashvals = [bytes([i]) * 32 for i in range(SIGN_POOL_MIN)]
+    sigs = sign_all(privkey, hashvals)
+    assert [s.to_bin() for s in sigs] == [
+        Sig.from_der(privkey.sign(h, hasher=None)) for h in hashvals
+    ]
+    assert all(s == Sig(s.to_bin()) for s in sigs)
+    assert [s.to_bin() for s in sign_all(privkey, hashvals, processes=2)] == [
+        s.to_bin() for s in sigs
+    ]
@@ -144,20 +144,17 @@ def get_member(
         prevname, _, var = var.partition(".")
     else:
         prevname = ""
-    if last:
-        seq = reversed(stash)
-    else:
-        seq = stash
-
-    for name, d in seq:
-        if prevname == "" or name == prevname:
-            if var not in d:
-                raise SpecFileError(
-                    event,
-                    "{}: {} did not receive a {}".format(stashname, prevname, var),
-                )
-            return d[var]
-    raise SpecFileError(event, "{}: have no prior {}".format(stashname, prevname))
+
+    entry = stash.find(prevname, last)
+    if entry is None:
+        raise SpecFileError(event, "{}: have no prior {}".format(stashname, prevname))
+    d = entry[1]
+    if var not in d:
+        raise SpecFileError(
+            event,
+            "{}: {} did not receive a {}".format(stashname, prevname, var),
+        )
+    return d[var]
 
 
 def _get_member(
@@ -2,11 +2,11 @@
 import io
 import logging
 
-from .event import Event, ExpectMsg, ResolvableBool
+from .event import Event, ExpectMsg, ResolvableBool, PerConnEvent, Connect, Disconnect
 from .errors import SpecFileError, EventError
 from .namespace import namespace
 from pyln.proto.message import Message
-from typing import Union, List, Optional, TYPE_CHECKING, cast
+from typing import Dict, Union, List, Optional, TYPE_CHECKING, cast
 
 if TYPE_CHECKING:
     # Otherwise a circular dependency
@@ -15,6 +15,9 @@ if TYPE_CHECKING:
 # These can all be fed to a Sequence() initializer.
 SequenceUnion = Union["Sequence", List[Event], Event]
 
+# Which branch each TryAll should take, for a single run of a test.
+Path = Dict["TryAll", int]
+
 
 class Sequence(Event):
     """A sequence of ordered events"""
@@ -67,12 +70,15 @@ class Sequence(Event):
 
     @staticmethod
     def match_which_sequence(
-        runner: "Runner", msg: Message, sequences: List["Sequence"]
+        runner: "Runner",
+        msg: Message,
+        sequences: List["Sequence"],
+        binmsg: Optional[bytes] = None,
     ) -> Optional["Sequence"]:
         """Return which sequence expects this msg, or None"""
 
         for s in sequences:
-            failreason = cast(ExpectMsg, s.events[0]).message_match(runner, msg)
+            failreason = cast(ExpectMsg, s.events[0]).message_match(runner, msg, binmsg)
             if failreason is None:
                 return s
 
@@ -129,7 +135,7 @@ class OneOf(Event):
                 continue
 
             seq = Sequence.match_which_sequence(
-                runner, msg, self.enabled_sequences(runner)
+                runner, msg, self.enabled_sequences(runner), binmsg
             )
             if seq is not None:
                 # We found the sequence, run it
@@ -199,7 +205,7 @@ class AnyOrder(Event):
                     runner.recv(self, conn, binm.getvalue())
                 continue
 
-            seq = Sequence.match_which_sequence(runner, msg, sequences)
+            seq = Sequence.match_which_sequence(runner, msg, sequences, binmsg)
             if seq is not None:
                 sequences.remove(seq)
                 all_done &= seq.action(runner, skip_first=True)
@@ -225,6 +231,14 @@ class TryAll(Event):
     def action(self, runner: "Runner") -> bool:
         super().action(runner)
 
+        # If this run was scheduled to take a particular branch, take it.
+        path: Optional[Path] = getattr(runner, "path", None)
+        if path is not None and self in path:
+            seq = self.sequences[path[self]]
+            if seq.enabled(runner):
+                seq.action(runner)
+            return True
+
         # Take first undone one, or if that fails, first enabled one.
         first_enabled = None
         first_undone = None
@@ -251,6 +265,127 @@ class TryAll(Event):
         return all_done
 
 
+def contains_tryall(event: Event) -> bool:
+    """Does this event (or any event nested inside it) branch the test?"""
+    if isinstance(event, TryAll):
+        return True
+    if isinstance(event, Sequence):
+        return any(contains_tryall(e) for e in event.events)
+    if isinstance(event, (OneOf, AnyOrder)):
+        return any(contains_tryall(s) for s in event.sequences)
+    return False
+
+
+def first_divergence(sequence: Sequence) -> Optional[int]:
+    """Index of the first top-level event which contains a TryAll, or None.
+
+    Every run executes the events before this identically, so they only
+    need to be run once if the runner can checkpoint.
+    """
+    for i, e in enumerate(sequence.events):
+        if contains_tryall(e):
+            return i
+    return None
+
+
+def _track_conns(event: Event, conns: List[str]) -> bool:
+    """Update conns (open connections, last used last) as event would.
+
+    Returns False if we can't tell without running it.
+    """
+    if isinstance(event, Connect):
+        conns.append(event.connprivkey)
+    elif isinstance(event, Disconnect):
+        name = event.connprivkey
+        if name is None and conns:
+            name = conns[-1]
+        if name in conns:
+            conns.remove(name)
+    elif isinstance(event, PerConnEvent):
+        # Naming a connection makes it the default for later events.
+        if event.connprivkey in conns:
+            conns.remove(event.connprivkey)
+            conns.append(event.connprivkey)
+    elif isinstance(event, Sequence):
+        if callable(event.enable):
+            return not _has_conn_events(event)
+        if event.enable:
+            return all(_track_conns(e, conns) for e in event.events)
+    elif isinstance(event, (OneOf, AnyOrder)):
+        return not _has_conn_events(event)
+    return True
+
+
+def _has_conn_events(event: Event) -> bool:
+    if isinstance(event, (Connect, Disconnect)):
+        return True
+    if isinstance(event, Sequence):
+        return any(_has_conn_events(e) for e in event.events)
+    if isinstance(event, (OneOf, AnyOrder, TryAll)):
+        return any(_has_conn_events(s) for s in event.sequences)
+    return False
+
+
+def checkpoint_split(sequence: Sequence) -> Optional[int]:
+    """Where to checkpoint, so later runs can skip the events before it.
+
+    This is the last top-level event up to first_divergence() before
+    which no connection is open: a live connection can't be snapshotted,
+    so the events on it after that (its transcript up to the TryAll) are
+    run again after each restore.  None if there's nothing to skip.
+    """
+    split = first_divergence(sequence)
+    if split is None:
+        return None
+
+    conns: List[str] = []
+    best = 0
+    for i, e in enumerate(sequence.events[:split]):
+        if not conns:
+            best = i
+        if not _track_conns(e, conns):
+            break
+    else:
+        if not conns:
+            best = split
+    return best or None
+
+
+def statically_enabled(event: Event) -> bool:
+    """Is this event enabled, as far as we can tell without a runner?"""
+    if isinstance(event, Sequence) and not callable(event.enable):
+        return bool(event.enable)
+    return True
+
+
+def leaf_paths(event: Event) -> List[Path]:
+    """Every distinct way through the TryAlls in this event, without running it.
+
+    Each path names the branch to take at every TryAll it reaches, so the
+    paths can be run independently (and in parallel) rather than relying
+    on the TryAll done flags.
+    """
+    if not statically_enabled(event):
+        return [{}]
+    if isinstance(event, TryAll):
+        paths: List[Path] = []
+        for i, s in enumerate(event.sequences):
+            if statically_enabled(s):
+                paths += [{event: i, **p} for p in leaf_paths(s)]
+        return paths or [{}]
+    if isinstance(event, Sequence):
+        children: List[Event] = event.events
+    elif isinstance(event, (OneOf, AnyOrder)):
+        children = cast(List[Event], event.sequences)
+    else:
+        return [{}]
+
+    paths = [{}]
+    for child in children:
+        paths = [{**p, **q} for p in paths for q in leaf_paths(child)]
+    return paths
+
+
 def test_empty_sequence() -> None:
     class nullrunner(object):
         class dummyconfig(object):
@@ -264,3 +399,58 @@ def test_empty_sequence() -> None:
     seq = Sequence(TryAll([], []))
     assert seq.action(nullrunner()) is False  # type: ignore
     assert seq.action(nullrunner()) is True  # type: ignore
+
+
+def test_first_divergence() -> None:
+    assert first_divergence(Sequence([])) is None
+    assert first_divergence(Sequence([Event(), Event()])) is None
+    assert first_divergence(Sequence([Event(), TryAll([], [])])) == 1
+    assert first_divergence(Sequence([Event(), Sequence(TryAll([], []))])) == 1
+
+
+def test_checkpoint_split() -> None:
+    assert checkpoint_split(Sequence([Event(), Event()])) is None
+    assert checkpoint_split(Sequence([Event(), TryAll([], [])])) == 1
+    # Connect first: there's nothing to skip.
+    assert checkpoint_split(Sequence([Connect("02"), TryAll([], [])])) is None
+    assert (
+        checkpoint_split(
+            Sequence([Event(), Event(), Connect("02"), Event(), TryAll([], [])])
+        )
+        == 2
+    )
+    # Once it's disconnected, we can checkpoint at the TryAll itself.
+    assert (
+        checkpoint_split(
+            Sequence(
+                [Connect("02"), Connect("03"), Disconnect(), Disconnect("02")]
+                + [TryAll([], [])]
+            )
+        )
+        == 4
+    )
+    # We can't tell which of these connects.
+    assert (
+        checkpoint_split(
+            Sequence(
+                [Event(), OneOf([Connect("02")], [Event()]), Event(), TryAll([], [])]
+            )
+        )
+        == 1
+    )
+
+
+def test_leaf_paths() -> None:
+    inner = TryAll([], [])
+    outer = TryAll(Sequence([], enable=False), [Event(), inner], [])
+    second = TryAll([], [])
+    paths = leaf_paths(Sequence([outer, second]))
+    assert paths == [
+        {outer: 1, inner: 0, second: 0},
+        {outer: 1, inner: 0, second: 1},
+        {outer: 1, inner: 1, second: 0},
+        {outer: 1, inner: 1, second: 1},
+        {outer: 2, second: 0},
+        {outer: 2, second: 1},
+    ]
+    assert leaf_paths(Event()) == [{}]
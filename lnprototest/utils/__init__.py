@@ -7,6 +7,7 @@ from .utils import (
     Side,
     privkey_expand,
     wait_for,
+    cache_dir,
     check_hex,
     gen_random_keyset,
     run_runner,
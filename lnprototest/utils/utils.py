@@ -2,6 +2,7 @@
 Utils module that implement common function used across lnprototest library.
 """
 
+import os
 import string
 import coincurve
 import time
@@ -66,6 +67,18 @@ def gen_random_keyset(counter: int = 20) -> KeySet:
     )
 
 
+def cache_dir(*subdirs: str) -> str:
+    """Where generated data is kept between runs (created if needed).
+
+    This is $LNPROTOTEST_CACHE_DIR, or ~/.cache/lnprototest by default."""
+    base = os.getenv("LNPROTOTEST_CACHE_DIR") or os.path.join(
+        os.path.expanduser("~"), ".cache", "lnprototest"
+    )
+    path = os.path.join(base, *subdirs)
+    os.makedirs(path, exist_ok=True)
+    return path
+
+
 def wait_for(success: typing.Callable, timeout: int = 180) -> None:
     start_time = time.time()
     interval = 0.25
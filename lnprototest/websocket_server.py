@@ -1,26 +1,111 @@
 import asyncio
 import json
+import logging
+import threading
 import websockets
-from typing import Dict, Any, Optional
+from concurrent import futures
+from typing import Dict, Any, Optional, Set
 from .event import Event, Msg, ExpectMsg
 
+# How long stop() waits for queued broadcasts to go out.
+STOP_TIMEOUT = 5
+
+
 class WebSocketServer:
+    """Broadcasts events to WebSocket clients for the whole of a run.
+
+    The server lives on its own event loop in a background thread, so
+    events only have to queue a broadcast, which never blocks them.
+    """
+
     def __init__(self, host: str = "localhost", port: int = 8765):
         self.host = host
         self.port = port
-        self.clients = set()
-        self.server = None
+        self.clients: Set[Any] = set()
+        self.server: Optional[Any] = None
+        self.loop: Optional[asyncio.AbstractEventLoop] = None
+        self.queue: Optional["asyncio.Queue[str]"] = None
+        self.thread: Optional[threading.Thread] = None
+        self.startup_error: Optional[BaseException] = None
+
+    def start(self) -> None:
+        """Start the server thread, and wait until it's listening"""
+        started = threading.Event()
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(
+            target=self._run, args=(started,), name="websocket", daemon=True
+        )
+        self.thread.start()
+        started.wait()
+        if self.startup_error is not None:
+            self.thread.join()
+            raise self.startup_error
 
-    async def start(self):
+    def _run(self, started: threading.Event) -> None:
+        assert self.loop
+        asyncio.set_event_loop(self.loop)
+        try:
+            self.loop.run_until_complete(self._serve())
+        except BaseException as ex:
+            self.startup_error = ex
+            started.set()
+            self.loop.close()
+            return
+        started.set()
+        self.loop.run_forever()
+        # Whatever stop() gave up waiting for.
+        if self.server is not None:
+            self.server.close()
+        pending = asyncio.all_tasks(self.loop)
+        for task in pending:
+            task.cancel()
+        self.loop.run_until_complete(asyncio.gather(*pending, return_exceptions=True))
+        self.loop.close()
+
+    async def _serve(self) -> None:
+        self.queue = asyncio.Queue()
         self.server = await websockets.serve(self.handle_client, self.host, self.port)
+        self.sender = asyncio.ensure_future(self._send_queued())
         print(f"WebSocket server started at ws://{self.host}:{self.port}")
 
-    async def stop(self):
-        if self.server:
-            self.server.close()
-            await self.server.wait_closed()
+    async def _send_queued(self) -> None:
+        assert self.queue
+        while True:
+            message = await self.queue.get()
+            if self.clients:
+                websockets.broadcast(self.clients, message)
+            self.queue.task_done()
+
+    async def _close(self) -> None:
+        assert self.queue and self.server
+        await self.queue.join()
+        self.sender.cancel()
+        self.server.close()
+        await self.server.wait_closed()
 
-    async def handle_client(self, websocket, path):
+    def stop(self, timeout: float = STOP_TIMEOUT) -> None:
+        """Send anything still queued, then shut down the server thread.
+
+        This is called while cleaning up after a test (which may have
+        failed), so a slow shutdown is logged rather than raised."""
+        if self.loop is None or self.thread is None:
+            return
+        closing = asyncio.run_coroutine_threadsafe(self._close(), self.loop)
+        try:
+            closing.result(timeout)
+        except futures.TimeoutError:
+            closing.cancel()
+            logging.warning(
+                "WebSocket server took over %ss to stop: dropped queued events",
+                timeout,
+            )
+        finally:
+            self.loop.call_soon_threadsafe(self.loop.stop)
+            self.thread.join()
+            self.loop = None
+            self.thread = None
+
+    async def handle_client(self, websocket: Any, path: Optional[str] = None) -> None:
         self.clients.add(websocket)
         try:
             async for message in websocket:
@@ -29,23 +114,44 @@ class WebSocketServer:
         finally:
             self.clients.remove(websocket)
 
-    async def broadcast_event(self, event: Event, direction: str, payload: Dict[str, Any]):
-        """Broadcast an event to all connected clients"""
-        if not self.clients:
+    def broadcast_event(
+        self, event: Event, direction: str, payload: Dict[str, Any]
+    ) -> None:
+        """Queue an event to broadcast to all connected clients"""
+        if not self.clients or self.loop is None:
             return
 
         message = {
             "direction": direction,
             "msg_name": event.__class__.__name__,
-            "payload": payload
+            "payload": payload,
         }
+        # Encode it now, as the payload may change once the event returns.
+        self.loop.call_soon_threadsafe(
+            self.queue.put_nowait, json.dumps(message, default=str)  # type: ignore
+        )
 
-        websockets.broadcast(self.clients, json.dumps(message))
-
-    async def broadcast_message(self, msg: Msg, direction: str):
+    def broadcast_message(self, msg: Msg, direction: str) -> None:
         """Broadcast a message event to all connected clients"""
-        await self.broadcast_event(msg, direction, msg.kwargs)
+        self.broadcast_event(msg, direction, msg.kwargs)
 
-    async def broadcast_expect(self, expect: ExpectMsg, direction: str):
+    def broadcast_expect(self, expect: ExpectMsg, direction: str) -> None:
         """Broadcast an expect message event to all connected clients"""
-        await self.broadcast_event(expect, direction, {"msgtype": expect.msgtype}) 
\ No newline at end of file
+        self.broadcast_event(expect, direction, {"msgtype": expect.msgtype})
+
+
+def test_stop_timeout() -> None:
+    import time
+
+    server = WebSocketServer(port=0)
+    server.start()
+
+    async def stuck() -> None:
+        await asyncio.sleep(1)
+
+    # A slow shutdown mustn't raise (and hide why the test failed).
+    server._close = stuck  # type: ignore
+    start = time.monotonic()
+    server.stop(timeout=0.1)
+    assert time.monotonic() - start < 1
+    assert server.thread is None
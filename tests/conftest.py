@@ -22,6 +22,32 @@ def pytest_addoption(parser: Any) -> None:
         help="parameters for runner to use",
         default=[],
     )
+    parser.addoption(
+        "--checkpoint",
+        action="store_true",
+        help="run events before the first TryAll once, then restore from there",
+        default=False,
+    )
+    parser.addoption(
+        "--parallel-branches",
+        action="store",
+        type=int,
+        help="run each TryAll branch on its own runner, this many at a time",
+        default=0,
+    )
+    parser.addoption(
+        "--websocket",
+        action="store_true",
+        help="broadcast events to WebSocket clients on ws://localhost:8765",
+        default=False,
+    )
+    parser.addoption(
+        "--stash-retention",
+        action="store",
+        type=int,
+        help="only keep the last N sent and received messages in the stash",
+        default=0,
+    )
 
 
 @pytest.fixture()  # type: ignore
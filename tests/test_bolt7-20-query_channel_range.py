@@ -17,16 +17,15 @@ from lnprototest import (
     Sequence,
     CheckEq,
     EventError,
-    namespace,
+    ExpectReplyChannelRange,
+    channel_range_scids,
+    channel_range_timestamps,
 )
 from lnprototest.utils import BitcoinUtils, tx_spendable, utxo
 from typing import Optional
 import pytest
 import time
-import io
-import zlib
-import crc32c
-from pyln.spec.bolt7 import channel_update_timestamps
+from lnprototest import gossip_query
 from pyln.proto.message import Message
 
 # Note for gossip_channel_range: we are *allowed* to return a superset
@@ -44,39 +43,22 @@ def encode_timestamps(t1: int = 0, t2: int = 0) -> str:
     # 2. data:
     #     * [`u32`:`timestamp_node_id_1`]
     #     * [`u32`:`timestamp_node_id_2`]
-    #
-    # Where:
-    # * `timestamp_node_id_1` is the timestamp of the `channel_update` for
-    #   `node_id_1`, or 0 if there was no `channel_update` from that node.
-    # * `timestamp_node_id_2` is the timestamp of the `channel_update` for
-    #    `node_id_2`, or 0 if there was no `channel_update` from that node.
-    v, _ = channel_update_timestamps.val_from_str(
-        "{{timestamp_node_id_1={},timestamp_node_id_2={}}}".format(t1, t2)
-    )
-
-    buf = io.BytesIO()
-    channel_update_timestamps.write(buf, v, {})
-    return buf.getvalue().hex()
+    return gossip_query.encode_timestamps([(t1, t2)]).hex()
 
 
 def decode_timestamps(runner: "Runner", event: Event, field: str) -> str:
     # Get timestamps from last reply_channel_range msg
     timestamps = runner.get_stash(event, "ExpectMsg")[-1][1]["tlvs"]["timestamps_tlv"]
 
-    # BOLT #7:
-    # Encoding types:
-    # * `0`: uncompressed array of `short_channel_id` types, in ascending
-    #   order.
-    # * `1`: array of `short_channel_id` types, in ascending order, compressed
-    #   with zlib deflate<sup>[1](#reference-1)</sup>
-    if timestamps["encoding_type"] == 0:
-        b = bytes.fromhex(timestamps["encoded_timestamps"])
-    elif timestamps["encoding_type"] == 1:
-        b = zlib.decompress(bytes.fromhex(timestamps["encoded_timestamps"]))
-    else:
-        raise EventError(event, "Unknown encoding type: {}".format(timestamps))
+    try:
+        pairs = gossip_query.decode_timestamps(
+            timestamps["encoding_type"],
+            bytes.fromhex(timestamps["encoded_timestamps"]),
+        )
+    except ValueError as ve:
+        raise EventError(event, "Bad timestamps {}: {}".format(timestamps, ve))
 
-    return b.hex()
+    return gossip_query.encode_timestamps(pairs).hex()
 
 
 def decode_scids(runner: "Runner", event: Event, field: str) -> str:
@@ -88,53 +70,13 @@ def decode_scids(runner: "Runner", event: Event, field: str) -> str:
     encoded = bytes.fromhex(
         runner.get_stash(event, "ExpectMsg")[-1][1]["encoded_short_ids"]
     )
-    # BOLT #7:
-    # Encoding types:
-    # * `0`: uncompressed array of `short_channel_id` types, in ascending
-    #   order.
-    # * `1`: array of `short_channel_id` types, in ascending order, compressed
-    #   with zlib deflate<sup>[1](#reference-1)</sup>
-    if encoded[0] == 0:
-        b = encoded[1:]
-    elif encoded[0] == 1:
-        b = zlib.decompress(encoded[1:])
-    else:
+    try:
+        return ",".join(gossip_query.decode_scids(encoded))
+    except ValueError as ve:
         raise EventError(
-            event, "Unknown encoding type {}: {}".format(encoded[0], encoded.hex())
+            event, "Bad encoded_short_ids {}: {}".format(encoded.hex(), ve)
         )
 
-    scidtype = namespace().get_fundamentaltype("short_channel_id")
-    arr = []
-    buf = io.BytesIO(b)
-    while True:
-        scid = scidtype.read(buf, {})
-        if scid is None:
-            break
-        arr.append(scid)
-
-    return ",".join([scidtype.val_to_str(a, {}) for a in arr])
-
-
-def calc_checksum(update: Message) -> int:
-    # BOLT #7: The checksum of a `channel_update` is the CRC32C checksum as
-    # specified in [RFC3720](https://tools.ietf.org/html/rfc3720#appendix-B.4)
-    # of this `channel_update` without its `signature` and `timestamp` fields.
-    bufio = io.BytesIO()
-    update.write(bufio)
-    buf = bufio.getvalue()
-
-    # BOLT #7:
-    # 1. type: 258 (`channel_update`)
-    # 2. data:
-    #     * [`signature`:`signature`]
-    #     * [`chain_hash`:`chain_hash`]
-    #     * [`short_channel_id`:`short_channel_id`]
-    #     * [`u32`:`timestamp`]
-    #     * [`byte`:`message_flags`]
-
-    # Note: 2 bytes for `type` field
-    return crc32c.crc32c(buf[2 + 64 : 2 + 64 + 32 + 8] + buf[2 + 64 + 32 + 8 + 4 :])
-
 
 def update_checksums(update1: Optional[Message], update2: Optional[Message]) -> str:
     # BOLT #7:
@@ -150,16 +92,7 @@ def update_checksums(update1: Optional[Message], update2: Optional[Message]) ->
     #   `node_id_1`, or 0 if there was no `channel_update` from that node.
     # * `checksum_node_id_2` is the checksum of the `channel_update` for
     #   `node_id_2`, or 0 if there was no `channel_update` from that node.
-    if update1:
-        csum1 = calc_checksum(update1)
-    else:
-        csum1 = 0
-
-    if update2:
-        csum2 = calc_checksum(update2)
-    else:
-        csum2 = 0
-
+    csum1, csum2 = gossip_query.update_checksums([(update1, update2)])[0]
     return "{{checksum_node_id_1={},checksum_node_id_2={}}}".format(csum1, csum2)
 
 
@@ -339,6 +272,41 @@ def test_query_channel_range(runner: Runner) -> None:
                 ),
                 CheckEq(decode_scids, "103x1x0,109x1x0"),
             ],
+            # Both again, however many parts the reply is split into.
+            [
+                Msg(
+                    "query_channel_range",
+                    chain_hash=BitcoinUtils.blockchain_hash(),
+                    first_blocknum=103,
+                    number_of_blocks=7,
+                ),
+                ExpectReplyChannelRange(first_blocknum=103, number_of_blocks=7),
+                CheckEq(channel_range_scids(), "103x1x0,109x1x0"),
+                CheckEq(channel_range_timestamps(), None),
+            ],
+            Sequence(
+                enable=runner.has_option("option_gossip_queries_ex") is not None,
+                events=[
+                    Msg(
+                        "query_channel_range",
+                        chain_hash=BitcoinUtils.blockchain_hash(),
+                        first_blocknum=103,
+                        number_of_blocks=7,
+                        tlvs="{query_option={query_option_flags=1}}",
+                    ),
+                    ExpectReplyChannelRange(first_blocknum=103, number_of_blocks=7),
+                    CheckEq(channel_range_scids(), "103x1x0,109x1x0"),
+                    CheckEq(
+                        channel_range_timestamps(),
+                        [
+                            funding1.node_id_sort(timestamp_103x1x0_LOCAL, 0),
+                            funding2.node_id_sort(
+                                timestamp_109x1x0_LOCAL, timestamp_109x1x0_REMOTE
+                            ),
+                        ],
+                    ),
+                ],
+            ),
             # This should get appended timestamp fields with option_gossip_queries_ex
             Sequence(
                 enable=runner.has_option("option_gossip_queries_ex") is not None,